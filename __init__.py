@@ -38,23 +38,53 @@ from . import gp_rigging_ops
 from . import gp_custom_props
 from . import gp_resampling_ops
 from . import gp_curve_baker
+from . import gp_segment_ops
+from . import gp_profiling
+from . import gp_rig_stats
+from . import gp_bbone_lod
+from . import gp_culling
+from . import gp_fcurve_sampler
+from . import gp_point_cache
+from . import gp_distributed_bake
+from . import gp_stroke_kdtree
+from . import gp_bone_registry
 
 
 
 # register
 ##################################
 def register():
+    gp_bbone_lod.register()
+    gp_point_cache.register()
+    gp_stroke_kdtree.register()
+    gp_bone_registry.register()
+    gp_culling.register()
+    gp_fcurve_sampler.register()
     gp_custom_props.register()
     gp_armature_applier.register()
+    gp_distributed_bake.register()
     gomez_poser_ui.register()
     gp_rigging_ops.register()
     gp_resampling_ops.register()
     gp_curve_baker.register()
+    gp_segment_ops.register()
+    gp_profiling.register()
+    gp_rig_stats.register()
 
 def unregister():
     gp_armature_applier.unregister()
+    gp_distributed_bake.unregister()
     gomez_poser_ui.unregister()
     gp_rigging_ops.unregister()
     gp_custom_props.unregister()
     gp_resampling_ops.unregister()
     gp_curve_baker.unregister()
+    gp_segment_ops.unregister()
+    gp_profiling.unregister()
+    gp_rig_stats.unregister()
+    gp_bbone_lod.unregister()
+    gp_culling.unregister()
+    gp_fcurve_sampler.unregister()
+    gp_point_cache.unregister()
+    gp_stroke_kdtree.unregister()
+    gp_bone_registry.unregister()
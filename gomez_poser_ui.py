@@ -26,9 +26,13 @@ from bpy.props import BoolProperty, PointerProperty, CollectionProperty, StringP
 import re
 from mathutils import Vector, Matrix, kdtree
 import bmesh
+from bpy.app.handlers import persistent
 from . import gp_armature_applier
 from .gp_armature_applier import remove_vertex_groups
 from .gp_rigging_ops import change_context
+from .gp_bone_registry import get_bone_registry, throttled
+from . import gp_profiling
+from . import gp_bbone_lod
 from bpy_extras.view3d_utils import location_3d_to_region_2d
 from math import ceil, log
 
@@ -51,48 +55,38 @@ def set_control_visibility(context, event=None):
     # Show layer 6 and the controls set in the interface
     addon_properties = context.window_manager.gopo_prop_group
     armature = addon_properties.ob_armature
+    # Debounced: the armature may have been cleared or deleted since
+    if not armature:
+        return
     armature.data.layers[6] = True
     armature.data.layers[0] = addon_properties.show_ctrls
     armature.data.layers[1] = addon_properties.show_handles
     armature.data.layers[4] = addon_properties.show_roots
-    pbones = context.object.pose.bones
+    pbones = armature.pose.bones
     if not pbones:
         return
-    view = context.space_data
-    if not view or not view.overlay:
-        return
-    
-    overlay = view.overlay
-
-    for pbone in pbones:
-
-        ctrl_bone = pbone.bone.poser_control
-        root_bone = pbone.bone.poser_root
-        handle_bone = pbone.bone.poser_handle
-        show_handle = handle_bone and \
-            ((overlay.display_handle == 'ALL') or \
-             ((overlay.display_handle == 'SELECTED')) and \
-             (pbone.bone.select or pbone.bone.gp_lhandle.select))
-
-        if ctrl_bone:
-            pbone.bone.layers[0] = True
-        elif root_bone:
-            pbone.bone.layers[4] = True
-        elif handle_bone:
-            pbone.bone.layers[1] = True
-            
-        # if (ctrl_bone or root_bone or show_handle): #and pbone.bone.rigged_stroke in ctrls_to_show:
-        #     pbone.bone.layers[0] = True
-        #     pbone.bone.layers[3] = True
-        # else:
-        #     pbone.bone.layers[0] = False #event.alt
-        #     pbone.bone.layers[3] = True
+
+    registry = get_bone_registry(armature)
+    for name in registry.names('CTRL'):
+        pbones[name].bone.layers[0] = True
+    for name in registry.names('ROOT'):
+        pbones[name].bone.layers[4] = True
+    for name in registry.names('HANDLE'):
+        pbones[name].bone.layers[1] = True
 
 
         
 
 
 
+def schedule_control_visibility():
+    """
+    Debounced set_control_visibility: bursts of calls (e.g. fast mode
+    toggling) result in a single update
+    """
+    throttled('control_visibility', lambda: set_control_visibility(bpy.context), interval=0.1)
+
+
 class GOMEZ_OT_go_pose(bpy.types.Operator):
     """
     Go from draw mode of the gp_ob  to pose mode of the armature
@@ -101,13 +95,21 @@ class GOMEZ_OT_go_pose(bpy.types.Operator):
     bl_label = "Gposer go_pose"
     bl_options = {'REGISTER', 'UNDO'}
 
+    # Only one instance of the modal handler is kept running, in the window
+    # with this pointer.  Blender drops modal handlers without calling modal
+    # when the file is loaded or the window closed
+    modal_running = False
+    modal_window = 0
+
     def modal(self, context, event):
-        if not context.active_object.type == 'ARMATURE':
+        gp_bbone_lod.notice_event(event)
+        if not context.active_object or not context.active_object.type == 'ARMATURE':
+            GOMEZ_OT_go_pose.modal_running = False
             return {'FINISHED'}
         if event.shift and event.type == 'O':
+            GOMEZ_OT_go_pose.modal_running = False
             bpy.ops.armature.go_draw()
             return {'FINISHED'}
-        # set_control_visibility(context, event)
 
         return {'PASS_THROUGH'}
 
@@ -115,20 +117,38 @@ class GOMEZ_OT_go_pose(bpy.types.Operator):
         return self.execute(context)
 
     def execute(self, context):
-        bpy.ops.object.mode_set(mode='OBJECT')
         armature = context.window_manager.gopo_prop_group.ob_armature
-        armature.hide_viewport = False
-        armature.select_set(True)
-        context.space_data.overlay.show_relationship_lines = False
-        # deselect the gp object
-        context.view_layer.objects.active.select_set(False)
-        context.view_layer.objects.active = armature
-        bpy.ops.object.mode_set(mode='POSE')
+        if not (context.mode == 'POSE' and context.object == armature):
+            if context.mode != 'OBJECT':
+                bpy.ops.object.mode_set(mode='OBJECT')
+            armature.hide_viewport = False
+            armature.select_set(True)
+            # deselect the gp object
+            if context.view_layer.objects.active:
+                context.view_layer.objects.active.select_set(False)
+            context.view_layer.objects.active = armature
+            bpy.ops.object.mode_set(mode='POSE')
+        if context.space_data and getattr(context.space_data, 'overlay', None):
+            context.space_data.overlay.show_relationship_lines = False
+        schedule_control_visibility()
+
+        if GOMEZ_OT_go_pose.is_running(context) or not context.window:
+            return {'FINISHED'}
+        GOMEZ_OT_go_pose.modal_running = True
+        GOMEZ_OT_go_pose.modal_window = context.window.as_pointer()
         context.window_manager.modal_handler_add(self)
-        set_control_visibility(context)
-
         return {'RUNNING_MODAL'}
 
+    @classmethod
+    def is_running(cls, context):
+        """
+        Whether the modal handler runs, in a window that still exists
+        """
+        if cls.modal_running:
+            windows = {window.as_pointer() for window in context.window_manager.windows}
+            cls.modal_running = cls.modal_window in windows
+        return cls.modal_running
+
     @classmethod
     def poll(cls, context):
         armature = context.window_manager.gopo_prop_group.ob_armature
@@ -167,7 +187,7 @@ class GOMEZ_OT_go_draw(bpy.types.Operator):
     @classmethod
     def poll(cls, context):
         gp_ob = context.window_manager.gopo_prop_group.gp_ob
-        if (context.space_data.type == 'VIEW_3D') and (context.mode == 'POSE') and gp_ob:
+        if context.space_data and (context.space_data.type == 'VIEW_3D') and (context.mode == 'POSE') and gp_ob:
             return True
         else:
             return False
@@ -192,6 +212,31 @@ class GomezPTPanel(bpy.types.Panel):
         layout.use_property_split = True
 
         layout.row().prop(addon_properties, 'error_threshold')
+        layout.row().prop(addon_properties, 'weight_falloff')
+        layout.row().prop(addon_properties, 'ease_mode')
+        layout.row().prop(addon_properties, 'modifier_mode')
+        layout.row().operator("greasepencil.consolidate_armature_mods")
+        layout.row().prop(addon_properties, 'bbone_segment_budget')
+        layout.row().prop(addon_properties, 'bbone_lod')
+        if addon_properties.bbone_lod:
+            layout.row().prop(addon_properties, 'lod_mode')
+            layout.row().prop(addon_properties, 'lod_segments')
+            if addon_properties.lod_mode == 'ZOOM':
+                layout.row().prop(addon_properties, 'lod_zoom_distance')
+        layout.row().prop(addon_properties, 'enable_culling')
+        if addon_properties.enable_culling:
+            layout.row().prop(addon_properties, 'cull_margin')
+        layout.row().prop(addon_properties, 'mute_inactive_rigs')
+        if addon_properties.enable_culling or addon_properties.mute_inactive_rigs:
+            layout.row().prop(addon_properties, 'cull_restore_render')
+            if addon_properties.modifier_mode == 'SHARED':
+                # A shared modifier can't be muted for a single stroke
+                layout.row().label(text='Shared modifiers: only the bones are muted', icon='INFO')
+        layout.row().prop(addon_properties, 'max_bones_per_stroke')
+        layout.row().prop(addon_properties, 'scene_bone_budget')
+        if addon_properties.max_bones_per_stroke or addon_properties.scene_bone_budget:
+            layout.row().label(text=f'Max error: {addon_properties.last_fit_error:.4f}')
+        layout.row().operator("greasepencil.rig_cost_report")
 
 
         layout.row().prop(addon_properties,
@@ -221,12 +266,74 @@ class GomezPTPanel(bpy.types.Panel):
             layout.row().prop(addon_properties, 'frame_end')
         layout.row().prop(addon_properties, 'bake_step')
         layout.row().prop(addon_properties, 'bake_to_new_layer')
+        layout.row().prop(addon_properties, 'bake_offline')
+        layout.row().prop(addon_properties, 'bake_to_point_cache')
+        if addon_properties.bake_to_point_cache:
+            layout.row().prop(addon_properties, 'point_cache_dir')
+            layout.row().prop(addon_properties, 'point_cache_encoding')
+            if addon_properties.point_cache_encoding == 'DELTA':
+                layout.row().prop(addon_properties, 'point_cache_precision')
         layout.row().prop(addon_properties, 'bake_from_active_to_current')
         layout.row().operator("greasepencil.gp_bake_animation")
+        row = layout.row()
+        row.prop(addon_properties, 'bake_workers')
+        row.operator("greasepencil.distributed_bake")
+
+        gp_ob = addon_properties.gp_ob
+        if gp_ob:
+            for item in gp_ob.data.gposer_point_caches:
+                row = layout.row()
+                row.label(text=f'{item.name}: {item.num_frames} frames')
+                row.operator("greasepencil.remove_point_cache", text='', icon='X').cache_name = item.name
+
+
+class GOMEZ_PT_profiling(bpy.types.Panel):
+    """
+    Timings of the last operator calls
+    """
+    bl_label = "Profiling"
+    bl_idname = "GOMEZ_PT_profiling"
+    bl_space_type = "VIEW_3D"
+    bl_region_type = 'UI'
+    bl_category = 'Gomez Poser'
+    bl_parent_id = "GOMEZ_PT_layout"
+    bl_options = {'DEFAULT_CLOSED'}
+
+    def draw(self, context):
+        addon_properties = context.window_manager.gopo_prop_group
+        layout = self.layout
+        layout.row().prop(addon_properties, 'enable_profiling')
+
+        calls = gp_profiling.get_calls()
+        if calls:
+            call = calls[-1]
+            layout.label(text=f"{call['operator']}: {call['duration']*1000:.1f} ms")
+            col = layout.column(align=True)
+            for name, total, count in gp_profiling.summarize(call):
+                col.label(text=f'{name}: {total*1000:.1f} ms ({count})')
+
+        row = layout.row()
+        row.operator("wm.gposer_profile_dump")
+        row.operator("wm.gposer_profile_clear")
+
+        layout.row().prop(addon_properties, 'enable_frame_timing')
+        frame_times = gp_profiling.get_frame_times()
+        if addon_properties.enable_frame_timing and frame_times:
+            average = sum(frame_times) / len(frame_times)
+            layout.label(text=f'Frame: {frame_times[-1]*1000:.1f} ms (avg {average*1000:.1f} ms)')
+        layout.row().operator("greasepencil.rig_playback_timing")
+
+
+@persistent
+def go_pose_load_post(*args):
+    # Loading a file drops the modal handler
+    GOMEZ_OT_go_pose.modal_running = False
 
 
 def register():
+    bpy.app.handlers.load_post.append(go_pose_load_post)
     bpy.utils.register_class(GomezPTPanel)
+    bpy.utils.register_class(GOMEZ_PT_profiling)
     bpy.utils.register_class(GOMEZ_OT_go_draw)
     bpy.utils.register_class(GOMEZ_OT_go_pose)
 
@@ -267,6 +374,8 @@ def register():
 
         
 def unregister():
+    bpy.app.handlers.load_post.remove(go_pose_load_post)
+    bpy.utils.unregister_class(GOMEZ_PT_profiling)
     bpy.utils.unregister_class(GomezPTPanel)
     bpy.utils.unregister_class(GOMEZ_OT_go_draw)
     bpy.utils.unregister_class(GOMEZ_OT_go_pose)
@@ -0,0 +1,152 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Python API for pipeline scripts, usable in background mode:
+#
+#     from gomez_poser import gp_api
+#     rigged = gp_api.rig_strokes(gp_ob, armature, [('Lines', 1, 0), ('Lines', 1, 3)],
+#                                 error_threshold=0.02, settings={'ease_mode': 'STATIC'})
+#     gp_api.bake_rigged_strokes(gp_ob, armature, [r.group_id for r in rigged], 1, 48)
+#
+# The calls leave the addon settings, the current frame, the active object
+# and its mode as they found them.
+
+import bpy
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from . import gp_auxiliary_objects
+from .gp_rigging_ops import rig_stroke
+from .gp_armature_applier import bake_strokes
+
+# Result of rigging a stroke, seconds is the time spent rigging it
+RiggedStroke = namedtuple('RiggedStroke', 'layer frame stroke_index group_id max_error seconds')
+
+
+def get_layer(gp_ob, layer):
+    """
+    Layer of gp_ob by name or index
+    """
+    layers = gp_ob.data.layers
+    if isinstance(layer, int):
+        if not -len(layers) <= layer < len(layers):
+            raise ValueError(f'{gp_ob.name} has no layer {layer}')
+        return layers[layer]
+    found = layers.get(layer)
+    if not found:
+        raise ValueError(f'{gp_ob.name} has no layer {layer!r}')
+    return found
+
+
+def get_keyframe(layer, frame_number):
+    for frame in layer.frames:
+        if frame.frame_number == frame_number:
+            return frame
+    raise ValueError(f'Layer {layer.info!r} has no keyframe at frame {frame_number}')
+
+
+def check_stroke_refs(gp_ob, stroke_refs):
+    """
+    Raises ValueError for a reference to a missing layer, keyframe or stroke
+    before anything is rigged
+    """
+    for layer_ref, frame_number, stroke_index in stroke_refs:
+        frame = get_keyframe(get_layer(gp_ob, layer_ref), frame_number)
+        if not 0 <= stroke_index < len(frame.strokes):
+            raise ValueError(f'Keyframe {frame_number} of {layer_ref!r} has no stroke {stroke_index}')
+
+
+@contextmanager
+def rig_session(gp_ob, armature, settings=None):
+    """
+    Points the addon settings at gp_ob and armature, with the overrides of
+    settings ({gopo_prop_group property: value}), in object mode.
+    Restores the settings, the frame, the active object and its mode on exit
+    """
+    context = bpy.context
+    props = context.window_manager.gopo_prop_group
+    overrides = dict(settings or {}, gp_ob=gp_ob, ob_armature=armature)
+    saved = {name: getattr(props, name) for name in overrides}
+    active = context.view_layer.objects.active
+    mode = active.mode if active else 'OBJECT'
+    frame_current = context.scene.frame_current
+
+    if context.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    try:
+        for name, value in overrides.items():
+            setattr(props, name, value)
+        yield context
+    finally:
+        for name, value in saved.items():
+            setattr(props, name, value)
+        if context.mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode='OBJECT')
+        if context.scene.frame_current != frame_current:
+            context.scene.frame_set(frame_current)
+        context.view_layer.objects.active = active
+        if active and mode != 'OBJECT':
+            bpy.ops.object.mode_set(mode=mode)
+
+
+def rig_strokes(gp_ob, armature, stroke_refs, error_threshold=0.01, closed_threshold=0.03,
+                max_bones=0, settings=None):
+    """
+    Rigs the strokes given by (layer, frame_number, stroke_index) references,
+    layer being a name or an index and frame_number that of a keyframe.
+    max_bones caps the deform bones per stroke, 0 for no cap.  settings
+    overrides gopo_prop_group properties (num_bendy, ease_mode,
+    modifier_mode, weight_falloff...) for the call.
+    Returns a RiggedStroke per reference, in the order given
+    """
+    check_stroke_refs(gp_ob, stroke_refs)
+    results = [None] * len(stroke_refs)
+    # Rigging doesn't add or remove strokes: the indices stay valid and the
+    # strokes of a keyframe are rigged together, changing frame once
+    order = sorted(range(len(stroke_refs)), key=lambda idx: stroke_refs[idx][1])
+
+    with rig_session(gp_ob, armature, settings) as context:
+        gp_auxiliary_objects.assure_auxiliary_objects(context)
+        for idx in order:
+            layer_ref, frame_number, stroke_index = stroke_refs[idx]
+            layer = get_layer(gp_ob, layer_ref)
+            if context.scene.frame_current != frame_number:
+                context.scene.frame_set(frame_number)
+            start = time.perf_counter()
+            group_id, max_error = rig_stroke(context, gp_ob, armature, layer, stroke_index,
+                                             closed_threshold, error_threshold, max_bones)
+            results[idx] = RiggedStroke(layer.info, frame_number, stroke_index, group_id, max_error,
+                                        time.perf_counter() - start)
+    return results
+
+
+def bake_rigged_strokes(gp_ob, armature, group_ids, frame_init, frame_end, step=1,
+                        bake_to_new_layer=False, offline=False, to_point_cache=False, settings=None):
+    """
+    Bakes the rigged strokes of group_ids, from the keyframes displayed at
+    frame_init, and removes their rigs.  Returns the seconds it took
+    """
+    with rig_session(gp_ob, armature, settings) as context:
+        context.scene.frame_set(frame_init)
+        context.view_layer.objects.active = gp_ob
+        start = time.perf_counter()
+        bake_strokes(context, gp_ob, set(group_ids), frame_init, frame_end, step,
+                     bake_to_new_layer, offline, to_point_cache)
+        return time.perf_counter() - start
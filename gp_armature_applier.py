@@ -1,8 +1,27 @@
 import bpy
+import os
+import re
+import time
+from contextlib import ExitStack
 from bpy.props import FloatProperty
 from bpy.props import IntProperty
 from bpy.props import BoolProperty, PointerProperty, CollectionProperty, StringProperty
 from mathutils import Vector, Matrix
+from .gp_bone_registry import get_bone_registry, invalidate_bone_registry
+from .gp_profiling import span, operator_call, suspend_call, resumes_call
+from .gp_bbone_lod import full_resolution
+from .gp_bbone_eval import evaluate_stroke, unsupported_reason
+from .gp_point_cache import write_point_cache
+from .gp_stroke_kdtree import invalidate_stroke_kdtree
+
+# Seconds between the steps of a modal job and work done per step,
+# at least one unit of work is done per step
+JOB_INTERVAL = 0.01
+TIME_SLICE = 0.1
+# Events passed through during a modal job: viewport navigation only, anything
+# else could change the frame or edit the strokes the job refers to
+NAVIGATION_EVENTS = {'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE', 'WHEELUPMOUSE',
+                     'WHEELDOWNMOUSE', 'TRACKPADPAN', 'TRACKPADZOOM', 'NDOF_MOTION'}
 
 def can_remove_vg(gp_ob, vgroup):
     """
@@ -36,15 +55,94 @@ def remove_vertex_groups(gp_ob, group_id, remove_bonegroup=False, is_resampling=
 def get_def_vgroup(gp_ob, group_id):
     """
     Return the vertex group corresponding to the group_id 
-    (The vertex group that the armature modifier is applied to)
+    (The vertex group holding all the points of the rigged stroke)
+    """
+    for vgroup in gp_ob.vertex_groups:
+        if vgroup.bone_group and vgroup.bone_group == group_id and not vgroup.deform_group:
+            return vgroup
+
+
+def get_stroke_armature_mod(gp_ob, group_id):
+    """
+    Return the armature modifier restricted to the stroke of group_id, if any
     """
     for mod in gp_ob.grease_pencil_modifiers:
-        vgroup = gp_ob.vertex_groups[mod.vertex_group]
+        if mod.type != 'GP_ARMATURE' or not mod.vertex_group:
+            continue
+        vgroup = gp_ob.vertex_groups.get(mod.vertex_group)
 
-        if vgroup.bone_group and vgroup.bone_group == group_id:
-            return vgroup
+        if vgroup and vgroup.bone_group and vgroup.bone_group == group_id:
+            return mod
+
+
+def get_shared_armature_mod(gp_ob, armature):
+    """
+    Return the armature modifier shared by all the strokes rigged to armature
+    """
+    for mod in gp_ob.grease_pencil_modifiers:
+        if mod.type == 'GP_ARMATURE' and mod.object == armature and not mod.vertex_group:
+            return mod
+
+
+def has_stroke_armature_mods(gp_ob, armature):
+    """
+    Whether some stroke rigged to armature has its own armature modifier
+    """
+    return any(mod.type == 'GP_ARMATURE' and mod.object == armature and mod.vertex_group
+               for mod in gp_ob.grease_pencil_modifiers)
+
+
+def consolidate_armature_mods(gp_ob, armature):
+    """
+    Replaces the per-stroke armature modifiers of armature with a single
+    modifier that relies on the deform vertex groups alone.
+    Returns the shared modifier
+    """
+    for mod in list(gp_ob.grease_pencil_modifiers):
+        if mod.type != 'GP_ARMATURE' or mod.object != armature or not mod.vertex_group:
+            continue
+        vgroup = gp_ob.vertex_groups.get(mod.vertex_group)
+        if vgroup and vgroup.bone_group:
+            gp_ob.grease_pencil_modifiers.remove(mod)
+
+    mod = get_shared_armature_mod(gp_ob, armature)
+    if not mod:
+        mod = gp_ob.grease_pencil_modifiers.new(type='GP_ARMATURE', name=armature.name)
+        mod.object = armature
+    return mod
 
             
+bone_path = re.compile(r'pose\.bones\["(.+?)"\]')
+
+
+def driver_bone_name(fcurve):
+    """
+    Name of the pose bone driven by fcurve, None if it drives something else
+    """
+    match = bone_path.match(fcurve.data_path)
+    return match.group(1) if match else None
+
+
+def set_rig_muted(gp_ob, armature, group_id, muted):
+    """
+    Mutes the per-stroke armature modifier, constraints and drivers of group_id.
+    With a shared modifier the stroke keeps deforming, only the bones stop evaluating
+    """
+    mod = get_stroke_armature_mod(gp_ob, group_id)
+    if mod:
+        mod.show_viewport = not muted
+
+    names = set(get_bone_registry(armature).names('ALL', group_id))
+    for name in names:
+        for constraint in armature.pose.bones[name].constraints:
+            constraint.mute = muted
+
+    if armature.animation_data:
+        for fcurve in armature.animation_data.drivers:
+            if driver_bone_name(fcurve) in names:
+                fcurve.mute = muted
+
+
 def are_we_removing_bonegroup(context, group_id):
     """
     Check if there are still strokes affected by this modifier
@@ -75,12 +173,22 @@ def remove_armature_mod(gp_ob, group_id):
     """
     Remove armature modifier from a grease pencil object, pertaining
     a bonegroup if it doesn't affect more strokes.
+    Shared modifiers are removed once no deform vertex group is left for their armature.
     Returns True if it removes the modifier
     """
-    for mod in gp_ob.grease_pencil_modifiers:
-        vgroup = gp_ob.vertex_groups[mod.vertex_group]
+    invalidate_stroke_kdtree(gp_ob, group_id)
+    mod = get_stroke_armature_mod(gp_ob, group_id)
+    if mod:
+        gp_ob.grease_pencil_modifiers.remove(mod)
+        return True
 
-        if vgroup.bone_group and vgroup.bone_group == group_id:
+    for mod in gp_ob.grease_pencil_modifiers:
+        if mod.type != 'GP_ARMATURE' or mod.vertex_group or not mod.object:
+            continue
+        bones = mod.object.data.bones
+        still_used = any(vgroup.deform_group and vgroup.bone_group != group_id and vgroup.name in bones
+                         for vgroup in gp_ob.vertex_groups)
+        if not still_used:
             gp_ob.grease_pencil_modifiers.remove(mod)
             return True
 
@@ -156,14 +264,14 @@ def clean_animation_data(context, action_groups):
     once the corresponding bones have been deleted.
     """
     armature = context.window_manager.gopo_prop_group.ob_armature
-    action = armature.animation_data.action
+    action = armature.animation_data.action if armature.animation_data else None
 
     if not action:
         return
     
     curves_to_remove = []
     for curve in action.fcurves:
-        if curve.group.name in action_groups:
+        if curve.group and curve.group.name in action_groups:
             curves_to_remove.append(curve)
 
     for curve in curves_to_remove:
@@ -192,12 +300,265 @@ def clean_bones(context,group_id):
             
 
     bpy.ops.object.mode_set(mode='OBJECT', toggle=False)
+    invalidate_bone_registry(armature)
     context.view_layer.objects.active = act_ob
-    bpy.ops.object.mode_set(mode=curr_mode)
+    if act_ob:
+        bpy.ops.object.mode_set(mode=curr_mode)
     return groups_names
     
                     
 
+def get_bake_groups(context):
+    """
+    Bone groups to bake: those of the selected bones when posing, leaving
+    pose mode for the grease pencil object, or those of the selected strokes
+    """
+    if context.mode =='POSE':
+        bone_groups = set()
+        for pbone in context.selected_pose_bones:
+            bone_groups.add(pbone.bone.rigged_stroke)
+        bpy.ops.object.mode_set(mode='OBJECT')
+        gp_ob = context.window_manager.gopo_prop_group.gp_ob
+        gp_ob.select_set(True)
+        context.view_layer.objects.active = gp_ob
+        return bone_groups
+    return get_target_strokes(context)
+
+
+def find_group_stroke(layer, group_id):
+    """
+    Index and stroke of the bone group in the active frame of layer,
+    (None, None) if it isn't there
+    """
+    stroke_idx, stroke = None, None
+    for idx, st in enumerate(layer.active_frame.strokes):
+        if st.bone_groups == group_id:
+            stroke_idx, stroke = idx, st
+    return stroke_idx, stroke
+
+
+def evaluate_scene(scene, gp_obeval, layer_name, stroke_idx, frames):
+    """
+    Baked points, {frame: [(co, strength, pressure, vertex_color)]},
+    read from the evaluated object, stepping the scene
+    """
+    baked_points = dict()
+    for fr in frames:
+        scene.frame_set(fr)
+
+        evald_stroke = gp_obeval.data.layers[layer_name].active_frame.strokes[stroke_idx]
+
+        pts_eval = list((pt.co.copy(), pt.strength, pt.pressure, pt.vertex_color) for pt in evald_stroke.points)
+
+        baked_points[fr] = pts_eval
+    return baked_points
+
+
+def evaluate_offline(gp_ob, armature, stroke, group_id, frames):
+    """
+    Baked points of every frame computed by the offline evaluator,
+    None if it can't evaluate the stroke
+    """
+    deformed = evaluate_stroke(gp_ob, armature, stroke, group_id, frames)
+    if deformed is None:
+        return None
+    attributes = [(pt.strength, pt.pressure, tuple(pt.vertex_color)) for pt in stroke.points]
+    return {fr: [(tuple(co), *attrs) for co, attrs in zip(frame_co.tolist(), attributes)]
+            for fr, frame_co in zip(frames, deformed)}
+
+
+def report_offline_fallbacks(operator, gp_ob, armature, group_ids):
+    """
+    Warns about the rigs an offline bake evaluates stepping the scene
+    """
+    if not armature:
+        reasons = ['there is no armature'] * len(group_ids)
+    else:
+        reasons = [reason for reason in (unsupported_reason(gp_ob, armature, group_id)
+                                         for group_id in sorted(group_ids)) if reason]
+    if reasons:
+        operator.report({'WARNING'}, f'{len(reasons)} rigs baked stepping the scene, '
+                        f"the offline evaluator can't reproduce them: {reasons[0]}")
+
+
+def write_baked_points(stroke, target_layer, baked_points):
+    """
+    Creates a frame and a stroke in target_layer for every baked frame
+    """
+    material_index = stroke.material_index
+    line_width = stroke.line_width
+    vertex_color_fill = stroke.vertex_color_fill
+
+    # now create frames and strokes, without stepping the scene
+    frames = {frame.frame_number: frame for frame in target_layer.frames}
+    for fr in sorted(baked_points):
+        n_points = len(stroke.points)
+
+        frame = frames.get(fr)
+        if frame is None:
+            frame = target_layer.frames.new(fr, active=True)
+            
+        new_stroke = frame.strokes.new()
+        new_stroke.points.add(n_points)
+        new_stroke.line_width = line_width
+        new_stroke.material_index = material_index
+        new_stroke.vertex_color_fill = vertex_color_fill
+        
+        # TODO: Change this to for_each_set
+        for gp_pt, pt in zip(new_stroke.points, baked_points[fr]):
+            coords, strength, pressure, v_color = pt
+            gp_pt.co = coords
+            gp_pt.strength = strength
+            gp_pt.pressure = pressure
+            gp_pt.vertex_color = v_color
+
+
+def bake_stroke(context, gp_ob, gp_obeval, source_layer, target_layer, group_id, frames,
+                offline=False, to_point_cache=False):
+    """
+    Bakes the stroke of group_id in the active frame of source_layer
+    """
+    stroke_idx, stroke = find_group_stroke(source_layer, group_id)
+    if not stroke:
+        return         
+
+    # First get the points.
+    baked_points = None
+    
+    with span('bake_evaluate'):
+        if offline:
+            armature = context.window_manager.gopo_prop_group.ob_armature
+            baked_points = evaluate_offline(gp_ob, armature, stroke, group_id, frames)
+        if not baked_points:
+            baked_points = evaluate_scene(context.scene, gp_obeval, source_layer.info, stroke_idx, frames)
+
+    with span('bake_write'):
+        store_baked_points(context.window_manager.gopo_prop_group, gp_ob, stroke, source_layer,
+                           target_layer, group_id, baked_points, to_point_cache)
+
+
+def bake_strokes(context, gp_ob, bone_groups, frame_init, frame_end, step=1,
+                 bake_to_new_layer=False, offline=False, to_point_cache=False):
+    """
+    Bakes the strokes of bone_groups in the unlocked layers of gp_ob and
+    removes their rigs.  Needs no screen, usable in background mode
+    """
+    depsgraph = context.evaluated_depsgraph_get()
+    gp_obeval = gp_ob.evaluated_get(depsgraph)
+    frames = list(range(frame_init, frame_end + 1, step))
+
+    layers = [layer for layer in gp_ob.data.layers if not layer.lock]
+    for layer in layers:
+        gp_ob.data.layers.active = layer 
+    
+        if bake_to_new_layer:
+            new_layer = gp_ob.data.layers.new('baked_' + layer.info , set_active=False)
+        else:
+            new_layer = gp_ob.data.layers.active 
+
+        with full_resolution():
+            for group_id in bone_groups:
+                bake_stroke(context, gp_ob, gp_obeval, layer, new_layer, group_id, frames,
+                            offline, to_point_cache)
+
+    clean_baked_groups(context, layers, bone_groups, frame_init, frame_end)
+
+
+def store_baked_points(props, gp_ob, stroke, source_layer, target_layer, group_id, baked_points, to_point_cache):
+    """
+    Writes the baked points as keyframes of target_layer or to a point cache
+    """
+    if to_point_cache:
+        directory = os.path.join(props.point_cache_dir, f'{gp_ob.name}_{source_layer.info}_{group_id}')
+        write_point_cache(gp_ob, stroke, group_id, baked_points, directory,
+                          props.point_cache_encoding, props.point_cache_precision)
+    else:
+        write_baked_points(stroke, target_layer, baked_points)
+
+
+def begin_modal_job(operator, context, total):
+    """
+    Runs operator as a modal job of total units of work, stepped by a timer.
+    The profiling call of the operator stays open until end_modal_job, timing
+    only the steps of a modal method decorated with resumes_call
+    """
+    operator._call = ExitStack()
+    operator._profile = operator._call.enter_context(operator_call(operator.bl_idname))
+    suspend_call(operator._profile)
+    wm = context.window_manager
+    operator._timer = wm.event_timer_add(JOB_INTERVAL, window=context.window)
+    wm.progress_begin(0, total)
+    wm.modal_handler_add(operator)
+
+
+def run_job_slice(work, pending):
+    """
+    Calls work while pending() for up to TIME_SLICE seconds, at least once
+    """
+    start = time.perf_counter()
+    work()
+    while pending() and time.perf_counter() - start < TIME_SLICE:
+        work()
+
+
+def job_event_result(event):
+    """
+    Modal result for the events other than the timer during a job
+    """
+    return {'PASS_THROUGH'} if event.type in NAVIGATION_EVENTS else {'RUNNING_MODAL'}
+
+
+def update_modal_job(context, label, done, total):
+    context.window_manager.progress_update(done)
+    context.workspace.status_text_set(f'{label} {done}/{total}, Esc to cancel')
+
+
+def end_modal_job(operator, context):
+    wm = context.window_manager
+    wm.event_timer_remove(operator._timer)
+    wm.progress_end()
+    context.workspace.status_text_set(None)
+    operator._call.close()
+
+
+def clean_baked(context, group_id, init_frame, end_frame, layer_name):
+    """
+    Removes the weights of the baked strokes of group_id in layer_name and,
+    once no stroke uses them, its vertex groups, modifier and bones
+    """
+    with span('clean_strokes'):
+        clean_strokes(context,
+                      group_id,
+                      init_frame,
+                      end_frame,
+                      layer_name=layer_name)
+
+    remove_bone_group = are_we_removing_bonegroup(context, group_id)
+    
+    with span('clean_gp_object'):
+        clean_gp_object(context,
+                        group_id,
+                        init_frame,
+                        end_frame,
+                        remove_bone_group)
+    if remove_bone_group:
+        invalidate_stroke_kdtree(context.window_manager.gopo_prop_group.gp_ob, group_id)
+        with span('clean_bones'):
+            action_groups = clean_bones(context, group_id)
+        with span('clean_animation'):
+            clean_animation_data(context, action_groups)
+
+
+def clean_baked_groups(context, layers, bone_groups, init_frame, end_frame):
+    """
+    Removes the rigs of the baked bone groups
+    """
+    for layer in layers:
+        for group_id in bone_groups:
+            with span('clean'):
+                clean_baked(context, group_id, init_frame, end_frame, layer.info)
+
+
 class GOMEZ_OT_clean_baked(bpy.types.Operator):
     """
     Cleans vertex groups and bones from baked strokes
@@ -229,6 +590,10 @@ class GOMEZ_OT_clean_baked(bpy.types.Operator):
 
     
     def execute(self, context):
+        with operator_call(self.bl_idname):
+            return self.run(context)
+
+    def run(self, context):
         if not (self.group_id and self.init_frame and self.end_frame):
             return {'CANCELLED'}
 
@@ -237,22 +602,7 @@ class GOMEZ_OT_clean_baked(bpy.types.Operator):
         else:
             layer_name = self.layer_name
                 
-        clean_strokes(context,
-                      self.group_id,
-                      self.init_frame,
-                      self.end_frame,
-                      layer_name=layer_name)
-
-        remove_bone_group = are_we_removing_bonegroup(context, self.group_id)
-        
-        clean_gp_object(context,
-                        self.group_id,
-                        self.init_frame,
-                        self.end_frame,
-                        remove_bone_group)
-        if remove_bone_group:
-            action_groups = clean_bones(context, self.group_id)
-            clean_animation_data(context, action_groups)
+        clean_baked(context, self.group_id, self.init_frame, self.end_frame, layer_name)
         return {'FINISHED'}
 
     @classmethod
@@ -293,64 +643,17 @@ class GOMEZ_OT_bake_animation(bpy.types.Operator):
     split : BoolProperty(name='split',
                          description='Split the stroke between a baked and a rigged part',
                          default=False)
+
+    to_point_cache : BoolProperty(name='to_point_cache',
+                                  description='Bake to an on-disk point cache instead of keyframes',
+                                  default=False)
+
+    offline : BoolProperty(name='offline',
+                           description='Evaluate the rig from the control bones animation instead of stepping the scene',
+                           default=False)
     
     
     
-    def bake_stroke(self, context, gp_ob, gp_obeval, source_layer, target_layer, group_id):
-        inf = self.frame_init
-        outf = self.frame_end
-        step = self.step
-        
-        stroke = None
-        for idx,st in enumerate(source_layer.active_frame.strokes):
-            if st.bone_groups == group_id:
-                stroke_idx = idx
-                stroke = st
-
-        if not stroke:
-            return         
-
-        material_index = stroke.material_index
-        line_width = stroke.line_width
-        vertex_color_fill = stroke.vertex_color_fill
-        # First get the points.
-        baked_points = dict()
-        
-        for fr in range(inf, outf+1, step):
-            context.scene.frame_set(fr)
-
-            evald_stroke = gp_obeval.data.layers[source_layer.info].active_frame.strokes[stroke_idx]
-
-            pts_eval = list((pt.co.copy(), pt.strength, pt.pressure, pt.vertex_color) for pt in evald_stroke.points)
-
-            baked_points[fr] = pts_eval
-
-        # now create frames and strokes
-        for fr in range(inf, outf+1, step):
-            context.scene.frame_set(fr)
-            
-            n_points = len(stroke.points)
-
-            if target_layer.active_frame and target_layer.active_frame.frame_number == fr:
-                frame = target_layer.active_frame
-            else:
-                frame = target_layer.frames.new(fr, active=True)
-                
-            new_stroke = frame.strokes.new()
-            new_stroke.points.add(n_points)
-            new_stroke.line_width = line_width
-            new_stroke.material_index = material_index
-            new_stroke.vertex_color_fill = vertex_color_fill
-            
-            # TODO: Change this to for_each_set
-            for gp_pt, pt in zip(new_stroke.points, baked_points[fr]):
-                coords, strength, pressure, v_color = pt
-                gp_pt.co = coords
-                gp_pt.strength = strength
-                gp_pt.pressure = pressure
-                gp_pt.vertex_color = v_color
-                
-
     def invoke(self, context, event):
         props = context.window_manager.gopo_prop_group
 
@@ -363,50 +666,153 @@ class GOMEZ_OT_bake_animation(bpy.types.Operator):
             self.frame_end =  props.frame_end
         self.step = props.bake_step
         self.bake_to_new_layer = props.bake_to_new_layer
+        self.offline = props.bake_offline
+        self.to_point_cache = props.bake_to_point_cache
 
-        return self.execute(context)
+        if not context.window:
+            return self.execute(context)
+        return self.start(context)
 
 
     def execute(self, context):
-        if context.mode =='POSE':
-            bone_groups = set()
-            for pbone in context.selected_pose_bones:
-                bone_groups.add(pbone.bone.rigged_stroke)
-            bpy.ops.object.mode_set(mode='OBJECT')
-            gp_ob = context.window_manager.gopo_prop_group.gp_ob
-            gp_ob.select_set(True)
-            context.view_layer.objects.active = gp_ob
-        else:
-            bone_groups = get_target_strokes(context)
-        gp_ob = context.object
-        depsgraph = context.evaluated_depsgraph_get()
-        gp_obeval = gp_ob.evaluated_get(depsgraph)
-
-        layers = [layer for layer in gp_ob.data.layers if not layer.lock]
-        for layer in layers:
-            gp_ob.data.layers.active = layer 
-            kf_frame_number = layer.active_frame.frame_number
+        with operator_call(self.bl_idname):
+            return self.run(context)
 
-            if kf_frame_number < self.frame_init:
-                self.split = True
-        
-            if self.bake_to_new_layer:
-                new_layer = gp_ob.data.layers.new('baked_' + layer.info , set_active=False)
-            else:
-                new_layer = gp_ob.data.layers.active 
+    def can_bake(self, context):
+        props = context.window_manager.gopo_prop_group
+        if self.to_point_cache and props.point_cache_dir.startswith('//') and not bpy.data.filepath:
+            self.report({'ERROR'}, 'Save the file before baking to a relative point cache directory')
+            return False
+        return True
 
-            for group_id in bone_groups:
-                self.bake_stroke(context, gp_ob, gp_obeval,layer, new_layer,  group_id)
+    def run(self, context):
+        if not self.can_bake(context):
+            return {'CANCELLED'}
 
-        for layer in layers:
-            for group_id in bone_groups:
-                bpy.ops.greasepencil.gp_clean_baked(group_id=group_id,
-                                                    init_frame=self.frame_init,
-                                                    end_frame=self.frame_end,
-                                                    layer_name = layer.info)
+        bone_groups = get_bake_groups(context)
+        gp_ob = context.object
+        self.split = any(layer.active_frame.frame_number < self.frame_init
+                         for layer in gp_ob.data.layers if not layer.lock)
+        if self.offline:
+            report_offline_fallbacks(self, gp_ob, context.window_manager.gopo_prop_group.ob_armature,
+                                     bone_groups)
+        bake_strokes(context, gp_ob, bone_groups, self.frame_init, self.frame_end, self.step,
+                     self.bake_to_new_layer, self.offline, self.to_point_cache)
+        return {'FINISHED'}
 
+    def start(self, context):
+        """
+        Bakes as a modal job: the points of the strokes are evaluated a few
+        frames per step and written once all of them are, so cancelling
+        leaves the data untouched
+        """
+        if not self.can_bake(context):
+            return {'CANCELLED'}
+        self._bone_groups = get_bake_groups(context)
+        gp_ob = context.object
+        self._gp_ob_name = gp_ob.name
+        self._frames = list(range(self.frame_init, self.frame_end + 1, self.step))
+        self._frame_current = context.scene.frame_current
+        self._layers = [layer.info for layer in gp_ob.data.layers if not layer.lock]
+        # [layer name, group id, stroke index, baked points] of every stroke to bake
+        self._tasks = []
+        for layer in gp_ob.data.layers:
+            if layer.lock:
+                continue
+            for group_id in self._bone_groups:
+                stroke_idx, stroke = find_group_stroke(layer, group_id)
+                if stroke:
+                    self._tasks.append([layer.info, group_id, stroke_idx, None])
+        if not (self._tasks and self._frames):
+            return {'CANCELLED'}
+        if self.offline:
+            report_offline_fallbacks(self, gp_ob, context.window_manager.gopo_prop_group.ob_armature,
+                                     self._bone_groups)
+        self._task = 0
+        self._frame = 0
+
+        self._resolution = ExitStack()
+        self._resolution.enter_context(full_resolution())
+        begin_modal_job(self, context, len(self._tasks) * len(self._frames))
+        return {'RUNNING_MODAL'}
+
+    def bake_next(self, context):
+        """
+        Evaluates the next frame of the current stroke, or the whole stroke offline
+        """
+        layer_name, group_id, stroke_idx, baked_points = self._tasks[self._task]
+        gp_ob = bpy.data.objects[self._gp_ob_name]
+        if baked_points is None:
+            baked_points = self._tasks[self._task][3] = {}
+            if self.offline:
+                # The stroke index refers to the keyframes displayed when the bake started
+                if context.scene.frame_current != self._frame_current:
+                    context.scene.frame_set(self._frame_current)
+                stroke = gp_ob.data.layers[layer_name].active_frame.strokes[stroke_idx]
+                armature = context.window_manager.gopo_prop_group.ob_armature
+                offline_points = evaluate_offline(gp_ob, armature, stroke, group_id, self._frames)
+                if offline_points:
+                    baked_points.update(offline_points)
+                    self._task += 1
+                    return
+
+        gp_obeval = gp_ob.evaluated_get(context.evaluated_depsgraph_get())
+        baked_points.update(evaluate_scene(context.scene, gp_obeval, layer_name, stroke_idx,
+                                           self._frames[self._frame:self._frame + 1]))
+        self._frame += 1
+        if self._frame == len(self._frames):
+            self._task += 1
+            self._frame = 0
+
+    @resumes_call
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.restore(context)
+            end_modal_job(self, context)
+            self.report({'WARNING'}, 'Bake cancelled')
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return job_event_result(event)
+
+        with span('bake_evaluate'):
+            run_job_slice(lambda: self.bake_next(context), lambda: self._task < len(self._tasks))
+        update_modal_job(context, 'Baking frame', self._task * len(self._frames) + self._frame,
+                         len(self._tasks) * len(self._frames))
+        if self._task < len(self._tasks):
+            return {'RUNNING_MODAL'}
+
+        # Back to the keyframes the stroke indices refer to before writing
+        self.restore(context)
+        self.write(context)
+        end_modal_job(self, context)
         return {'FINISHED'}
 
+    def write(self, context):
+        """
+        Writes the baked strokes and removes their rigs
+        """
+        props = context.window_manager.gopo_prop_group
+        gp_ob = bpy.data.objects[self._gp_ob_name]
+        layers = [gp_ob.data.layers[name] for name in self._layers]
+        targets = {layer.info: (gp_ob.data.layers.new('baked_' + layer.info, set_active=False)
+                                if self.bake_to_new_layer else layer)
+                   for layer in layers}
+        with span('bake_write'):
+            for layer_name, group_id, stroke_idx, baked_points in self._tasks:
+                layer = gp_ob.data.layers[layer_name]
+                strokes = layer.active_frame.strokes
+                if stroke_idx >= len(strokes) or strokes[stroke_idx].bone_groups != group_id:
+                    self.report({'WARNING'}, f'Stroke of bone group {group_id} changed while baking, skipped')
+                    continue
+                stroke = strokes[stroke_idx]
+                store_baked_points(props, gp_ob, stroke, layer, targets[layer_name], group_id,
+                                   baked_points, self.to_point_cache)
+        clean_baked_groups(context, layers, self._bone_groups, self.frame_init, self.frame_end)
+
+    def restore(self, context):
+        self._resolution.close()
+        context.scene.frame_set(self._frame_current)
+
 
     @classmethod
     def poll(cls, context):
@@ -426,6 +832,26 @@ class GOMEZ_OT_bake_animation(bpy.types.Operator):
         return False
 
 
+class GOMEZ_OT_consolidate_armature_mods(bpy.types.Operator):
+    """
+    Replace the per-stroke armature modifiers with one modifier per armature
+    """
+    bl_idname = "greasepencil.consolidate_armature_mods"
+    bl_label = "Consolidate armature modifiers"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute(self, context):
+        prop_group = context.window_manager.gopo_prop_group
+        consolidate_armature_mods(prop_group.gp_ob, prop_group.ob_armature)
+        prop_group.modifier_mode = 'SHARED'
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        prop_group = context.window_manager.gopo_prop_group
+        return prop_group.gp_ob and prop_group.ob_armature
+
+
     
 class GOMEZ_OT_select_all_stroke_ctrls(bpy.types.Operator):
     bl_idname = 'armature.select_all_ctrls'
@@ -434,11 +860,13 @@ class GOMEZ_OT_select_all_stroke_ctrls(bpy.types.Operator):
 
     def execute(self, context):
         armature = context.object
-        indices = [bone.rigged_stroke for bone in armature.data.bones if bone.select]
+        registry = get_bone_registry(armature)
+        indices = {pbone.bone.rigged_stroke for pbone in context.selected_pose_bones}
 
-        for bone in armature.data.bones:
-            if bone.poser_control and bone.rigged_stroke in indices:
-                bone.select = True
+        bones = armature.data.bones
+        for index in indices:
+            for name in registry.names('CTRL', index):
+                bones[name].select = True
         return {'FINISHED'}
     
     @classmethod
@@ -454,16 +882,13 @@ class GOMEZ_OT_select_bonegroup(bpy.types.Operator):
 
     def execute(self, context):
         armature = context.object
-        indices = [bone.rigged_stroke for bone in armature.data.bones if bone.select]
+        registry = get_bone_registry(armature)
+        indices = {pbone.bone.rigged_stroke for pbone in context.selected_pose_bones}
 
-        for bone in armature.data.bones:
-            poser_bone = any(bone.poser_control,
-                             bone.poser_handle,
-                             bone.poser_root,
-                             bone.poser_deform)
-            
-            if poser_bone and bone.rigged_stroke in indices:
-                bone.select = True
+        bones = armature.data.bones
+        for index in indices:
+            for name in registry.names('ALL', index):
+                bones[name].select = True
         return {'FINISHED'}
     
     @classmethod
@@ -481,6 +906,7 @@ def register():
     bpy.utils.register_class(GOMEZ_OT_clean_baked)
     bpy.utils.register_class(GOMEZ_OT_select_all_stroke_ctrls)
     bpy.utils.register_class(GOMEZ_OT_select_bonegroup)
+    bpy.utils.register_class(GOMEZ_OT_consolidate_armature_mods)
     
 
 def unregister():
@@ -488,6 +914,7 @@ def unregister():
     bpy.utils.unregister_class(GOMEZ_OT_clean_baked)
     bpy.utils.unregister_class(GOMEZ_OT_select_all_stroke_ctrls)
     bpy.utils.unregister_class(GOMEZ_OT_select_bonegroup)
+    bpy.utils.unregister_class(GOMEZ_OT_consolidate_armature_mods)
 
         
     
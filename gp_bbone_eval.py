@@ -0,0 +1,454 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Evaluates the deformation of a rigged stroke for a range of frames
+# straight from the animation of its control bones, without stepping the scene.
+# The animation is sampled for all the frames at once by gp_fcurve_sampler.
+#
+# The rig built by gp_rigging_ops is rebuilt here: every deform bone goes from
+# its control to the next one (copy location + stretch to), its bezier handles
+# point to the handle bones (absolute custom handles) and its ease grows with the
+# distance to them (ease drivers).  The bendy segments follow Blender's b-bone
+# code, in armature space and without the volume preservation of stretched bones,
+# so the result is close to, but not exactly, what the armature modifier gives.
+# Rigs the evaluator can't reproduce (animated object transforms, axis angle
+# rotations or constraints in the control bones, scale inheritance other than
+# full or none) give None, and the caller steps the scene instead.
+
+import numpy as np
+from .gp_bone_registry import get_bone_registry
+from .gp_fcurve_sampler import sample_bones
+
+# Blender scales the bbone handles by ease * length * this factor
+BBONE_HANDLE_SCALE = 0.390464
+# Samples per segment used to place the segments at equal arc lengths
+EQUALIZE_SUBDIV = 16
+# Scale inheritance modes reproduced by pose_matrices
+INHERIT_SCALE_MODES = ('FULL', 'NONE')
+# Object channels that move the gp object or the armature
+OBJECT_TRANSFORMS = ('location', 'rotation_euler', 'rotation_quaternion', 'rotation_axis_angle', 'scale',
+                     'delta_location', 'delta_rotation_euler', 'delta_rotation_quaternion', 'delta_scale')
+
+
+def quaternion_matrices(quats):
+    """
+    (n, 3, 3) rotation matrices of (n, 4) w, x, y, z quaternions
+    """
+    quats = quats / np.linalg.norm(quats, axis=1, keepdims=True)
+    w, x, y, z = quats.T
+    return np.stack([
+        np.stack([1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)], axis=1),
+        np.stack([2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)], axis=1),
+        np.stack([2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)], axis=1)], axis=1)
+
+
+def euler_matrices(eulers, order):
+    """
+    (n, 3, 3) rotation matrices of (n, 3) euler angles in Blender's order
+    """
+    n = len(eulers)
+    matrices = np.broadcast_to(np.eye(3), (n, 3, 3)).copy()
+    for axis in order:
+        idx = 'XYZ'.index(axis)
+        cos, sin = np.cos(eulers[:, idx]), np.sin(eulers[:, idx])
+        rot = np.broadcast_to(np.eye(3), (n, 3, 3)).copy()
+        a, b = [i for i in range(3) if i != idx]
+        rot[:, a, a] = cos
+        rot[:, b, b] = cos
+        sign = 1.0 if idx == 1 else -1.0
+        rot[:, a, b] = sign * sin
+        rot[:, b, a] = -sign * sin
+        # The first axis in the order is applied first
+        matrices = rot @ matrices
+    return matrices
+
+
+def basis_matrices(armature, pbone, frames):
+    """
+    (n_frames, 4, 4) local transforms of a pose bone from its fcurves.
+    Axis angle rotations aren't sampled: check bone_unsupported first
+    """
+    values = sample_bones(armature, [pbone.name], frames)[pbone.name]
+    n = len(frames)
+
+    if pbone.rotation_mode == 'QUATERNION':
+        rotation = quaternion_matrices(values['rotation_quaternion'])
+    else:
+        rotation = euler_matrices(values['rotation_euler'], pbone.rotation_mode)
+
+    matrices = np.broadcast_to(np.eye(4), (n, 4, 4)).copy()
+    matrices[:, :3, :3] = rotation * values['scale'][:, None, :]
+    matrices[:, :3, 3] = values['location']
+    return matrices
+
+
+def bone_unsupported(pbone):
+    """
+    Why the pose of pbone can't be evaluated offline, None if it can
+    """
+    if pbone.rotation_mode == 'AXIS_ANGLE':
+        return f'{pbone.name} has an axis angle rotation'
+    if any(not constraint.mute for constraint in pbone.constraints):
+        return f'{pbone.name} has constraints'
+    if pbone.parent:
+        if pbone.bone.inherit_scale not in INHERIT_SCALE_MODES:
+            return f'{pbone.name} inherits the scale in {pbone.bone.inherit_scale} mode'
+        if not pbone.bone.use_inherit_rotation:
+            return f"{pbone.name} doesn't inherit the rotation"
+    return None
+
+
+def transform_animated(ob):
+    """
+    Whether ob, or one of its parents, moves by animation, drivers or constraints
+    """
+    while ob:
+        anim = ob.animation_data
+        if anim:
+            fcurves = list(anim.drivers) + (list(anim.action.fcurves) if anim.action else [])
+            if any(fcurve.data_path in OBJECT_TRANSFORMS for fcurve in fcurves):
+                return True
+        if any(not constraint.mute for constraint in ob.constraints):
+            return True
+        ob = ob.parent
+    return False
+
+
+def unsupported_reason(gp_ob, armature, group_id):
+    """
+    Why the rig of group_id can't be evaluated offline, None if it can
+    """
+    for ob in (gp_ob, armature):
+        if transform_animated(ob):
+            return f'{ob.name} has animated transforms'
+    pbones = armature.pose.bones
+    for (role, order), name in stroke_chain(armature, group_id).items():
+        if role == 'DEFORM':
+            continue
+        pbone = pbones[name]
+        while pbone:
+            reason = bone_unsupported(pbone)
+            if reason:
+                return reason
+            pbone = pbone.parent
+    return None
+
+
+def pose_matrices(armature, names, frames):
+    """
+    Armature space pose matrices, (n_frames, 4, 4) by bone name, of the bones
+    in names and their parents.  None if bone_unsupported finds one of them
+    """
+    matrices = {}
+
+    def pose_matrix(pbone):
+        if pbone.name in matrices:
+            return matrices[pbone.name]
+        if bone_unsupported(pbone):
+            return None
+        basis = basis_matrices(armature, pbone, frames)
+        rest = np.asarray(pbone.bone.matrix_local, dtype=float)
+        if not pbone.parent:
+            matrices[pbone.name] = rest @ basis
+            return matrices[pbone.name]
+
+        parent = pose_matrix(pbone.parent)
+        if parent is None:
+            return None
+        offset = np.linalg.inv(np.asarray(pbone.parent.bone.matrix_local, dtype=float)) @ rest
+        matrix = parent @ offset @ basis
+        if pbone.bone.inherit_scale == 'NONE':
+            # Blender drops the scale of the parent from the rotation and scale of
+            # the child, its location still follows the scaled parent
+            unscaled = parent.copy()
+            unscaled[:, :3, :3] /= np.linalg.norm(parent[:, :3, :3], axis=-2, keepdims=True)
+            location = matrix[:, :3, 3]
+            matrix = unscaled @ offset @ basis
+            matrix[:, :3, 3] = location
+        matrices[pbone.name] = matrix
+        return matrix
+
+    for name in names:
+        if pose_matrix(armature.pose.bones[name]) is None:
+            return None
+    return matrices
+
+
+def normalized(vecs):
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return np.divide(vecs, norms, out=np.zeros_like(vecs), where=norms > 0.0)
+
+
+def y_to_vec(vecs):
+    """
+    Rotations taking the Y axis to the unit vectors vecs, as
+    Blender's vec_roll_to_mat3 with no roll
+    """
+    x, y, z = vecs[..., 0], vecs[..., 1], vecs[..., 2]
+    theta = 1.0 + y
+    # Vectors pointing down Y are turned around Z
+    safe = theta > 1.0e-5
+    theta = np.where(safe, theta, 1.0)
+    matrices = np.empty(vecs.shape[:-1] + (3, 3))
+    matrices[..., 0, 0] = np.where(safe, 1.0 - x*x/theta, -1.0)
+    matrices[..., 1, 0] = np.where(safe, -x, 0.0)
+    matrices[..., 2, 0] = np.where(safe, -x*z/theta, 0.0)
+    matrices[..., 0, 1] = np.where(safe, x, 0.0)
+    matrices[..., 1, 1] = np.where(safe, y, -1.0)
+    matrices[..., 2, 1] = np.where(safe, z, 0.0)
+    matrices[..., 0, 2] = np.where(safe, -x*z/theta, 0.0)
+    matrices[..., 1, 2] = np.where(safe, -z, 0.0)
+    matrices[..., 2, 2] = np.where(safe, 1.0 - z*z/theta, 1.0)
+    return matrices
+
+
+def swing(from_dirs, to_dirs):
+    """
+    Shortest rotations taking the unit vectors from_dirs to to_dirs
+    """
+    axis = np.cross(from_dirs, to_dirs)
+    cos = np.einsum('...i,...i->...', from_dirs, to_dirs)
+    skew = np.zeros(axis.shape[:-1] + (3, 3))
+    skew[..., 0, 1], skew[..., 0, 2] = -axis[..., 2], axis[..., 1]
+    skew[..., 1, 0], skew[..., 1, 2] = axis[..., 2], -axis[..., 0]
+    skew[..., 2, 0], skew[..., 2, 1] = -axis[..., 1], axis[..., 0]
+    factor = 1.0 / np.maximum(1.0 + cos, 1.0e-8)
+    return np.eye(3) + skew + skew @ skew * factor[..., None, None]
+
+
+def bezier_segments(p0, p1, p2, p3, segments):
+    """
+    Points and unit tangents at the segments + 1 boundaries of the segments of
+    a cubic bezier, placed at equal arc lengths.  Control points are (..., 3)
+    """
+    p0, p1, p2, p3 = (np.asarray(p, dtype=float)[..., None, :] for p in (p0, p1, p2, p3))
+
+    def point(t):
+        mt = 1.0 - t
+        return mt**3*p0 + 3*mt**2*t*p1 + 3*mt*t**2*p2 + t**3*p3
+
+    def tangent(t):
+        mt = 1.0 - t
+        return 3*mt**2*(p1 - p0) + 6*mt*t*(p2 - p1) + 3*t**2*(p3 - p2)
+
+    t_dense = np.linspace(0.0, 1.0, EQUALIZE_SUBDIV * segments + 1)[:, None]
+    lengths = np.linalg.norm(np.diff(point(t_dense), axis=-2), axis=-1)
+    cumulative = np.concatenate([np.zeros(lengths.shape[:-1] + (1,)), np.cumsum(lengths, axis=-1)], axis=-1)
+    total = np.maximum(cumulative[..., -1:], 1.0e-12)
+    targets = np.linspace(0.0, 1.0, segments + 1) * total
+
+    # Interpolate the curve parameter at the target arc lengths
+    idx = np.clip((cumulative[..., None, :] < targets[..., :, None]).sum(axis=-1), 1, len(t_dense) - 1)
+    before = np.take_along_axis(cumulative, idx - 1, axis=-1)
+    after = np.take_along_axis(cumulative, idx, axis=-1)
+    blend = np.divide(targets - before, after - before, out=np.zeros_like(targets), where=after > before)
+    t = ((idx - 1 + blend) / (len(t_dense) - 1))[..., None]
+
+    tangents = tangent(t)
+    # Degenerate handles: use the chord
+    chord = np.broadcast_to(p3 - p0, tangents.shape)
+    tangents = np.where(np.linalg.norm(tangents, axis=-1, keepdims=True) > 1.0e-9, tangents, chord)
+    return point(t), normalized(tangents)
+
+
+def bezier_handles(head, tail, handle_start, handle_end, ease_in, ease_out):
+    """
+    Inner control points of the bbone curve of a bone with absolute custom handles
+    """
+    length = np.linalg.norm(tail - head, axis=-1, keepdims=True)
+    direction = normalized(tail - head)
+    start = normalized(handle_start - head) if handle_start is not None else direction
+    end = normalized(handle_end - tail) if handle_end is not None else -direction
+    p1 = head + start * np.asarray(ease_in)[..., None] * length * BBONE_HANDLE_SCALE
+    p2 = tail + end * np.asarray(ease_out)[..., None] * length * BBONE_HANDLE_SCALE
+    return p1, p2
+
+
+def stroke_chain(armature, group_id):
+    """
+    Names of the bones of a rigged stroke by (role, bone_order)
+    """
+    registry = get_bone_registry(armature)
+    bones = armature.data.bones
+    chain = {}
+    for role in ('CTRL', 'DEFORM', 'HANDLE_LEFT', 'HANDLE_RIGHT'):
+        for name in registry.names(role, group_id):
+            chain[(role, bones[name].bone_order)] = name
+    return chain
+
+
+def driven_ease(armature, deform_name, prop):
+    anim = armature.animation_data
+    return bool(anim and anim.drivers.find(f'pose.bones["{deform_name}"].{prop}'))
+
+
+def deform_bone_segments(armature, group_id, frames):
+    """
+    Rest and pose segment frames of every deform bone of a rigged stroke, by name.
+    Each entry holds the rest head, orientation and length, the rest boundary
+    points and rotations, and the pose ones for every frame.
+    None if the pose of the control bones can't be evaluated
+    """
+    chain = stroke_chain(armature, group_id)
+    bones = armature.data.bones
+    names = [name for (role, order), name in chain.items() if role != 'DEFORM']
+    poses = pose_matrices(armature, names, frames)
+    if poses is None:
+        return None
+
+    def heads(role, order):
+        name = chain.get((role, order))
+        if name is None:
+            return None, None
+        return np.asarray(bones[name].head_local, dtype=float), poses[name][:, :3, 3]
+
+    deform_names = sorted((order, name) for (role, order), name in chain.items() if role == 'DEFORM')
+    segments_by_bone = {}
+    prev_swing = None
+    for order, name in deform_names:
+        bone = bones[name]
+        segments = bone.full_segments or bone.bbone_segments
+        # Copy location and stretch to: the bone spans from its control to the next one
+        _, head = heads('CTRL', order)
+        _, tail = heads('CTRL', order + 1)
+        rest_hstart, hstart = heads('HANDLE_RIGHT', order)
+        rest_hend, hend = heads('HANDLE_LEFT', order)
+        rest_head = np.asarray(bone.head_local, dtype=float)
+        rest_tail = np.asarray(bone.tail_local, dtype=float)
+
+        # Ease drivers keep the handle length proportional to the distance to the handle bone
+        ease_in = np.full(len(frames), bone.bbone_easein)
+        ease_out = np.full(len(frames), bone.bbone_easeout)
+        if hstart is not None and driven_ease(armature, name, 'bbone_easein'):
+            rest_dist = np.linalg.norm(rest_hstart - rest_head)
+            if rest_dist:
+                ease_in *= np.linalg.norm(hstart - head, axis=-1) / rest_dist
+        if hend is not None and driven_ease(armature, name, 'bbone_easeout'):
+            rest_dist = np.linalg.norm(rest_hend - rest_tail)
+            if rest_dist:
+                ease_out *= np.linalg.norm(hend - tail, axis=-1) / rest_dist
+
+        rest_p1, rest_p2 = bezier_handles(rest_head, rest_tail, rest_hstart, rest_hend,
+                                          bone.bbone_easein, bone.bbone_easeout)
+        p1, p2 = bezier_handles(head, tail, hstart, hend, ease_in, ease_out)
+
+        # Stretch to swings the orientation inherited from the previous deform bone
+        rest_rot = np.asarray(bone.matrix_local, dtype=float)[:3, :3]
+        inherited = rest_rot if prev_swing is None else prev_swing @ rest_rot
+        pose_rot = swing(inherited[..., :, 1], normalized(tail - head)) @ inherited
+        prev_swing = pose_rot @ rest_rot.T
+
+        rest_points, rest_tangents = bezier_segments(rest_head, rest_p1, rest_p2, rest_tail, segments)
+        points, tangents = bezier_segments(head, p1, p2, tail, segments)
+        local_rest = np.einsum('ji,...j->...i', rest_rot, rest_tangents)
+        local_pose = np.einsum('...ji,...kj->...ki', pose_rot, tangents)
+        segments_by_bone[name] = {
+            'segments': segments,
+            'rest_head': rest_head,
+            'rest_rot': rest_rot,
+            'rest_length': bone.length,
+            'rest_points': rest_points,
+            'rest_rots': rest_rot @ y_to_vec(local_rest),
+            'points': points,
+            'rots': pose_rot[:, None] @ y_to_vec(local_pose),
+        }
+    return segments_by_bone
+
+
+def deform_points(co, weights, segments_by_bone):
+    """
+    Deforms the (n, 3) armature space points co by the bones in weights,
+    a dict of (n,) weights by bone name.  Returns (n_frames, n, 3)
+    """
+    total = np.zeros(len(co))
+    result = None
+    for name, bone_weights in weights.items():
+        seg = segments_by_bone.get(name)
+        mask = bone_weights > 0.0
+        if seg is None or not mask.any():
+            continue
+        x = co[mask]
+        # The segment is picked by the position along the straight rest bone
+        y = (x - seg['rest_head']) @ seg['rest_rot'][:, 1]
+        u = np.clip(y / seg['rest_length'], 0.0, 1.0) * seg['segments']
+        k = np.minimum(np.floor(u).astype(int), seg['segments'] - 1)
+        blend = (u - k)[None, :, None]
+
+        deformed = 0.0
+        for j, factor in ((k, 1.0 - blend), (k + 1, blend)):
+            offset = x - seg['rest_points'][j]
+            rotation = seg['rots'][:, j] @ np.swapaxes(seg['rest_rots'][j], -1, -2)
+            moved = seg['points'][:, j] + np.einsum('fnij,nj->fni', rotation, offset)
+            deformed = deformed + factor * moved
+
+        if result is None:
+            result = np.zeros((deformed.shape[0],) + co.shape)
+        result[:, mask] += bone_weights[mask][None, :, None] * deformed
+        total[mask] += bone_weights[mask]
+
+    if result is None:
+        return None
+    # Points outside every deform group keep their position
+    has_weight = total > 0.0
+    result[:, has_weight] /= total[has_weight][None, :, None]
+    result[:, ~has_weight] = co[~has_weight]
+    return result
+
+
+def stroke_weights(gp_ob, stroke, bone_names):
+    """
+    (n_points,) weights of every deform bone, read from the vertex groups named as the bones
+    """
+    weights = {}
+    n_points = len(stroke.points)
+    for name in bone_names:
+        vgroup = gp_ob.vertex_groups.get(name)
+        if not vgroup:
+            continue
+        values = np.array([stroke.points.weight_get(vertex_group_index=vgroup.index, point_index=idx)
+                           for idx in range(n_points)])
+        weights[name] = np.maximum(values, 0.0)
+    return weights
+
+
+def evaluate_stroke(gp_ob, armature, stroke, group_id, frames):
+    """
+    (n_frames, n_points, 3) deformed positions of the points of a rigged stroke
+    in gp_ob space, None if the stroke has no deform bones or its rig can't be
+    evaluated offline (see unsupported_reason)
+    """
+    frames = list(frames)
+    if unsupported_reason(gp_ob, armature, group_id):
+        return None
+    segments_by_bone = deform_bone_segments(armature, group_id, frames)
+    if not segments_by_bone:
+        return None
+
+    to_armature = np.asarray(armature.matrix_world.inverted() @ gp_ob.matrix_world, dtype=float)
+    co = np.empty(len(stroke.points) * 3)
+    stroke.points.foreach_get('co', co)
+    co = co.reshape(-1, 3) @ to_armature[:3, :3].T + to_armature[:3, 3]
+
+    weights = stroke_weights(gp_ob, stroke, segments_by_bone)
+    deformed = deform_points(co, weights, segments_by_bone)
+    if deformed is None:
+        return None
+    to_gp = np.linalg.inv(to_armature)
+    return deformed @ to_gp[:3, :3].T + to_gp[:3, 3]
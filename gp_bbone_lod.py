@@ -0,0 +1,254 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from contextlib import contextmanager
+from bpy.app.handlers import persistent
+from .gp_bone_registry import get_bone_registry
+
+LOD_MODES = [('ALWAYS', 'Always', 'Reduced segments in the viewport at all times'),
+             ('PLAYBACK', 'Interaction', 'Reduced segments while the animation plays or bones are transformed'),
+             ('ZOOM', 'Zoomed out', 'Reduced segments while every 3D view is further than lod_zoom_distance')]
+
+# Seconds between checks of whether playback stopped or the zoom changed
+PLAYBACK_POLL = 0.25
+# Events, seen by the go_pose modal handler, that start a transform of the bones
+TRANSFORM_EVENTS = {'G', 'R', 'S', 'EVT_TWEAK_L', 'EVT_TWEAK_R'}
+
+_lod_active = False
+_rendering = False
+# Whether a transform started from pose mode is running
+_interacting = False
+# Whether the reduced segments were in use when the file started saving
+_lod_before_save = False
+
+
+def gposer_armatures():
+    return [ob for ob in bpy.data.objects
+            if ob.type == 'ARMATURE' and ob.data.is_gposer_armature]
+
+
+def set_segments(armature, lod_segments=0):
+    """
+    Sets the deform bones of armature to at most lod_segments,
+    or back to their full segments when lod_segments is 0
+    """
+    bones = armature.data.bones
+    for name in get_bone_registry(armature).names('DEFORM'):
+        bone = bones[name]
+        if not bone.full_segments:
+            bone.full_segments = bone.bbone_segments
+        segments = min(lod_segments, bone.full_segments) if lod_segments else bone.full_segments
+        if bone.bbone_segments != segments:
+            bone.bbone_segments = segments
+
+
+def apply_lod(active):
+    """
+    Reduces or restores the segments of the deform bones of every gomez_poser armature
+    """
+    global _lod_active
+    lod_segments = bpy.context.window_manager.gopo_prop_group.lod_segments if active else 0
+    for armature in gposer_armatures():
+        set_segments(armature, lod_segments)
+    _lod_active = active
+
+
+def has_reduced_segments():
+    """
+    Whether a deform bone has fewer segments than its full segments,
+    as in a file saved or copied with the reduced segments in use
+    """
+    for armature in gposer_armatures():
+        bones = armature.data.bones
+        for name in get_bone_registry(armature).names('DEFORM'):
+            bone = bones[name]
+            if bone.full_segments and bone.bbone_segments != bone.full_segments:
+                return True
+    return False
+
+
+def zoomed_out(distance):
+    """
+    Whether every 3D view looks at the scene from further than distance
+    """
+    views = [area.spaces.active.region_3d for window in bpy.context.window_manager.windows
+             for area in window.screen.areas if area.type == 'VIEW_3D']
+    return bool(views) and all(view.view_distance > distance for view in views)
+
+
+def wants_lod():
+    """
+    Whether the viewport should use reduced segments now
+    """
+    props = bpy.context.window_manager.gopo_prop_group
+    if not props.bbone_lod or _rendering:
+        return False
+    if props.lod_mode == 'ALWAYS':
+        return True
+    if props.lod_mode == 'ZOOM':
+        return zoomed_out(props.lod_zoom_distance)
+    screen = bpy.context.screen
+    return _interacting or bool(screen and screen.is_animation_playing)
+
+
+def watches_zoom():
+    props = bpy.context.window_manager.gopo_prop_group
+    return props.bbone_lod and props.lod_mode == 'ZOOM'
+
+
+def update_lod():
+    """
+    Applies or removes the reduced segments if the state changed
+    """
+    active = wants_lod()
+    if active != _lod_active:
+        apply_lod(active)
+    # The end of playback and zoom changes have no handler: poll them
+    if (_lod_active or watches_zoom()) and not bpy.app.timers.is_registered(poll_lod):
+        bpy.app.timers.register(poll_lod, first_interval=PLAYBACK_POLL)
+
+
+def notice_event(event):
+    """
+    Follows the transforms from the events of the go_pose modal handler.
+    A transform takes all the events while it runs: the next event the
+    handler sees means it ended
+    """
+    global _interacting
+    if event.type.startswith('TIMER'):
+        return
+    interacting = (event.type in TRANSFORM_EVENTS and event.value != 'RELEASE'
+                   and not (event.ctrl or event.alt))
+    if interacting != _interacting:
+        _interacting = interacting
+        update_lod()
+
+
+def refresh_lod(armature):
+    """
+    Reduces the segments of new bones if the reduced segments are in use
+    """
+    if _lod_active:
+        set_segments(armature, bpy.context.window_manager.gopo_prop_group.lod_segments)
+
+
+def poll_lod():
+    update_lod()
+    # Keep polling while the reduced segments are in use or the zoom is followed
+    return PLAYBACK_POLL if _lod_active or watches_zoom() else None
+
+
+@persistent
+def lod_frame_change(scene, *args):
+    if _lod_active or not wants_lod():
+        return
+    update_lod()
+
+
+@persistent
+def lod_render_pre(scene, *args):
+    global _rendering
+    _rendering = True
+    if _lod_active or has_reduced_segments():
+        apply_lod(False)
+
+
+@persistent
+def lod_render_post(scene, *args):
+    global _rendering
+    _rendering = False
+    update_lod()
+
+
+@contextmanager
+def full_resolution():
+    """
+    Full segments inside the block, for baking
+    """
+    was_active = _lod_active
+    if was_active or has_reduced_segments():
+        apply_lod(False)
+    try:
+        yield
+    finally:
+        if was_active:
+            apply_lod(True)
+
+
+@persistent
+def lod_save_pre(*args):
+    # The file is saved with the full segments
+    global _lod_before_save
+    _lod_before_save = _lod_active
+    apply_lod(False)
+
+
+@persistent
+def lod_save_post(*args):
+    if _lod_before_save:
+        apply_lod(True)
+
+
+@persistent
+def lod_load_pre(*args):
+    # The bones of the new file are saved with their full segments
+    global _lod_active, _rendering, _interacting, _lod_before_save
+    _lod_active = _rendering = _interacting = _lod_before_save = False
+
+
+@persistent
+def lod_load_post(*args):
+    # Timers don't survive loading a file
+    update_lod()
+
+
+def register():
+    bpy.types.Bone.full_segments = bpy.props.IntProperty(name='full_segments',
+                                                         description='Bendy bone segments at full resolution',
+                                                         default=0)
+    bpy.types.EditBone.full_segments = bpy.props.IntProperty(name='full_segments',
+                                                             description='Bendy bone segments at full resolution',
+                                                             default=0)
+    bpy.app.handlers.frame_change_pre.append(lod_frame_change)
+    bpy.app.handlers.render_init.append(lod_render_pre)
+    bpy.app.handlers.render_complete.append(lod_render_post)
+    bpy.app.handlers.render_cancel.append(lod_render_post)
+    bpy.app.handlers.save_pre.append(lod_save_pre)
+    bpy.app.handlers.save_post.append(lod_save_post)
+    bpy.app.handlers.load_pre.append(lod_load_pre)
+    bpy.app.handlers.load_post.append(lod_load_post)
+
+
+def unregister():
+    if _lod_active:
+        apply_lod(False)
+    if bpy.app.timers.is_registered(poll_lod):
+        bpy.app.timers.unregister(poll_lod)
+    bpy.app.handlers.frame_change_pre.remove(lod_frame_change)
+    bpy.app.handlers.render_init.remove(lod_render_pre)
+    bpy.app.handlers.render_complete.remove(lod_render_post)
+    bpy.app.handlers.render_cancel.remove(lod_render_post)
+    bpy.app.handlers.save_pre.remove(lod_save_pre)
+    bpy.app.handlers.save_post.remove(lod_save_post)
+    bpy.app.handlers.load_pre.remove(lod_load_pre)
+    bpy.app.handlers.load_post.remove(lod_load_post)
+    del bpy.types.Bone.full_segments
+    del bpy.types.EditBone.full_segments
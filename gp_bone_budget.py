@@ -0,0 +1,185 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+import numpy as np
+from .gp_bone_registry import get_bone_registry
+
+# Samples per fitted segment used to measure the fitting error
+ERROR_SAMPLES = 64
+# Fits tried while searching the error threshold
+MAX_SEARCH_FITS = 10
+
+
+def bezier_samples(p0, p1, p2, p3, n=ERROR_SAMPLES):
+    """
+    Returns n points of a cubic bezier as an (n, 3) array
+    """
+    t = np.linspace(0.0, 1.0, n)[:, None]
+    mt = 1.0 - t
+    return (mt**3 * np.asarray(p0) + 3.0 * mt**2 * t * np.asarray(p1) +
+            3.0 * mt * t**2 * np.asarray(p2) + t**3 * np.asarray(p3))
+
+
+def fitted_max_error(context, stroke):
+    """
+    Maximum distance from the stroke points to the fitted curve
+    stored in window_manager.fitted_bones
+    """
+    co = np.array([pt.co for pt in stroke.points])
+    max_error = 0.0
+    for fb in context.window_manager.fitted_bones:
+        first, last = fb.vg_idx
+        curve = bezier_samples(fb.bone_head, fb.handle_l, fb.handle_r, fb.bone_tail)
+        pts = co[first:last + 1]
+        if not len(pts):
+            continue
+        dists = np.linalg.norm(pts[:, None, :] - curve[None, :, :], axis=2).min(axis=1)
+        max_error = max(max_error, float(dists.max()))
+    return max_error
+
+
+def turning_angles(heads, handles_l, handles_r, tails):
+    """
+    Turning angle of the control polygon of each bezier segment,
+    an upper bound of how much the tangent turns along the segment
+    """
+    points = np.stack([heads, handles_l, handles_r, tails], axis=1).astype(float)
+    angles = np.zeros(len(points))
+    for idx, legs in enumerate(np.diff(points, axis=1)):
+        # Zero length legs (handles on the knots) have no direction
+        norms = np.linalg.norm(legs, axis=1)
+        unit = legs[norms > 0.0] / norms[norms > 0.0, None]
+        cosines = np.clip((unit[:-1] * unit[1:]).sum(axis=1), -1.0, 1.0)
+        angles[idx] = np.arccos(cosines).sum()
+    return angles
+
+
+def allocate_segments(weights, budget, max_segments=32):
+    """
+    Splits budget segments among the bones proportionally to weights,
+    with at least one and at most max_segments per bone
+    """
+    weights = np.maximum(np.asarray(weights, dtype=float), 0.0)
+    num = len(weights)
+    counts = np.ones(num, dtype=int)
+    extra = min(budget, num * max_segments) - num
+    if extra <= 0:
+        return counts.tolist()
+    if weights.sum() == 0.0:
+        weights = np.ones(num)
+
+    share = weights / weights.sum() * extra
+    counts += np.minimum(np.floor(share).astype(int), max_segments - 1)
+    # Hand out what the rounding left to the largest remainders
+    remainder = share - np.floor(share)
+    for idx in np.argsort(-remainder, kind='stable'):
+        if counts.sum() - num >= extra:
+            break
+        if weights[idx] > 0.0 and counts[idx] < max_segments:
+            counts[idx] += 1
+    return counts.tolist()
+
+
+def curvature_segments(heads, handles_l, handles_r, tails, budget, max_segments=32):
+    """
+    Bendy bone segments for each fitted segment within budget.  The chord error of
+    n segments along an arc of angle a and length l goes as l * a**2 / n**2, so
+    the segments are allocated proportionally to a * sqrt(l)
+    """
+    lengths = np.linalg.norm(np.asarray(tails, dtype=float) - np.asarray(heads, dtype=float), axis=1)
+    weights = turning_angles(heads, handles_l, handles_r, tails) * np.sqrt(lengths)
+    return allocate_segments(weights, budget, max_segments)
+
+
+def count_deform_bones(armature):
+    """
+    Number of gomez_poser deform bones in the armature
+    """
+    return len(get_bone_registry(armature).names('DEFORM'))
+
+
+def stroke_bone_budget(context, armature, strokes_left=1, deform_bones=None):
+    """
+    Maximum number of deform bones for the next stroke, from the per-stroke
+    budget and what is left of the scene budget shared by the strokes left
+    to rig.  deform_bones is the number already in the armature, counted if
+    None; callers rigging many strokes count once and keep it up to date.
+    Returns 0 if there is no budget
+    """
+    props = context.window_manager.gopo_prop_group
+    budget = props.max_bones_per_stroke
+    if props.scene_bone_budget:
+        if deform_bones is None:
+            deform_bones = count_deform_bones(armature)
+        remaining = props.scene_bone_budget - deform_bones
+        share = max(1, remaining // max(1, strokes_left))
+        budget = min(budget, share) if budget else share
+    return budget
+
+
+def fit_stroke(context, error_threshold, stroke_index):
+    """
+    Fits the stroke, returns the number of bones of the fitted curve
+    """
+    bpy.ops.gpencil.fit_curve(error_threshold=error_threshold,
+                              target='ARMATURE',
+                              stroke_index=stroke_index)
+    return len(context.window_manager.fitted_bones)
+
+
+def fit_within_budget(context, stroke_index, error_threshold, max_bones):
+    """
+    Fits the stroke with the smallest error threshold that keeps the number
+    of bones within max_bones (searching in log scale).
+    The fitted curve is left in window_manager.fitted_bones.
+    Returns the error threshold used
+    """
+    if fit_stroke(context, error_threshold, stroke_index) <= max_bones:
+        return error_threshold
+
+    # Find an upper bound that fits in the budget
+    low = error_threshold
+    high = error_threshold
+    fits = 1
+    while fits < MAX_SEARCH_FITS:
+        high *= 4.0
+        fits += 1
+        if fit_stroke(context, high, stroke_index) <= max_bones:
+            break
+        low = high
+    else:
+        # The stroke can't be fitted with so few bones
+        return high
+
+    # Bisect between a threshold with too many bones and one within budget
+    last_fit = high
+    while fits < MAX_SEARCH_FITS:
+        last_fit = (low * high) ** 0.5
+        fits += 1
+        if fit_stroke(context, last_fit, stroke_index) <= max_bones:
+            high = last_fit
+        else:
+            low = last_fit
+
+    if last_fit != high:
+        # the last fit was over budget
+        fit_stroke(context, high, stroke_index)
+    return high
@@ -0,0 +1,151 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from bpy.app.handlers import persistent
+
+ROLES = ('CTRL', 'DEFORM', 'ROOT', 'HANDLE_LEFT', 'HANDLE_RIGHT')
+# Roles that group other roles
+ROLE_ALIASES = {'HANDLE': ('HANDLE_LEFT', 'HANDLE_RIGHT'),
+                'ALL': ROLES}
+
+# Bumped in the armature data every time its gomez_poser bones change
+GENERATION_KEY = 'gposer_registry_generation'
+
+# Registries by armature data name
+_registries = {}
+
+
+def bone_role(bone):
+    """
+    Returns the role of a gomez_poser bone, None for other bones
+    """
+    if bone.poser_control:
+        return 'CTRL'
+    if bone.poser_deform:
+        return 'DEFORM'
+    if bone.poser_root:
+        return 'ROOT'
+    if bone.poser_lhandle:
+        return 'HANDLE_LEFT'
+    if bone.poser_rhandle:
+        return 'HANDLE_RIGHT'
+
+
+def registry_signature(armature_data):
+    """
+    Cheap check of whether the bones changed since the registry was built.
+    The names catch renamed bones, and bones changed by other tools
+    """
+    return (armature_data.get(GENERATION_KEY, 0), hash(tuple(armature_data.bones.keys())))
+
+
+class BoneRegistry:
+    """
+    Names of the gomez_poser bones of an armature by role and rigged_stroke
+    """
+
+    def __init__(self, armature_data):
+        self.signature = registry_signature(armature_data)
+        self.by_role = {role: [] for role in ROLES}
+        self.by_stroke = {}
+        for bone in armature_data.bones:
+            role = bone_role(bone)
+            if not role:
+                continue
+            self.by_role[role].append(bone.name)
+            stroke_roles = self.by_stroke.setdefault(bone.rigged_stroke, {})
+            stroke_roles.setdefault(role, []).append(bone.name)
+
+    def names(self, role='ALL', rigged_stroke=None):
+        """
+        Names of the bones with role (or any of the roles of an alias),
+        optionally only those of a rigged_stroke
+        """
+        roles = ROLE_ALIASES.get(role, (role,))
+        if rigged_stroke is None:
+            return [name for r in roles for name in self.by_role[r]]
+        stroke_roles = self.by_stroke.get(rigged_stroke, {})
+        return [name for r in roles for name in stroke_roles.get(r, ())]
+
+    def strokes(self):
+        """
+        The rigged_stroke ids with bones in the armature
+        """
+        return list(self.by_stroke)
+
+
+def get_bone_registry(armature):
+    """
+    Returns the registry of the armature object, rebuilding it if
+    the bones changed since it was built
+    """
+    armature_data = armature.data
+    registry = _registries.get(armature_data.name)
+    if registry is None or registry.signature != registry_signature(armature_data):
+        registry = BoneRegistry(armature_data)
+        _registries[armature_data.name] = registry
+    return registry
+
+
+def invalidate_bone_registry(armature):
+    """
+    Marks the registry of the armature as stale.  Call after adding,
+    removing or renaming gomez_poser bones
+    """
+    armature_data = armature.data
+    armature_data[GENERATION_KEY] = armature_data.get(GENERATION_KEY, 0) + 1
+    _registries.pop(armature_data.name, None)
+
+
+@persistent
+def registry_load_pre(*args):
+    # Armatures of the new file may have the names of the old ones
+    _registries.clear()
+
+
+# Pending throttled updates by key
+_pending_updates = set()
+
+
+def throttled(key, func, interval=1.0/30.0):
+    """
+    Runs func once after interval, coalescing all the calls with the same key
+    made in the meantime.  Used by the slider update callbacks
+    """
+    if key in _pending_updates:
+        return
+    _pending_updates.add(key)
+
+    def run():
+        _pending_updates.discard(key)
+        func()
+        return None
+
+    bpy.app.timers.register(run, first_interval=interval)
+
+
+def register():
+    bpy.app.handlers.load_pre.append(registry_load_pre)
+
+
+def unregister():
+    bpy.app.handlers.load_pre.remove(registry_load_pre)
+    _registries.clear()
@@ -0,0 +1,270 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from bisect import bisect_right
+from contextlib import contextmanager
+from bpy.app.handlers import persistent
+from bpy_extras.object_utils import world_to_camera_view
+from .gp_bone_registry import get_bone_registry
+from .gp_armature_applier import set_rig_muted
+
+# Rigs muted by culling, stored in the gp object as {armature name: [group ids]}
+# so that the state survives saving and reloading the file
+CULLED_KEY = 'gposer_culled'
+
+_rendering = False
+_suspended = False
+# Keyframe activity indices by grease pencil data name
+_activity_indices = {}
+
+
+def rigged_pairs(scene):
+    """
+    (gp_ob, armature) pairs of the scene linked by an armature modifier
+    """
+    pairs = []
+    for ob in scene.objects:
+        if ob.type != 'GPENCIL':
+            continue
+        for mod in ob.grease_pencil_modifiers:
+            armature = mod.object if mod.type == 'GP_ARMATURE' else None
+            if armature and armature.data.is_gposer_armature and (ob, armature) not in pairs:
+                pairs.append((ob, armature))
+    return pairs
+
+
+def rig_view_points(armature, group_id):
+    """
+    World positions of the control and handle bones of a rigged stroke,
+    which bound the curve of its deform bones
+    """
+    matrix = armature.matrix_world
+    pbones = armature.pose.bones
+    registry = get_bone_registry(armature)
+    names = registry.names('CTRL', group_id) + registry.names('HANDLE', group_id)
+    return [matrix @ pbones[name].head for name in names]
+
+
+def is_out_of_view(scene, camera, points, margin):
+    """
+    Whether all points lie beyond the same side of the camera frustum,
+    widened by margin (in frame units)
+    """
+    if not points:
+        return False
+    view = [world_to_camera_view(scene, camera, co) for co in points]
+    return (all(co.z < 0.0 for co in view) or
+            all(co.x < -margin for co in view) or
+            all(co.x > 1.0 + margin for co in view) or
+            all(co.y < -margin for co in view) or
+            all(co.y > 1.0 + margin for co in view))
+
+
+def culled_groups(scene, armature, margin):
+    """
+    Group ids of the rigs of armature out of view of the scene camera
+    """
+    if not scene.camera:
+        return set()
+    return {group_id for group_id in get_bone_registry(armature).strokes()
+            if is_out_of_view(scene, scene.camera, rig_view_points(armature, group_id), margin)}
+
+
+def activity_signature(gp_data):
+    return tuple((layer.info, len(layer.frames)) for layer in gp_data.layers)
+
+
+class ActivityIndex:
+    """
+    Group ids of the rigged strokes in every keyframe of every layer
+    """
+
+    def __init__(self, gp_data):
+        self.signature = activity_signature(gp_data)
+        # {layer name: (sorted frame numbers, [set of group ids per frame])}
+        self.layers = {}
+        for layer in gp_data.layers:
+            frames = sorted(layer.frames, key=lambda frame: frame.frame_number)
+            self.layers[layer.info] = ([frame.frame_number for frame in frames],
+                                       [{stroke.bone_groups for stroke in frame.strokes if stroke.bone_groups}
+                                        for frame in frames])
+
+    def active_groups(self, gp_data, frame_number):
+        """
+        Group ids of the strokes in the keyframes displayed at frame_number
+        by the visible layers
+        """
+        active = set()
+        for layer in gp_data.layers:
+            if layer.hide or layer.info not in self.layers:
+                continue
+            frame_numbers, groups = self.layers[layer.info]
+            idx = bisect_right(frame_numbers, frame_number) - 1
+            if idx >= 0:
+                active |= groups[idx]
+        return active
+
+
+def get_activity_index(gp_data):
+    """
+    Returns the activity index of the grease pencil data, rebuilding it if
+    keyframes were added or removed
+    """
+    index = _activity_indices.get(gp_data.name)
+    if index is None or index.signature != activity_signature(gp_data):
+        index = ActivityIndex(gp_data)
+        _activity_indices[gp_data.name] = index
+    return index
+
+
+def inactive_groups(scene, gp_ob, armature):
+    """
+    Group ids of the rigs of armature whose strokes aren't in any displayed keyframe
+    """
+    active = get_activity_index(gp_ob.data).active_groups(gp_ob.data, scene.frame_current)
+    return set(get_bone_registry(armature).strokes()) - active
+
+
+def get_muted_groups(gp_ob, armature):
+    return set(gp_ob.get(CULLED_KEY, {}).get(armature.name, ()))
+
+
+def set_muted_groups(gp_ob, armature, group_ids):
+    """
+    Mutes the rigs in group_ids and unmutes the rest of the rigs muted before,
+    touching only the rigs whose state changes
+    """
+    muted = get_muted_groups(gp_ob, armature)
+    if muted == group_ids:
+        return
+    for group_id in group_ids - muted:
+        set_rig_muted(gp_ob, armature, group_id, True)
+    for group_id in muted - group_ids:
+        set_rig_muted(gp_ob, armature, group_id, False)
+    if CULLED_KEY not in gp_ob:
+        gp_ob[CULLED_KEY] = {}
+    gp_ob[CULLED_KEY][armature.name] = sorted(group_ids)
+
+
+def update_culling(scene):
+    """
+    Mutes the rigs out of view or without strokes in the displayed keyframes,
+    and unmutes the ones back in use
+    """
+    props = bpy.context.window_manager.gopo_prop_group
+    for gp_ob, armature in rigged_pairs(scene):
+        group_ids = set()
+        if props.enable_culling:
+            group_ids |= culled_groups(scene, armature, props.cull_margin)
+        if props.mute_inactive_rigs:
+            group_ids |= inactive_groups(scene, gp_ob, armature)
+        set_muted_groups(gp_ob, armature, group_ids)
+
+
+def restore_all():
+    """
+    Unmutes every rig muted by culling
+    """
+    for gp_ob in bpy.data.objects:
+        if CULLED_KEY not in gp_ob:
+            continue
+        for armature_name in gp_ob[CULLED_KEY].keys():
+            armature = bpy.data.objects.get(armature_name)
+            if armature:
+                set_muted_groups(gp_ob, armature, set())
+        del gp_ob[CULLED_KEY]
+
+
+@contextmanager
+def culling_suspended(scene):
+    """
+    Unmutes every rig muted by culling and keeps culling off inside the block,
+    culls again on exit
+    """
+    global _suspended
+    restore_all()
+    _suspended = True
+    try:
+        yield
+    finally:
+        _suspended = False
+        props = bpy.context.window_manager.gopo_prop_group
+        if props.enable_culling or props.mute_inactive_rigs:
+            update_culling(scene)
+
+
+@persistent
+def cull_frame_change(scene, *args):
+    # Uses the pose of the previous frame; the margin covers the motion between frames
+    props = bpy.context.window_manager.gopo_prop_group
+    if _rendering or _suspended or not (props.enable_culling or props.mute_inactive_rigs):
+        return
+    update_culling(scene)
+
+
+@persistent
+def cull_depsgraph_update(scene, depsgraph):
+    # Strokes edited: rebuild the activity index of their data on the next frame change
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.GreasePencil) and update.is_updated_geometry:
+            _activity_indices.pop(update.id.name, None)
+
+
+@persistent
+def cull_render_pre(scene, *args):
+    global _rendering
+    if bpy.context.window_manager.gopo_prop_group.cull_restore_render:
+        _rendering = True
+        restore_all()
+
+
+@persistent
+def cull_render_post(scene, *args):
+    global _rendering
+    _rendering = False
+
+
+@persistent
+def cull_load_pre(*args):
+    # Grease pencil data of the new file may have the names of the old one
+    global _rendering, _suspended
+    _activity_indices.clear()
+    _rendering = False
+    _suspended = False
+
+
+def register():
+    bpy.app.handlers.load_pre.append(cull_load_pre)
+    bpy.app.handlers.frame_change_pre.append(cull_frame_change)
+    bpy.app.handlers.depsgraph_update_post.append(cull_depsgraph_update)
+    bpy.app.handlers.render_init.append(cull_render_pre)
+    bpy.app.handlers.render_complete.append(cull_render_post)
+    bpy.app.handlers.render_cancel.append(cull_render_post)
+
+
+def unregister():
+    restore_all()
+    bpy.app.handlers.load_pre.remove(cull_load_pre)
+    bpy.app.handlers.frame_change_pre.remove(cull_frame_change)
+    bpy.app.handlers.depsgraph_update_post.remove(cull_depsgraph_update)
+    bpy.app.handlers.render_init.remove(cull_render_pre)
+    bpy.app.handlers.render_complete.remove(cull_render_post)
+    bpy.app.handlers.render_cancel.remove(cull_render_post)
@@ -19,8 +19,14 @@ Created by Marcelo Demian Gómez
 '''
 
 import bpy
-from bpy.props import FloatProperty, IntProperty, FloatVectorProperty, BoolProperty, PointerProperty, CollectionProperty, StringProperty
-from .gp_rigging_ops import change_context
+from bpy.props import FloatProperty, IntProperty, FloatVectorProperty, BoolProperty, PointerProperty, CollectionProperty, StringProperty, EnumProperty
+from .gp_rigging_ops import EASE_MODES, change_context
+from . import gomez_poser_ui
+from . import gp_profiling
+from .gp_bone_registry import get_bone_registry, throttled
+from . import gp_bbone_lod
+from . import gp_culling
+from .gp_point_cache import CACHE_ENCODINGS
 
 
 class FittedBone(bpy.types.PropertyGroup):
@@ -50,25 +56,60 @@ def maybe_hide_handles(self, context):
     armature.data.layers[1] = self.show_handles
     return
 
+def update_profiling(self, context):
+    gp_profiling.set_enabled(self.enable_profiling)
+    return
+
+
+def update_frame_timing(self, context):
+    gp_profiling.set_frame_timer(self.enable_frame_timing)
+    return
+
+
+def update_bbone_lod(self, context):
+    gp_bbone_lod.update_lod()
+    return
+
+
+def update_lod_segments(self, context):
+    if gp_bbone_lod.wants_lod():
+        gp_bbone_lod.apply_lod(True)
+    return
+
+
+def update_culling(self, context):
+    if self.enable_culling or self.mute_inactive_rigs:
+        gp_culling.update_culling(context.scene)
+    else:
+        gp_culling.restore_all()
+    return
+
+
+def set_custom_shape_scale(role, prop_name):
+    """
+    Sets the custom shape scale of the bones with role from the current
+    value of the prop_name property
+    """
+    props = bpy.context.window_manager.gopo_prop_group
+    armature = props.ob_armature
+    if not armature:
+        return
+    scale = getattr(props, prop_name)
+    pbones = armature.pose.bones
+    for name in get_bone_registry(armature).names(role):
+        pbones[name].custom_shape_scale = scale
+
+
 def update_root_scale(self, context):
-    armature = self.ob_armature
-    for pbone in armature.pose.bones:
-        if pbone.bone.poser_root:
-            pbone.custom_shape_scale = self.root_scale
+    throttled('root_scale', lambda: set_custom_shape_scale('ROOT', 'root_scale'))
     return
 
 def update_handle_scale(self, context):
-    armature = self.ob_armature
-    for pbone in armature.pose.bones:
-        if pbone.bone.poser_handle:
-            pbone.custom_shape_scale = self.handle_scale
+    throttled('handle_scale', lambda: set_custom_shape_scale('HANDLE', 'handle_scale'))
     return
 
 def update_ctrl_scale(self, context):
-    armature = self.ob_armature
-    for pbone in armature.pose.bones:
-        if pbone.bone.poser_control:
-            pbone.custom_shape_scale = self.ctrl_scale
+    throttled('ctrl_scale', lambda: set_custom_shape_scale('CTRL', 'ctrl_scale'))
     return 
 
 
@@ -87,6 +128,79 @@ class GopoProperties(bpy.types.PropertyGroup):
                            default=32,
                            min=1,
                            max=32)
+    bbone_segment_budget: IntProperty(name='bbone_segment_budget',
+                                      description='Bendy bone segments of a stroke, split by curvature (0 to use num_bendy on every bone)',
+                                      default=0,
+                                      min=0)
+    bbone_lod: BoolProperty(name='bbone_lod',
+                            description='Fewer bendy bone segments in the viewport, full segments for render and bake',
+                            default=False,
+                            update=update_bbone_lod)
+    lod_mode: EnumProperty(name='lod_mode',
+                           items=gp_bbone_lod.LOD_MODES,
+                           default='PLAYBACK',
+                           update=update_bbone_lod)
+    lod_segments: IntProperty(name='lod_segments',
+                              description='Bendy bone segments of the deform bones at reduced resolution',
+                              default=4,
+                              min=1,
+                              max=32,
+                              update=update_lod_segments)
+    lod_zoom_distance: FloatProperty(name='lod_zoom_distance',
+                                     description='View distance past which the 3D views use reduced segments',
+                                     default=20.0,
+                                     min=0.0,
+                                     update=update_bbone_lod)
+    enable_culling: BoolProperty(name='enable_culling',
+                                 description='Mute the rigs out of view of the active camera. '
+                                             'Strokes rigged with a shared modifier keep deforming, only their bones stop evaluating',
+                                 default=False,
+                                 update=update_culling)
+    mute_inactive_rigs: BoolProperty(name='mute_inactive_rigs',
+                                     description='Mute the rigs whose strokes are not in the keyframes displayed at the current frame. '
+                                                 'Strokes rigged with a shared modifier keep deforming, only their bones stop evaluating',
+                                     default=False,
+                                     update=update_culling)
+    cull_margin: FloatProperty(name='cull_margin',
+                               description='Distance outside the camera frame, as a fraction of the frame, before a rig is muted',
+                               default=0.1,
+                               min=0.0)
+    cull_restore_render: BoolProperty(name='cull_restore_render',
+                                      description='Unmute the culled rigs while rendering',
+                                      default=True)
+    weight_falloff: FloatProperty(name='weight_falloff',
+                                  description='Width of the weight blend across joints, relative to the shortest bone',
+                                  default=0.25,
+                                  min=0.0,
+                                  max=1.0)
+    max_bones_per_stroke: IntProperty(name='max_bones_per_stroke',
+                                      description='Maximum deform bones per stroke (0 for no limit)',
+                                      default=0,
+                                      min=0)
+    scene_bone_budget: IntProperty(name='scene_bone_budget',
+                                   description='Maximum deform bones in the armature (0 for no limit)',
+                                   default=0,
+                                   min=0)
+    last_fit_error: FloatProperty(name='last_fit_error',
+                                  description='Max fitting error of the last strokes rigged within a budget',
+                                  default=0.0)
+    ease_mode: EnumProperty(name='ease_mode',
+                            description='How the ease of the deform bones follows the handles',
+                            items=EASE_MODES,
+                            default='SCRIPTED')
+    modifier_mode: EnumProperty(name='modifier_mode',
+                                description='Armature modifiers added when rigging a stroke',
+                                items=[('SHARED', 'Shared', 'One armature modifier per armature'),
+                                       ('PER_STROKE', 'Per stroke', 'One armature modifier per rigged stroke')],
+                                default='PER_STROKE')
+    enable_profiling: BoolProperty(name='enable_profiling',
+                                   description='Record the time spent in each stage of the operators',
+                                   default=False,
+                                   update=update_profiling)
+    enable_frame_timing: BoolProperty(name='enable_frame_timing',
+                                      description='Time the evaluation of every frame change',
+                                      default=False,
+                                      update=update_frame_timing)
     initialized: BoolProperty(name='initialized',
                               default=False)
     ob_armature: PointerProperty(type=bpy.types.Object,
@@ -106,6 +220,32 @@ class GopoProperties(bpy.types.PropertyGroup):
                                     description='Bake the stroke to new layer',
                                     default=False)
 
+    bake_offline: BoolProperty(name='bake_offline',
+                               description='Evaluate the rig from the control bones animation instead of stepping the scene (approximate)',
+                               default=False)
+
+    bake_to_point_cache: BoolProperty(name='bake_to_point_cache',
+                                      description='Bake to an on-disk point cache streamed into a display stroke, instead of keyframes',
+                                      default=False)
+    point_cache_dir: StringProperty(name='point_cache_dir',
+                                    description='Directory of the point caches',
+                                    default='//gposer_cache',
+                                    subtype='DIR_PATH')
+    point_cache_encoding: EnumProperty(name='point_cache_encoding',
+                                       items=CACHE_ENCODINGS,
+                                       default='FLOAT')
+    point_cache_precision: FloatProperty(name='point_cache_precision',
+                                         description='Precision of the delta encoded coordinates',
+                                         default=1.0e-4,
+                                         min=1.0e-7,
+                                         precision=6)
+
+    bake_workers: IntProperty(name='bake_workers',
+                              description='Background Blender processes of a distributed bake',
+                              default=4,
+                              min=1,
+                              max=64)
+
     bake_from_active_to_current: BoolProperty(name='from_active_to_current',
                                               description='Bake stroke from active keyframe to current frame',
                                               default=True)
@@ -155,10 +295,18 @@ class GopoProperties(bpy.types.PropertyGroup):
 
 
 def notify_mode_change():
+    """
+    Entering pose mode on a gomez_poser armature schedules a (debounced)
+    update of the controls visibility, and starts the go_pose modal handler
+    (go_draw shortcut and selection handling) if it isn't running
+    """
     ob_act = bpy.context.active_object
-    if bpy.context.mode == 'POSE' and ob_act.data.is_gposer_armature:
-        con = change_context(bpy.context, ob_act, obtype='ARMATURE')
-        bpy.ops.greasepencil.go_pose(con)
+    if bpy.context.mode == 'POSE' and ob_act and ob_act.type == 'ARMATURE' and ob_act.data.is_gposer_armature:
+        if gomez_poser_ui.GOMEZ_OT_go_pose.is_running(bpy.context):
+            gomez_poser_ui.schedule_control_visibility()
+        else:
+            con = change_context(bpy.context, ob_act, obtype='ARMATURE')
+            bpy.ops.greasepencil.go_pose(con)
     
 
 
@@ -0,0 +1,127 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Compact storage of baked point sequences: values are quantized to a grid of
+# the given precision, every keyframe_interval frames (and whenever a delta
+# doesn't fit) the quantized values are stored whole, and the frames in between
+# store int16 deltas to the previous frame.  Deltas are taken between quantized
+# values, so decoding is exact on the grid and errors don't accumulate.
+
+import os
+import numpy as np
+
+DELTA_DTYPE = np.int16
+DELTA_LIMIT = np.iinfo(DELTA_DTYPE).max
+KEYFRAME_DTYPE = np.int32
+KEYFRAME_INTERVAL = 32
+
+# Arrays of an encoded sequence, saved as one .npy file each
+ENCODED_ARRAYS = ('keyframes', 'key_index', 'deltas')
+
+
+def encode(values, precision, keyframe_interval=KEYFRAME_INTERVAL):
+    """
+    Encodes an (n_frames, ...) array.  Returns a dict with
+    keyframes: (n_keys, ...) int32 quantized values,
+    key_index: (n_frames,) index of the keyframe each frame decodes from,
+    deltas: (n_frames, ...) int16 deltas to the previous frame (0 on keyframes)
+    and the precision.  key_frames holds the frame of every keyframe.
+    Raises ValueError if the values don't fit int32 at that precision
+    """
+    quantized = np.round(np.asarray(values, dtype=np.float64) / precision).astype(np.int64)
+    if quantized.size and np.abs(quantized).max() > np.iinfo(KEYFRAME_DTYPE).max:
+        raise ValueError(f'Values out of range for a precision of {precision}')
+    n_frames = len(quantized)
+    deltas = np.zeros(quantized.shape, dtype=DELTA_DTYPE)
+    key_index = np.zeros(n_frames, dtype=np.int32)
+    keyframes = []
+    since_key = 0
+    for fr in range(n_frames):
+        if fr > 0:
+            delta = quantized[fr] - quantized[fr - 1]
+            since_key += 1
+        if fr == 0 or since_key >= keyframe_interval or np.abs(delta).max(initial=0) > DELTA_LIMIT:
+            keyframes.append(quantized[fr])
+            since_key = 0
+        else:
+            deltas[fr] = delta
+        key_index[fr] = len(keyframes) - 1
+
+    keyframes = np.array(keyframes, dtype=KEYFRAME_DTYPE).reshape((len(keyframes),) + quantized.shape[1:])
+    encoded = {'keyframes': keyframes, 'key_index': key_index, 'deltas': deltas,
+               'precision': float(precision)}
+    encoded['key_frames'] = keyframe_frames(encoded)
+    return encoded
+
+
+def keyframe_frames(encoded):
+    """
+    Frame index of every keyframe
+    """
+    key_index = np.asarray(encoded['key_index'])
+    return np.flatnonzero(np.diff(key_index, prepend=-1))
+
+
+def decode_frame(encoded, frame):
+    """
+    Values of one frame: its keyframe plus the deltas since it
+    """
+    key = int(encoded['key_index'][frame])
+    start = int(encoded['key_frames'][key])
+    quantized = encoded['keyframes'][key].astype(np.int64)
+    if frame > start:
+        quantized = quantized + encoded['deltas'][start + 1:frame + 1].sum(axis=0, dtype=np.int64)
+    return (quantized * encoded['precision']).astype(np.float32)
+
+
+def decode(encoded):
+    """
+    Values of every frame
+    """
+    key_index = np.asarray(encoded['key_index'])
+    deltas = np.asarray(encoded['deltas'], dtype=np.int64)
+    is_key = np.diff(key_index, prepend=-1) > 0
+    # Restart the running sum of the deltas at every keyframe
+    running = np.cumsum(deltas, axis=0)
+    at_key = running[is_key][key_index]
+    quantized = np.asarray(encoded['keyframes'], dtype=np.int64)[key_index] + running - at_key
+    return (quantized * encoded['precision']).astype(np.float32)
+
+
+def save(directory, name, encoded):
+    """
+    Saves an encoded sequence as name_<array>.npy files plus the precision
+    """
+    for array in ENCODED_ARRAYS:
+        np.save(os.path.join(directory, f'{name}_{array}.npy'), encoded[array])
+    np.save(os.path.join(directory, f'{name}_precision.npy'), np.array(encoded['precision']))
+
+
+def load(directory, name, mmap_mode='r'):
+    """
+    Loads an encoded sequence with its arrays memory mapped
+    """
+    encoded = {array: np.load(os.path.join(directory, f'{name}_{array}.npy'), mmap_mode=mmap_mode)
+               for array in ENCODED_ARRAYS}
+    encoded['precision'] = float(np.load(os.path.join(directory, f'{name}_precision.npy')))
+    # Small, read whole for the keyframe lookups
+    encoded['key_index'] = np.array(encoded['key_index'])
+    encoded['key_frames'] = keyframe_frames(encoded)
+    return encoded
@@ -0,0 +1,388 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Baking split between background Blender processes.  The file is saved to a
+# temporary copy, every worker opens it with `blender -b`, evaluates its chunk
+# of the frame range and saves the baked points of every stroke to .npz files.
+# When all the workers are done the main process merges the chunks into the
+# target layers, so nothing is written if a worker fails or the bake is cancelled.
+
+import bpy
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from contextlib import ExitStack
+from bpy.props import IntProperty, BoolProperty
+from .gp_armature_applier import (get_bake_groups, find_group_stroke, evaluate_scene, evaluate_offline,
+                                  report_offline_fallbacks, store_baked_points, clean_baked_groups)
+from .gp_bbone_lod import full_resolution
+from .gp_profiling import span, operator_call, suspend_call, resumes_call
+
+ADDON = __package__
+# Seconds between checks of the workers
+POLL_INTERVAL = 0.5
+# Lines of a failed worker log shown in the report
+LOG_TAIL = 5
+
+
+def split_frames(frames, num_chunks):
+    """
+    Splits frames in at most num_chunks contiguous, non empty chunks
+    """
+    num_chunks = max(1, min(num_chunks, len(frames)))
+    size, extra = divmod(len(frames), num_chunks)
+    chunks = []
+    start = 0
+    for idx in range(num_chunks):
+        end = start + size + (1 if idx < extra else 0)
+        chunks.append(frames[start:end])
+        start = end
+    return chunks
+
+
+def chunk_path(directory, layer_idx, group_id):
+    return os.path.join(directory, f'layer{layer_idx}_group{group_id}.npz')
+
+
+def save_chunk(path, baked_points):
+    """
+    Saves baked points, {frame: [(co, strength, pressure, vertex_color)]}, to a .npz file
+    """
+    frames = sorted(baked_points)
+    co, strength, pressure, vertex_color = (np.array(values, dtype=np.float32) for values in
+                                            zip(*(zip(*baked_points[fr]) for fr in frames)))
+    np.savez(path, frames=np.array(frames), co=co, strength=strength, pressure=pressure,
+             vertex_color=vertex_color)
+
+
+def load_chunk(path):
+    """
+    Baked points saved by save_chunk
+    """
+    with np.load(path) as data:
+        arrays = [data[name].tolist() for name in ('co', 'strength', 'pressure', 'vertex_color')]
+        frames = data['frames'].tolist()
+    return {fr: list(zip(*(values[idx] for values in arrays))) for idx, fr in enumerate(frames)}
+
+
+class BakeWorker:
+    """
+    A background Blender process baking a chunk of the frame range
+    """
+
+    def __init__(self, blend_path, directory, frames, worker_args):
+        self.directory = directory
+        self.frames = frames
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'worker.log')
+        expr = (f'import addon_utils; addon_utils.enable({ADDON!r}); '
+                f'from {ADDON}.gp_distributed_bake import worker_main; worker_main()')
+        command = [bpy.app.binary_path, '-b', blend_path, '--python-expr', expr, '--',
+                   '--output', directory,
+                   '--frame-init', str(frames[0]), '--frame-end', str(frames[-1])] + worker_args
+        with open(self.log_path, 'w') as log:
+            self.process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+
+    def poll(self):
+        return self.process.poll()
+
+    def failed(self):
+        return self.process.returncode not in (None, 0)
+
+    def log_tail(self):
+        with open(self.log_path) as log:
+            return ' | '.join(line.strip() for line in log.readlines()[-LOG_TAIL:])
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+
+def parse_worker_args(argv):
+    parser = argparse.ArgumentParser(prog='gposer bake worker')
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--gp-ob', required=True)
+    parser.add_argument('--armature', default='')
+    parser.add_argument('--layers', type=int, nargs='*', default=[])
+    parser.add_argument('--groups', type=int, nargs='*', default=[])
+    parser.add_argument('--frame-init', type=int, required=True)
+    parser.add_argument('--frame-end', type=int, required=True)
+    parser.add_argument('--frame-current', type=int, required=True)
+    parser.add_argument('--step', type=int, default=1)
+    parser.add_argument('--offline', action='store_true')
+    return parser.parse_args(argv)
+
+
+def worker_main():
+    """
+    Entry point of a worker: bakes its chunk of every stroke to .npz files.
+    A failure exits with an error code, read by the main process
+    """
+    args = parse_worker_args(sys.argv[sys.argv.index('--') + 1:])
+    scene = bpy.context.scene
+    props = bpy.context.window_manager.gopo_prop_group
+    # Culled rigs would bake undeformed
+    props.enable_culling = False
+    props.mute_inactive_rigs = False
+
+    gp_ob = bpy.data.objects[args.gp_ob]
+    armature = bpy.data.objects.get(args.armature)
+    frames = list(range(args.frame_init, args.frame_end + 1, args.step))
+    gp_obeval = gp_ob.evaluated_get(bpy.context.evaluated_depsgraph_get())
+    try:
+        with full_resolution():
+            for layer_idx in args.layers:
+                layer = gp_ob.data.layers[layer_idx]
+                for group_id in args.groups:
+                    # The strokes are found in the keyframes displayed when the bake started
+                    scene.frame_set(args.frame_current)
+                    stroke_idx, stroke = find_group_stroke(layer, group_id)
+                    if not stroke:
+                        continue
+                    baked_points = None
+                    if args.offline and armature:
+                        baked_points = evaluate_offline(gp_ob, armature, stroke, group_id, frames)
+                    if not baked_points:
+                        baked_points = evaluate_scene(scene, gp_obeval, layer.info, stroke_idx, frames)
+                    save_chunk(chunk_path(args.output, layer_idx, group_id), baked_points)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        sys.exit(1)
+
+
+class GOMEZ_OT_distributed_bake(bpy.types.Operator):
+    """
+    Bake the rigged strokes splitting the frame range between background Blender processes
+    """
+    bl_idname = "greasepencil.distributed_bake"
+    bl_label = "Distributed bake"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    workers : IntProperty(name='workers',
+                          description='Number of background Blender processes',
+                          default=4, min=1, max=64)
+
+    frame_init : IntProperty(name='start frame',
+                             description="the frame to start applying the modifier",
+                             default=1, min=0, max=1000000)
+
+    frame_end : IntProperty(name='end frame',
+                            description="the frame to stop applying the modifier",
+                            default=1, min=0, max=1000000)
+
+    step : IntProperty(name='frame_step',
+                       description='step between baked steps',
+                       default=1,
+                       min=1,
+                       max=1000000)
+
+    bake_to_new_layer : BoolProperty(name='bake_to_new_layer',
+                                     description='Bake the stroke to new layer',
+                                     default=False)
+
+    to_point_cache : BoolProperty(name='to_point_cache',
+                                  description='Bake to an on-disk point cache instead of keyframes',
+                                  default=False)
+
+    offline : BoolProperty(name='offline',
+                           description='Evaluate the rig from the control bones animation instead of stepping the scene',
+                           default=False)
+
+    def invoke(self, context, event):
+        props = context.window_manager.gopo_prop_group
+
+        if props.bake_from_active_to_current:
+            gp_ob = props.gp_ob
+            self.frame_init = gp_ob.data.layers.active.active_frame.frame_number
+            self.frame_end = context.scene.frame_current
+        else:
+            self.frame_init = props.frame_init
+            self.frame_end =  props.frame_end
+        self.step = props.bake_step
+        self.bake_to_new_layer = props.bake_to_new_layer
+        self.offline = props.bake_offline
+        self.to_point_cache = props.bake_to_point_cache
+        self.workers = props.bake_workers
+
+        return self.execute(context)
+
+    def execute(self, context):
+        # The call stays open while the workers run, until finish or cancel
+        self._call = ExitStack()
+        self._profile = self._call.enter_context(operator_call(self.bl_idname))
+        result = self.run(context)
+        if result != {'RUNNING_MODAL'}:
+            self._call.close()
+        else:
+            # Timed again in the steps of modal
+            suspend_call(self._profile)
+        return result
+
+    def run(self, context):
+        props = context.window_manager.gopo_prop_group
+        if self.to_point_cache and props.point_cache_dir.startswith('//') and not bpy.data.filepath:
+            self.report({'ERROR'}, 'Save the file before baking to a relative point cache directory')
+            return {'CANCELLED'}
+
+        self._groups = sorted(get_bake_groups(context))
+        gp_ob = context.object
+        frames = list(range(self.frame_init, self.frame_end + 1, self.step))
+        if not (self._groups and frames):
+            return {'CANCELLED'}
+        self._gp_ob_name = gp_ob.name
+        # Layer names by index, the workers address the layers of the copy by index
+        self._layers = {idx: layer.info for idx, layer in enumerate(gp_ob.data.layers) if not layer.lock}
+
+        self._tmp_dir = tempfile.mkdtemp(prefix='gposer_bake_')
+        blend_path = os.path.join(self._tmp_dir, 'bake.blend')
+        # The workers start without the reduced viewport segments in use
+        with span('bake_save_copy'), full_resolution():
+            bpy.ops.wm.save_as_mainfile(filepath=blend_path, copy=True)
+
+        armature = props.ob_armature
+        worker_args = ['--gp-ob', gp_ob.name,
+                       '--armature', armature.name if armature else '',
+                       '--layers', *map(str, self._layers),
+                       '--groups', *map(str, self._groups),
+                       '--frame-current', str(context.scene.frame_current),
+                       '--step', str(self.step)]
+        if self.offline:
+            worker_args.append('--offline')
+            report_offline_fallbacks(self, gp_ob, armature, self._groups)
+        try:
+            self._workers = [BakeWorker(blend_path, os.path.join(self._tmp_dir, f'chunk_{idx}'), chunk, worker_args)
+                             for idx, chunk in enumerate(split_frames(frames, self.workers))]
+        except OSError as err:
+            self._workers = []
+            self.cancel(context)
+            self.report({'ERROR'}, f'Could not start the bake workers: {err}')
+            return {'CANCELLED'}
+
+        wm = context.window_manager
+        wm.progress_begin(0, len(self._workers))
+        if not context.window:
+            # Background mode: there's no event loop to poll from
+            for worker in self._workers:
+                worker.process.wait()
+            return self.finish(context)
+
+        self._timer = wm.event_timer_add(POLL_INTERVAL, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    @resumes_call
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.cancel(context)
+            self.report({'WARNING'}, 'Distributed bake cancelled')
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        done = [worker for worker in self._workers if worker.poll() is not None]
+        context.window_manager.progress_update(len(done))
+        if len(done) < len(self._workers) and not any(worker.failed() for worker in done):
+            return {'PASS_THROUGH'}
+        return self.finish(context)
+
+    def finish(self, context):
+        failed = [worker for worker in self._workers if worker.failed()]
+        if failed:
+            self.report({'ERROR'}, f'Bake of frames {failed[0].frames[0]}-{failed[0].frames[-1]} failed: '
+                        + failed[0].log_tail())
+            self.cancel(context)
+            return {'CANCELLED'}
+        with span('bake_merge'):
+            self.merge(context)
+        self.cancel(context)
+        return {'FINISHED'}
+
+    def merge(self, context):
+        """
+        Writes the chunks baked by the workers and removes the rigs
+        """
+        props = context.window_manager.gopo_prop_group
+        gp_ob = bpy.data.objects[self._gp_ob_name]
+        layers = []
+        for layer_idx, layer_name in self._layers.items():
+            layer = gp_ob.data.layers.get(layer_name)
+            if not layer:
+                continue
+            layers.append(layer)
+            if self.bake_to_new_layer:
+                target_layer = gp_ob.data.layers.new('baked_' + layer.info, set_active=False)
+            else:
+                target_layer = layer
+            for group_id in self._groups:
+                _, stroke = find_group_stroke(layer, group_id)
+                paths = [chunk_path(worker.directory, layer_idx, group_id) for worker in self._workers]
+                paths = [path for path in paths if os.path.exists(path)]
+                if not (stroke and paths):
+                    continue
+                baked_points = {}
+                for path in paths:
+                    baked_points.update(load_chunk(path))
+                store_baked_points(props, gp_ob, stroke, layer, target_layer, group_id,
+                                   baked_points, self.to_point_cache)
+
+        clean_baked_groups(context, layers, self._groups, self.frame_init, self.frame_end)
+
+    def cancel(self, context):
+        """
+        Stops the workers and removes the temporary files
+        """
+        for worker in getattr(self, '_workers', []):
+            worker.kill()
+        timer = getattr(self, '_timer', None)
+        if timer:
+            context.window_manager.event_timer_remove(timer)
+            self._timer = None
+        context.window_manager.progress_end()
+        shutil.rmtree(self._tmp_dir, ignore_errors=True)
+        call = getattr(self, '_call', None)
+        if call:
+            call.close()
+
+    @classmethod
+    def poll(cls, context):
+        if context.mode == 'POSE':
+            if context.active_pose_bone:
+                return True
+        if context.object:
+            if context.object.type == 'GPENCIL':
+                if context.object.data.layers.active:
+                    if context.object.data.layers.active.active_frame:
+                        return True
+
+        return False
+
+
+def register():
+    bpy.utils.register_class(GOMEZ_OT_distributed_bake)
+
+
+def unregister():
+    bpy.utils.unregister_class(GOMEZ_OT_distributed_bake)
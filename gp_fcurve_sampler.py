@@ -0,0 +1,221 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+from .gp_bone_registry import get_bone_registry
+
+# Interpolations sampled here, any other is left to fcurve.evaluate
+INTERPOLATIONS = {'CONSTANT': 0, 'LINEAR': 1, 'BEZIER': 2}
+OTHER_INTERPOLATION = -1
+# Bisection steps solving the bezier x(t) = frame, precision of 2**-steps in t
+BEZIER_STEPS = 24
+
+# Sampled values by action name: {'signature': ..., 'values': {(data_path, index, frames): array}}
+_cache = {}
+
+
+def keyframe_arrays(fcurve):
+    """
+    Keyframe coordinates, handles and interpolation codes of an fcurve as arrays
+    """
+    points = fcurve.keyframe_points
+    n = len(points)
+    arrays = []
+    for attr in ('co', 'handle_left', 'handle_right'):
+        values = np.empty(2 * n)
+        points.foreach_get(attr, values)
+        arrays.append(values.reshape(n, 2))
+    interpolation = np.array([INTERPOLATIONS.get(pt.interpolation, OTHER_INTERPOLATION) for pt in points])
+    return (*arrays, interpolation)
+
+
+def solve_bezier_t(x0, x1, x2, x3, x):
+    """
+    Parameter t in [0, 1] where the monotonic cubic bezier with x control
+    values x0..x3 reaches x, by vectorized bisection
+    """
+    low = np.zeros_like(x)
+    high = np.ones_like(x)
+    for _ in range(BEZIER_STEPS):
+        t = 0.5 * (low + high)
+        mt = 1.0 - t
+        value = mt**3*x0 + 3*mt**2*t*x1 + 3*mt*t**2*x2 + t**3*x3
+        below = value < x
+        low = np.where(below, t, low)
+        high = np.where(below, high, t)
+    return 0.5 * (low + high)
+
+
+def sample_keyframes(co, handle_left, handle_right, interpolation, frames):
+    """
+    Values of the keyframed curve at frames, with constant extrapolation.
+    Returns the values and a mask of the frames whose segment uses an
+    interpolation not handled here
+    """
+    frames = np.asarray(frames, dtype=float)
+    values = np.empty(len(frames))
+    unsupported = np.zeros(len(frames), dtype=bool)
+    if len(co) == 1:
+        values[:] = co[0, 1]
+        return values, unsupported
+
+    # Segment k goes from key k to key k+1
+    k = np.clip(np.searchsorted(co[:, 0], frames, side='right') - 1, 0, len(co) - 2)
+    a, b = co[k], co[k + 1]
+    width = b[:, 0] - a[:, 0]
+    u = np.clip(np.divide(frames - a[:, 0], width, out=np.zeros_like(frames), where=width > 0.0), 0.0, 1.0)
+    mode = interpolation[k]
+
+    values[:] = a[:, 1]
+    linear = mode == INTERPOLATIONS['LINEAR']
+    values[linear] = a[linear, 1] + u[linear] * (b[linear, 1] - a[linear, 1])
+
+    bezier = mode == INTERPOLATIONS['BEZIER']
+    if bezier.any():
+        a, b, seg_width, x = a[bezier], b[bezier], width[bezier], frames[bezier]
+        h1 = handle_right[k[bezier]] - a
+        h2 = handle_left[k[bezier] + 1] - b
+        # As Blender does, shorten the handles that overlap so that x grows along the segment
+        reach = np.abs(h1[:, 0]) + np.abs(h2[:, 0])
+        scale = np.where(reach > seg_width, np.divide(seg_width, reach, out=np.ones_like(reach), where=reach > 0.0), 1.0)
+        h1 *= scale[:, None]
+        h2 *= scale[:, None]
+        p1, p2 = a + h1, b + h2
+        t = solve_bezier_t(a[:, 0], p1[:, 0], p2[:, 0], b[:, 0], np.clip(x, a[:, 0], b[:, 0]))
+        mt = 1.0 - t
+        values[bezier] = mt**3*a[:, 1] + 3*mt**2*t*p1[:, 1] + 3*mt*t**2*p2[:, 1] + t**3*b[:, 1]
+
+    # Constant extrapolation outside the keys
+    values[frames <= co[0, 0]] = co[0, 1]
+    values[frames >= co[-1, 0]] = co[-1, 1]
+    inside = (frames > co[0, 0]) & (frames < co[-1, 0])
+    unsupported = inside & (mode == OTHER_INTERPOLATION)
+    return values, unsupported
+
+
+def sample_fcurve(fcurve, frames):
+    """
+    Values of the fcurve at every frame, evaluating the keyframes for all the frames at once.
+    Modifiers, linear extrapolation and the easing interpolations go through fcurve.evaluate
+    """
+    frames = np.asarray(frames, dtype=float)
+    if fcurve.modifiers or len(fcurve.keyframe_points) == 0:
+        return np.array([fcurve.evaluate(fr) for fr in frames])
+
+    co, handle_left, handle_right, interpolation = keyframe_arrays(fcurve)
+    values, fallback = sample_keyframes(co, handle_left, handle_right, interpolation, frames)
+    if fcurve.extrapolation == 'LINEAR':
+        fallback |= (frames < co[0, 0]) | (frames > co[-1, 0])
+    for idx in np.flatnonzero(fallback).tolist():
+        values[idx] = fcurve.evaluate(frames[idx])
+    return values
+
+
+def action_signature(action):
+    """
+    Cheap check of whether keys were added or removed since the action was sampled.
+    Moving keys is caught by the depsgraph handler
+    """
+    return (len(action.fcurves), sum(len(fcurve.keyframe_points) for fcurve in action.fcurves))
+
+
+def sample_action(action, data_path, index, frames):
+    """
+    Cached values of a channel of the action at frames, None if it isn't animated
+    """
+    fcurve = action.fcurves.find(data_path, index=index)
+    if fcurve is None or fcurve.mute:
+        return None
+    cache = _cache.get(action.name)
+    signature = action_signature(action)
+    if cache is None or cache['signature'] != signature:
+        cache = {'signature': signature, 'values': {}}
+        _cache[action.name] = cache
+
+    key = (data_path, index, tuple(frames))
+    values = cache['values'].get(key)
+    if values is None:
+        values = sample_fcurve(fcurve, frames)
+        cache['values'][key] = values
+    return values
+
+
+def sample_bones(armature, names, frames, props=('location', 'rotation_quaternion', 'rotation_euler', 'scale')):
+    """
+    Animated transform channels of the pose bones in names at every frame:
+    {bone name: {prop: (n_frames, size) array}}.  Channels without
+    fcurves hold the current pose value
+    """
+    anim = armature.animation_data
+    action = anim.action if anim else None
+    n = len(frames)
+    samples = {}
+    for name in names:
+        pbone = armature.pose.bones[name]
+        bone_samples = {}
+        for prop in props:
+            default = np.asarray(getattr(pbone, prop), dtype=float)
+            values = np.tile(default, (n, 1))
+            if action:
+                path = f'pose.bones["{name}"].{prop}'
+                for idx in range(len(default)):
+                    channel = sample_action(action, path, idx, frames)
+                    if channel is not None:
+                        values[:, idx] = channel
+            bone_samples[prop] = values
+        samples[name] = bone_samples
+    return samples
+
+
+def sample_stroke_bones(armature, group_id, frames):
+    """
+    Animated transform channels of all the gomez_poser bones of a rigged stroke
+    """
+    return sample_bones(armature, get_bone_registry(armature).names('ALL', group_id), frames)
+
+
+def invalidate_action(action):
+    _cache.pop(action.name, None)
+
+
+@persistent
+def sampler_depsgraph_update(scene, depsgraph):
+    # Keys moved or edited in the graph editor or the dopesheet
+    for update in depsgraph.updates:
+        if isinstance(update.id, bpy.types.Action):
+            invalidate_action(update.id)
+
+
+@persistent
+def sampler_load_pre(*args):
+    _cache.clear()
+
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(sampler_depsgraph_update)
+    bpy.app.handlers.load_pre.append(sampler_load_pre)
+
+
+def unregister():
+    bpy.app.handlers.depsgraph_update_post.remove(sampler_depsgraph_update)
+    bpy.app.handlers.load_pre.remove(sampler_load_pre)
+    _cache.clear()
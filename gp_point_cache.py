@@ -0,0 +1,232 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+import os
+import shutil
+import numpy as np
+from bpy.app.handlers import persistent
+from bpy.props import IntProperty, StringProperty, EnumProperty, FloatProperty
+from . import gp_delta_codec
+
+# Point attributes stored in a cache: (attribute, values per point)
+CACHE_ATTRIBUTES = (('co', 3), ('pressure', 1), ('strength', 1), ('vertex_color', 4))
+
+CACHE_ENCODINGS = [('FLOAT', 'Float', 'Float32 values of every frame'),
+                   ('DELTA', 'Delta', 'Quantized keyframes and int16 deltas between frames')]
+# Precision of the delta encoded attributes in the 0 to 1 range
+ATTRIBUTE_PRECISION = 1.0 / 4096.0
+
+# Open memory maps by cache directory
+_memmaps = {}
+
+
+class PointCacheItem(bpy.types.PropertyGroup):
+    """
+    A baked stroke stored on disk, displayed by a stroke in its own layer
+    """
+    directory: StringProperty(name='directory', subtype='DIR_PATH')
+    layer: StringProperty(name='layer',
+                          description='Layer of the display stroke')
+    group_id: IntProperty(name='group_id')
+    frame_start: IntProperty(name='frame_start')
+    step: IntProperty(name='step', default=1)
+    num_frames: IntProperty(name='num_frames')
+    num_points: IntProperty(name='num_points')
+    encoding: EnumProperty(name='encoding', items=CACHE_ENCODINGS, default='FLOAT')
+    precision: FloatProperty(name='precision',
+                             description='Precision of the delta encoded coordinates')
+
+
+def cache_path(directory, attribute):
+    return os.path.join(bpy.path.abspath(directory), attribute + '.npy')
+
+
+def write_point_cache(gp_ob, stroke, group_id, baked_points, directory, encoding='FLOAT', precision=1.0e-4):
+    """
+    Writes the baked points, {frame: [(co, strength, pressure, vertex_color)]},
+    to files in directory, as float32 arrays or delta encoded with the given
+    precision, and adds a layer with the stroke that displays them.
+    Returns the cache item
+    """
+    frames = sorted(baked_points)
+    num_points = len(stroke.points)
+    abs_directory = bpy.path.abspath(directory)
+    close_point_cache(directory)
+    shutil.rmtree(abs_directory, ignore_errors=True)
+    os.makedirs(abs_directory, exist_ok=True)
+
+    buffers = {attribute: np.empty((len(frames), num_points, size), dtype=np.float32)
+               for attribute, size in CACHE_ATTRIBUTES}
+    for idx, fr in enumerate(frames):
+        co, strength, pressure, vertex_color = zip(*baked_points[fr])
+        buffers['co'][idx] = co
+        buffers['strength'][idx, :, 0] = strength
+        buffers['pressure'][idx, :, 0] = pressure
+        buffers['vertex_color'][idx] = vertex_color
+    for attribute, values in buffers.items():
+        if encoding == 'DELTA':
+            attribute_precision = precision if attribute == 'co' else ATTRIBUTE_PRECISION
+            gp_delta_codec.save(abs_directory, attribute, gp_delta_codec.encode(values, attribute_precision))
+        else:
+            np.save(cache_path(directory, attribute), values)
+    del buffers
+
+    layer_name = 'cache_' + os.path.basename(os.path.normpath(abs_directory))
+    layer = gp_ob.data.layers.get(layer_name) or gp_ob.data.layers.new(layer_name, set_active=False)
+    for frame in list(layer.frames):
+        layer.frames.remove(frame)
+    display = layer.frames.new(frames[0]).strokes.new()
+    display.points.add(num_points)
+    display.line_width = stroke.line_width
+    display.material_index = stroke.material_index
+    display.vertex_color_fill = stroke.vertex_color_fill
+
+    caches = gp_ob.data.gposer_point_caches
+    item = caches.get(layer_name) or caches.add()
+    item.name = layer_name
+    item.directory = directory
+    item.layer = layer_name
+    item.group_id = group_id
+    item.frame_start = frames[0]
+    item.step = frames[1] - frames[0] if len(frames) > 1 else 1
+    item.num_frames = len(frames)
+    item.num_points = num_points
+    item.encoding = encoding
+    item.precision = precision
+    return item
+
+
+def open_point_cache(item):
+    """
+    Read only memory maps of the attributes of a cache,
+    the encoded sequences for delta encoded caches
+    """
+    memmaps = _memmaps.get(item.directory)
+    if memmaps is None:
+        if item.encoding == 'DELTA':
+            abs_directory = bpy.path.abspath(item.directory)
+            memmaps = {attribute: gp_delta_codec.load(abs_directory, attribute)
+                       for attribute, _ in CACHE_ATTRIBUTES}
+        else:
+            memmaps = {attribute: np.load(cache_path(item.directory, attribute), mmap_mode='r')
+                       for attribute, _ in CACHE_ATTRIBUTES}
+        _memmaps[item.directory] = memmaps
+    return memmaps
+
+
+def close_point_cache(directory):
+    _memmaps.pop(directory, None)
+
+
+def display_stroke(gp_ob, item):
+    layer = gp_ob.data.layers.get(item.layer)
+    if not layer or not layer.frames or not layer.frames[0].strokes:
+        return None
+    return layer.frames[0].strokes[0]
+
+
+def show_cached_frame(gp_ob, item, frame_number):
+    """
+    Copies the points cached for frame_number (held outside the baked range)
+    into the display stroke.  Only that frame is read from disk
+    """
+    stroke = display_stroke(gp_ob, item)
+    if stroke is None or len(stroke.points) != item.num_points:
+        return
+    try:
+        memmaps = open_point_cache(item)
+    except OSError:
+        return
+    idx = min(max((frame_number - item.frame_start) // item.step, 0), item.num_frames - 1)
+    for attribute, _ in CACHE_ATTRIBUTES:
+        if item.encoding == 'DELTA':
+            values = gp_delta_codec.decode_frame(memmaps[attribute], idx)
+        else:
+            values = np.ascontiguousarray(memmaps[attribute][idx])
+        stroke.points.foreach_set(attribute, values.ravel())
+
+
+def remove_point_cache(gp_ob, item):
+    """
+    Deletes the cache files, its display layer and its item
+    """
+    close_point_cache(item.directory)
+    layer = gp_ob.data.layers.get(item.layer)
+    if layer:
+        gp_ob.data.layers.remove(layer)
+    shutil.rmtree(bpy.path.abspath(item.directory), ignore_errors=True)
+    caches = gp_ob.data.gposer_point_caches
+    caches.remove(caches.find(item.name))
+
+
+@persistent
+def stream_point_caches(scene, *args):
+    for ob in scene.objects:
+        if ob.type != 'GPENCIL' or not ob.data.gposer_point_caches:
+            continue
+        for item in ob.data.gposer_point_caches:
+            show_cached_frame(ob, item, scene.frame_current)
+        ob.data.update_tag()
+
+
+@persistent
+def point_cache_load_pre(*args):
+    _memmaps.clear()
+
+
+class GOMEZ_OT_remove_point_cache(bpy.types.Operator):
+    """
+    Delete a point cache and its display layer
+    """
+    bl_idname = "greasepencil.remove_point_cache"
+    bl_label = "Remove point cache"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    cache_name: StringProperty(name='cache_name')
+
+    def execute(self, context):
+        gp_ob = context.window_manager.gopo_prop_group.gp_ob
+        item = gp_ob.data.gposer_point_caches.get(self.cache_name)
+        if not item:
+            return {'CANCELLED'}
+        remove_point_cache(gp_ob, item)
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return context.window_manager.gopo_prop_group.gp_ob
+
+
+def register():
+    bpy.utils.register_class(PointCacheItem)
+    bpy.utils.register_class(GOMEZ_OT_remove_point_cache)
+    bpy.types.GreasePencil.gposer_point_caches = bpy.props.CollectionProperty(type=PointCacheItem)
+    bpy.app.handlers.frame_change_pre.append(stream_point_caches)
+    bpy.app.handlers.load_pre.append(point_cache_load_pre)
+
+
+def unregister():
+    bpy.app.handlers.frame_change_pre.remove(stream_point_caches)
+    bpy.app.handlers.load_pre.remove(point_cache_load_pre)
+    del bpy.types.GreasePencil.gposer_point_caches
+    bpy.utils.unregister_class(GOMEZ_OT_remove_point_cache)
+    bpy.utils.unregister_class(PointCacheItem)
+    _memmaps.clear()
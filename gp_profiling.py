@@ -0,0 +1,292 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+import csv
+import functools
+import json
+from collections import deque
+from contextlib import contextmanager
+from time import perf_counter
+from bpy.app.handlers import persistent
+from bpy.props import EnumProperty, StringProperty
+
+# Operator calls kept in memory
+MAX_CALLS = 200
+
+_enabled = False
+# Recorded calls: {'operator', 'start', 'duration', 'spans': [(name, depth, duration)]}
+_calls = []
+_current_call = None
+_depth = 0
+
+
+def set_enabled(value):
+    global _enabled
+    _enabled = value
+
+
+def is_enabled():
+    return _enabled
+
+
+@contextmanager
+def operator_call(name):
+    """
+    Collects the spans timed during an operator call, yields the call.
+    Does nothing, and yields None, unless profiling is enabled
+    """
+    global _current_call, _depth
+    if not _enabled or _current_call is not None:
+        yield None
+        return
+
+    call = _current_call = {'operator': name, 'start': perf_counter(), 'duration': 0.0, 'spans': []}
+    _depth = 0
+    try:
+        yield call
+    finally:
+        if _current_call is call:
+            _current_call = None
+            _depth = 0
+        call['duration'] = perf_counter() - call['start']
+        _calls.append(call)
+        del _calls[:-MAX_CALLS]
+
+
+def suspend_call(call):
+    """
+    Stops timing spans for call, an operator call left open while a modal job
+    runs, so that the operators running between its steps don't add theirs
+    """
+    global _current_call, _depth
+    if call is not None and _current_call is call:
+        _current_call = None
+        _depth = 0
+
+
+@contextmanager
+def resumed_call(call):
+    """
+    Times the spans of the block for call, suspended between the steps of a modal job
+    """
+    global _current_call, _depth
+    if call is None or _current_call is not None:
+        yield
+        return
+
+    _current_call = call
+    _depth = 0
+    try:
+        yield
+    finally:
+        suspend_call(call)
+
+
+def resumes_call(modal):
+    """
+    Decorates the modal method of an operator whose call, stored in its
+    _profile, stays open between the steps of the job
+    """
+    @functools.wraps(modal)
+    def wrapper(self, context, event):
+        with resumed_call(getattr(self, '_profile', None)):
+            return modal(self, context, event)
+    return wrapper
+
+
+@contextmanager
+def span(name):
+    """
+    Times a stage of an operator call
+    """
+    global _depth
+    if not _enabled or _current_call is None:
+        yield
+        return
+
+    call = _current_call
+    depth = _depth
+    _depth += 1
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        _depth -= 1
+        call['spans'].append((name, depth, perf_counter() - start))
+
+
+# Frames kept by the playback timer
+MAX_FRAMES = 250
+
+_frame_start = None
+# Duration of the last frame changes, from frame_change_pre to frame_change_post
+_frame_times = deque(maxlen=MAX_FRAMES)
+# Lists collecting frame times for frame_timer blocks
+_recordings = []
+
+
+@persistent
+def frame_timer_pre(scene, *args):
+    global _frame_start
+    _frame_start = perf_counter()
+
+
+@persistent
+def frame_timer_post(scene, *args):
+    global _frame_start
+    if _frame_start is not None:
+        duration = perf_counter() - _frame_start
+        _frame_times.append(duration)
+        for recorded in _recordings:
+            recorded.append(duration)
+        _frame_start = None
+
+
+def set_frame_timer(value):
+    """
+    Adds or removes the frame change handlers that time the evaluation of every frame
+    """
+    handlers = bpy.app.handlers
+    running = frame_timer_pre in handlers.frame_change_pre
+    if value and not running:
+        handlers.frame_change_pre.append(frame_timer_pre)
+        handlers.frame_change_post.append(frame_timer_post)
+    elif not value and running:
+        handlers.frame_change_pre.remove(frame_timer_pre)
+        handlers.frame_change_post.remove(frame_timer_post)
+
+
+@contextmanager
+def frame_timer():
+    """
+    Collects the duration of the frame changes made inside the block
+    in the yielded list
+    """
+    was_running = frame_timer_pre in bpy.app.handlers.frame_change_pre
+    set_frame_timer(True)
+    recorded = []
+    _recordings.append(recorded)
+    try:
+        yield recorded
+    finally:
+        _recordings.remove(recorded)
+        set_frame_timer(was_running)
+
+
+def get_frame_times():
+    return _frame_times
+
+
+def get_calls():
+    return _calls
+
+
+def clear():
+    _calls.clear()
+
+
+def summarize(call):
+    """
+    Total time and count of every span name in a call, slowest first
+    """
+    totals = {}
+    for name, depth, duration in call['spans']:
+        total, count = totals.get(name, (0.0, 0))
+        totals[name] = (total + duration, count + 1)
+    return sorted(((name, total, count) for name, (total, count) in totals.items()),
+                  key=lambda item: item[1], reverse=True)
+
+
+def dump_json(path):
+    with open(path, 'w') as f:
+        json.dump(_calls, f, indent=1)
+
+
+def dump_csv(path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['call', 'operator', 'span', 'depth', 'duration'])
+        for idx, call in enumerate(_calls):
+            writer.writerow([idx, call['operator'], '', 0, call['duration']])
+            for name, depth, duration in call['spans']:
+                writer.writerow([idx, call['operator'], name, depth + 1, duration])
+
+
+class GOMEZ_OT_profile_dump(bpy.types.Operator):
+    """
+    Save the recorded timings to a file
+    """
+    bl_idname = "wm.gposer_profile_dump"
+    bl_label = "Save timings"
+
+    filepath: StringProperty(subtype='FILE_PATH')
+    file_format: EnumProperty(name='format',
+                              items=[('JSON', 'JSON', ''), ('CSV', 'CSV', '')],
+                              default='JSON')
+
+    def invoke(self, context, event):
+        context.window_manager.fileselect_add(self)
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        path = bpy.path.abspath(self.filepath)
+        if self.file_format == 'JSON':
+            dump_json(path)
+        else:
+            dump_csv(path)
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        return bool(_calls)
+
+
+class GOMEZ_OT_profile_clear(bpy.types.Operator):
+    """
+    Discard the recorded timings
+    """
+    bl_idname = "wm.gposer_profile_clear"
+    bl_label = "Clear timings"
+
+    def execute(self, context):
+        clear()
+        return {'FINISHED'}
+
+
+@persistent
+def profiling_load_pre(*args):
+    # Loading a file drops the modal jobs without ending their calls
+    global _current_call, _depth
+    _current_call = None
+    _depth = 0
+
+
+def register():
+    bpy.utils.register_class(GOMEZ_OT_profile_dump)
+    bpy.utils.register_class(GOMEZ_OT_profile_clear)
+    bpy.app.handlers.load_pre.append(profiling_load_pre)
+
+
+def unregister():
+    bpy.app.handlers.load_pre.remove(profiling_load_pre)
+    set_frame_timer(False)
+    bpy.utils.unregister_class(GOMEZ_OT_profile_dump)
+    bpy.utils.unregister_class(GOMEZ_OT_profile_clear)
@@ -23,6 +23,7 @@ from bpy.props import FloatProperty, IntProperty, FloatVectorProperty, BoolPrope
 from math import log
 from .gp_armature_applier import remove_vertex_groups
 from .gp_rigging_ops import add_vertex_groups, add_weights
+from .gp_profiling import span, operator_call
 
 
 def get_group_to_resample(context, gp_ob=None):
@@ -104,6 +105,10 @@ class GOMEZ_OT_resample_rigged(bpy.types.Operator):
 
     
     def execute(self, context):
+        with operator_call(self.bl_idname):
+            return self.run(context)
+
+    def run(self, context):
         group_id = get_group_to_resample(context)
         gp_ob = context.window_manager.gopo_prop_group.gp_ob
         if not group_id:
@@ -120,21 +125,23 @@ class GOMEZ_OT_resample_rigged(bpy.types.Operator):
         bpy.ops.gpencil.select_all(action='DESELECT')
         stroke = self.get_stroke_to_resample(context, group_id)
         
-        for idx, times in reversed(indices):
-            first_point = stroke.points[idx]
-            second_point = stroke.points[idx + 1]
-            first_point.select = True
-            second_point.select = True
-            for _ in range(times):
-                bpy.ops.gpencil.stroke_subdivide()
-            bpy.ops.gpencil.select_all(action='DESELECT')
+        with span('subdivide'):
+            for idx, times in reversed(indices):
+                first_point = stroke.points[idx]
+                second_point = stroke.points[idx + 1]
+                first_point.select = True
+                second_point.select = True
+                for _ in range(times):
+                    bpy.ops.gpencil.stroke_subdivide()
+                bpy.ops.gpencil.select_all(action='DESELECT')
 
         # vertex groups need to be rebuilt    
-        remove_vertex_groups(gp_ob, group_id, is_resampling=True)
-        
         armature = context.window_manager.gopo_prop_group.ob_armature
-        add_vertex_groups(context, gp_ob,armature, bone_group=group_id )
-        add_weights(context,gp_ob, stroke, bone_group=group_id)
+        with span('vertex_groups'):
+            remove_vertex_groups(gp_ob, group_id, is_resampling=True)
+            add_vertex_groups(context, gp_ob,armature, bone_group=group_id )
+        with span('weights'):
+            add_weights(context,gp_ob, stroke, bone_group=group_id)
 
         if original_mode== 'POSE':
             bpy.ops.object.mode_set(mode='OBJECT')
@@ -0,0 +1,289 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from time import perf_counter
+from bpy.props import IntProperty
+from .gp_bone_registry import get_bone_registry
+from .gp_armature_applier import get_stroke_armature_mod, get_shared_armature_mod, driver_bone_name, set_rig_muted
+from .gp_profiling import frame_timer
+from .gp_culling import culling_suspended
+
+REPORT_TEXT = 'gposer_rig_report'
+TIMING_TEXT = 'gposer_rig_timing'
+# Strokes listed as worst offenders
+WORST_COUNT = 10
+
+COLUMNS = ('stroke', 'deform', 'ctrl', 'handle', 'segments', 'drivers',
+           'py_drivers', 'constraints', 'vgroups', 'arm_mods', 'points')
+
+def driver_counts(armature):
+    """
+    Number of drivers and of Python drivers by bone name
+    """
+    counts = {}
+    if not armature.animation_data:
+        return counts
+    for fcurve in armature.animation_data.drivers:
+        name = driver_bone_name(fcurve)
+        if not name:
+            continue
+        driver = fcurve.driver
+        is_python = driver.type == 'SCRIPTED' and not driver.is_simple_expression
+        total, python = counts.get(name, (0, 0))
+        counts[name] = (total + 1, python + int(is_python))
+    return counts
+
+
+def stroke_point_counts(gp_ob):
+    """
+    Number of points of the rigged strokes by bone group
+    """
+    counts = {}
+    for layer in gp_ob.data.layers:
+        for frame in layer.frames:
+            for stroke in frame.strokes:
+                if stroke.bone_groups:
+                    counts[stroke.bone_groups] = counts.get(stroke.bone_groups, 0) + len(stroke.points)
+    return counts
+
+
+def rig_stats(gp_ob, armature):
+    """
+    Returns a dict per rigged_stroke with the counts in COLUMNS
+    """
+    registry = get_bone_registry(armature)
+    pbones = armature.pose.bones
+    drivers = driver_counts(armature)
+    points = stroke_point_counts(gp_ob)
+    vgroups = {}
+    for vgroup in gp_ob.vertex_groups:
+        if vgroup.bone_group:
+            vgroups[vgroup.bone_group] = vgroups.get(vgroup.bone_group, 0) + 1
+
+    stats = []
+    for group_id in sorted(registry.strokes()):
+        deform = registry.names('DEFORM', group_id)
+        all_bones = registry.names('ALL', group_id)
+        stats.append({
+            'stroke': group_id,
+            'deform': len(deform),
+            'ctrl': len(registry.names('CTRL', group_id)),
+            'handle': len(registry.names('HANDLE', group_id)),
+            'segments': sum(pbones[name].bone.bbone_segments for name in deform),
+            'drivers': sum(drivers.get(name, (0, 0))[0] for name in all_bones),
+            'py_drivers': sum(drivers.get(name, (0, 0))[1] for name in all_bones),
+            'constraints': sum(len(pbones[name].constraints) for name in all_bones),
+            'vgroups': vgroups.get(group_id, 0),
+            'arm_mods': 1 if get_stroke_armature_mod(gp_ob, group_id) else 0,
+            'points': points.get(group_id, 0),
+        })
+    return stats
+
+
+def time_playback(context, num_frames):
+    """
+    Average time in seconds of evaluating num_frames frames from the current one
+    """
+    scene = context.scene
+    current = scene.frame_current
+    start = perf_counter()
+    for fr in range(current, current + num_frames):
+        scene.frame_set(fr)
+    elapsed = perf_counter() - start
+    scene.frame_set(current)
+    return elapsed / max(1, num_frames)
+
+
+def time_frame_range(context, frame_start, frame_end):
+    """
+    Average evaluation time of the frames in the range, measured by the frame change handlers
+    """
+    scene = context.scene
+    with frame_timer() as frame_times:
+        for fr in range(frame_start, frame_end + 1):
+            scene.frame_set(fr)
+    return sum(frame_times) / max(1, len(frame_times))
+
+
+def rig_timings(context, gp_ob, armature, frame_start, frame_end):
+    """
+    Returns the average frame time with every rig enabled, with every rig muted
+    and the time saved by muting each rigged_stroke alone, most expensive first.
+    Culling is suspended while measuring and the rigs it mutes are muted again after
+    """
+    scene = context.scene
+    current = scene.frame_current
+    group_ids = sorted(get_bone_registry(armature).strokes())
+
+    with culling_suspended(scene):
+        # Evaluate once so that the first measurement isn't paying for the first evaluation
+        scene.frame_set(frame_start)
+        baseline = time_frame_range(context, frame_start, frame_end)
+
+        costs = []
+        for group_id in group_ids:
+            set_rig_muted(gp_ob, armature, group_id, True)
+            try:
+                muted = time_frame_range(context, frame_start, frame_end)
+            finally:
+                set_rig_muted(gp_ob, armature, group_id, False)
+            costs.append((group_id, baseline - muted))
+
+        for group_id in group_ids:
+            set_rig_muted(gp_ob, armature, group_id, True)
+        try:
+            all_muted = time_frame_range(context, frame_start, frame_end)
+        finally:
+            for group_id in group_ids:
+                set_rig_muted(gp_ob, armature, group_id, False)
+
+        scene.frame_set(current)
+    costs.sort(key=lambda item: item[1], reverse=True)
+    return baseline, all_muted, costs
+
+
+def format_table(rows, columns=COLUMNS):
+    """
+    Fixed width text table
+    """
+    widths = [max(len(col), *(len(str(row[col])) for row in rows)) for col in columns]
+    lines = ['  '.join(col.rjust(w) for col, w in zip(columns, widths))]
+    for row in rows:
+        lines.append('  '.join(str(row[col]).rjust(w) for col, w in zip(columns, widths)))
+    return lines
+
+
+def write_report(lines, text_name=REPORT_TEXT):
+    """
+    Writes the report to a text datablock
+    """
+    text = bpy.data.texts.get(text_name) or bpy.data.texts.new(text_name)
+    text.clear()
+    text.write('\n'.join(lines) + '\n')
+    return text
+
+
+class GOMEZ_OT_rig_cost_report(bpy.types.Operator):
+    """
+    Report bones, drivers, constraints, vertex groups and points of every rigged stroke
+    """
+    bl_idname = "greasepencil.rig_cost_report"
+    bl_label = "Rig cost report"
+
+    sample_frames: IntProperty(name='sample_frames',
+                               description='Frames evaluated to time playback (0 to skip)',
+                               default=10,
+                               min=0)
+
+    def execute(self, context):
+        props = context.window_manager.gopo_prop_group
+        gp_ob = props.gp_ob
+        armature = props.ob_armature
+        stats = rig_stats(gp_ob, armature)
+        if not stats:
+            self.report({'INFO'}, 'No rigged strokes')
+            return {'CANCELLED'}
+
+        totals = {col: sum(row[col] for row in stats) for col in COLUMNS[1:]}
+        totals['stroke'] = 'total'
+        totals['arm_mods'] = len([mod for mod in gp_ob.grease_pencil_modifiers
+                                  if mod.type == 'GP_ARMATURE'])
+        worst = sorted(stats, key=lambda row: (row['py_drivers'], row['segments'], row['points']),
+                       reverse=True)[:WORST_COUNT]
+
+        lines = [f'Rig cost report: {gp_ob.name} / {armature.name}', '']
+        lines += format_table(stats + [totals])
+        lines += ['', 'Worst offenders (python drivers, bbone segments, points):']
+        lines += format_table(worst)
+        if self.sample_frames:
+            frame_time = time_playback(context, self.sample_frames)
+            lines += ['', f'Playback: {frame_time*1000:.2f} ms per frame '
+                      f'({1.0/frame_time if frame_time else 0.0:.1f} fps) over {self.sample_frames} frames']
+        write_report(lines)
+
+        self.report({'INFO'}, f"{len(stats)} rigs, {totals['deform']} deform bones, "
+                    f"{totals['py_drivers']} python drivers. See text '{REPORT_TEXT}'")
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        props = context.window_manager.gopo_prop_group
+        return props.gp_ob and props.ob_armature
+
+
+class GOMEZ_OT_rig_playback_timing(bpy.types.Operator):
+    """
+    Time the frame range with every rig enabled and with each rigged stroke muted in turn
+    """
+    bl_idname = "greasepencil.rig_playback_timing"
+    bl_label = "Time rigs playback"
+
+    frame_start: IntProperty(name='frame_start', default=1)
+    frame_end: IntProperty(name='frame_end', default=24)
+
+    def invoke(self, context, event):
+        self.frame_start = context.scene.frame_start
+        self.frame_end = context.scene.frame_end
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        props = context.window_manager.gopo_prop_group
+        gp_ob = props.gp_ob
+        armature = props.ob_armature
+        if self.frame_end < self.frame_start:
+            self.report({'ERROR'}, 'Empty frame range')
+            return {'CANCELLED'}
+
+        baseline, all_muted, costs = rig_timings(context, gp_ob, armature,
+                                                 self.frame_start, self.frame_end)
+        rows = [{'stroke': group_id, 'ms_per_frame': f'{cost*1000:.3f}',
+                 'share': f'{100*cost/baseline if baseline else 0.0:.1f}%'}
+                for group_id, cost in costs]
+        lines = [f'Rig playback timing: {gp_ob.name} / {armature.name}, '
+                 f'frames {self.frame_start}-{self.frame_end}',
+                 f'All rigs enabled: {baseline*1000:.3f} ms per frame',
+                 f'All rigs muted: {all_muted*1000:.3f} ms per frame',
+                 '']
+        if rows:
+            lines += format_table(rows, ('stroke', 'ms_per_frame', 'share'))
+        if get_shared_armature_mod(gp_ob, armature):
+            lines += ['', 'The armature modifier is shared: muted strokes still deform, '
+                      'only their bones stop evaluating']
+        write_report(lines, TIMING_TEXT)
+
+        self.report({'INFO'}, f'{baseline*1000:.2f} ms per frame, '
+                    f'{(baseline - all_muted)*1000:.2f} ms in rigs. See text \'{TIMING_TEXT}\'')
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        props = context.window_manager.gopo_prop_group
+        return props.gp_ob and props.ob_armature
+
+
+def register():
+    bpy.utils.register_class(GOMEZ_OT_rig_cost_report)
+    bpy.utils.register_class(GOMEZ_OT_rig_playback_timing)
+
+
+def unregister():
+    bpy.utils.unregister_class(GOMEZ_OT_rig_cost_report)
+    bpy.utils.unregister_class(GOMEZ_OT_rig_playback_timing)
@@ -18,14 +18,22 @@ Created by Marcelo Demian Gómez
     along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 import bpy
-# from line_profiler import LineProfiler
 
-from mathutils import Vector, Matrix, kdtree
+from mathutils import Vector, Matrix
 
-from bpy.props import FloatProperty, IntProperty, FloatVectorProperty, BoolProperty, PointerProperty, CollectionProperty, StringProperty
+from bpy.props import FloatProperty, IntProperty, FloatVectorProperty, BoolProperty, PointerProperty, CollectionProperty, StringProperty, EnumProperty
 from . import gp_auxiliary_objects
-
-# profile = LineProfiler()
+from . import gp_weights
+from . import gp_bone_budget
+from .gp_armature_applier import get_shared_armature_mod, has_stroke_armature_mods, clean_baked
+from .gp_armature_applier import begin_modal_job, run_job_slice, update_modal_job, end_modal_job, job_event_result
+from .gp_bone_registry import invalidate_bone_registry
+from .gp_stroke_kdtree import get_points_co, get_stroke_kdtree, find_nearest_indices
+from .gp_bbone_lod import refresh_lod
+from .gp_profiling import span, operator_call, resumes_call
+
+EASE_MODES = [('SCRIPTED', 'Driven', 'Ease drivers, a simple expression Blender evaluates without Python'),
+              ('STATIC', 'Static', 'Fixed ease, no drivers')]
 
 def is_bone_type(bone, bonetype):
 
@@ -53,67 +61,94 @@ def get_bone(bones, rigged_stroke, bone_type, bone_order):
             return b
 
 
-def add_driver(context, i, def_bone, handle_start, handle_end, group_id):
+def ease_expression(rest_distance, rest_ease):
+    """
+    Expression of an ease driver: the ease grows with the distance
+    from the handle to the bone, and is 0 in the rest position.
+    Blender's simple expression evaluator handles it, without Python
+    """
+    return f'(varname-{rest_distance})*{rest_ease}/{rest_distance} '
+
+
+def add_ease_driver(armature, path, bone_a, bone_b, rest_distance, rest_ease):
+    """
+    Drives an ease property by the distance between two bones
+    """
+    driver = armature.driver_add(path).driver
+    driver.type = 'SCRIPTED'
+    driver.use_self = False
+    variable = driver.variables.new()
+    variable.type = 'LOC_DIFF'
+    variable.name = 'varname'
+    variable.targets[0].id = armature
+    variable.targets[0].bone_target = bone_a
+    variable.targets[1].id = armature
+    variable.targets[1].bone_target = bone_b
+
+    driver.expression = ease_expression(rest_distance, rest_ease)
+
+
+def add_driver(context, i, def_bone, handle_start, handle_end, group_id, ease_mode=None):
     ''' Add drivers to ease properties of deform bone '''
     
-    num_bones = context.window_manager.gopo_prop_group.num_bones
     armature = context.window_manager.gopo_prop_group.ob_armature
     deform_name = def_bone.name
+    if ease_mode is None:
+        ease_mode = context.window_manager.gopo_prop_group.ease_mode
+    if ease_mode == 'STATIC':
+        return
 
-
-    # TODO: this looks dangerous: the bones passed to this function are posebones
     # distance in editmode
+    rest_bones = armature.data.bones
     if handle_start:
-        edit_distance_handle_start = (handle_start.head - def_bone.head).length
+        edit_distance_handle_start = (rest_bones[handle_start.name].head_local -
+                                      rest_bones[deform_name].head_local).length
     
         # ease in
         path_ease_in = f'pose.bones[\"{deform_name}\"].bbone_easein'
         edit_easein = armature.data.bones[deform_name].bbone_easein
 
         # add driver easein
-        driver = armature.driver_add(path_ease_in).driver
-        variable = driver.variables.new()
-        variable.type = 'LOC_DIFF'
-        variable.name = 'varname'
-        variable.targets[0].id = armature
-        variable.targets[0].bone_target = def_bone.name
-        variable.targets[1].id = armature
-        variable.targets[1].bone_target = handle_start.name
-
-        driver.expression = f'(varname-{edit_distance_handle_start})*{edit_easein}/{edit_distance_handle_start} '
+        if edit_distance_handle_start:
+            add_ease_driver(armature, path_ease_in, def_bone.name, handle_start.name,
+                            edit_distance_handle_start, edit_easein)
 
     if handle_end:
-        edit_distance_handle_end = (handle_end.head - def_bone.tail).length
+        edit_distance_handle_end = (rest_bones[handle_end.name].head_local -
+                                    rest_bones[deform_name].tail_local).length
         # ease out
         ctrl_bone = get_bone(armature.pose.bones, group_id, 'CTRL', i+1 )
         path_ease_out = f'pose.bones[\"{deform_name}\"].bbone_easeout'
         edit_easeout = armature.data.bones[deform_name].bbone_easeout
 
         # add driver easeout
-        driver = armature.driver_add(path_ease_out).driver
-        variable = driver.variables.new()
-        variable.type = 'LOC_DIFF'
-        variable.name = 'varname'
-        variable.targets[0].id = armature
-        variable.targets[0].bone_target = ctrl_bone.name
-        variable.targets[1].id = armature
-        variable.targets[1].bone_target = handle_end.name
+        if edit_distance_handle_end:
+            add_ease_driver(armature, path_ease_out, ctrl_bone.name, handle_end.name,
+                            edit_distance_handle_end, edit_easeout)
 
-        driver.expression = f'(varname-{edit_distance_handle_end})*{edit_easeout}/{edit_distance_handle_end} '
 
+def remove_ease_drivers(armature, def_bone_name):
+    """
+    Removes the ease drivers of a deform bone
+    """
+    for prop in ('bbone_easein', 'bbone_easeout'):
+        armature.driver_remove(f'pose.bones["{def_bone_name}"].{prop}')
 
 
-def bname(context, i, role='deform', side=None):
+def bname(context, i, role='deform', side=None, group_id=None):
     """
     Returns the name of a bone taking into account bone_group, role, index, and side
     """
-    bone_groups = context.window_manager.gopo_prop_group.gp_ob.data.current_bone_group
+    if group_id is None:
+        bone_groups = context.window_manager.gopo_prop_group.gp_ob.data.current_bone_group
+    else:
+        bone_groups = group_id
     name = '_'.join(str(a)
                     for a in [role, side, bone_groups, i] if a is not None)
     return name
 
 
-def rig_ease(context, armature, i, group_id):
+def rig_ease(context, armature, i, group_id, ease_mode=None):
     """
     Adds drivers to the ease parameters of the deform bones
     driving them by the scale of the controls
@@ -125,7 +160,19 @@ def rig_ease(context, armature, i, group_id):
         def_bone = get_bone(armature.pose.bones, group_id, 'DEFORM', i)  
         handle_start = get_bone(armature.pose.bones, group_id, 'HANDLE_RIGHT', i)  
         handle_end = get_bone(armature.pose.bones, group_id, 'HANDLE_LEFT', i)  
-        add_driver(context, i, def_bone, handle_start, handle_end, group_id)
+        add_driver(context, i, def_bone, handle_start, handle_end, group_id, ease_mode)
+
+
+def set_ease_mode(context, armature, group_id, ease_mode):
+    """
+    Rebuilds the ease drivers of a rigged stroke with another ease_mode
+    """
+    deform_bones = [b for b in armature.data.bones if b.poser_deform and b.rigged_stroke == group_id]
+    props = context.window_manager.gopo_prop_group
+    props.num_bones = len(deform_bones)
+    for bone in deform_bones:
+        remove_ease_drivers(armature, bone.name)
+        rig_ease(context, armature, bone.bone_order, group_id, ease_mode)
 
 
 def get_stroke_index(context, gp_ob):
@@ -147,20 +194,16 @@ def get_stroke_index(context, gp_ob):
 def change_context(context, ob, obtype='GPENCIL'):
     """
     Modificar el contexto para cambiar los pesos
-    de los vertex groups de grease pencil
+    de los vertex groups de grease pencil.
+    Without a 3D view (background mode) no area is set
     """
-    for area in context.screen.areas:
-        if area.type == "VIEW_3D":
-            break
-    for region in area.regions:
-        if region.type == "WINDOW":
-            break
-
-    space = area.spaces[0]
     con = context.copy()
-    con['area'] = area
-    con['region'] = region
-    con['space_data'] = space
+    screen = context.screen
+    area = next((area for area in screen.areas if area.type == "VIEW_3D"), None) if screen else None
+    if area:
+        con['area'] = area
+        con['region'] = next((region for region in area.regions if region.type == "WINDOW"), None)
+        con['space_data'] = area.spaces[0]
     if obtype == 'GPENCIL':
         con['active_gpencil_frame'] = ob.data.layers.active.active_frame
         con['editable_gpencil_layers'] = ob.data.layers
@@ -190,7 +233,32 @@ def get_points_world_position(gp_ob, points):
     return transformed_points
 
 
-def calculate_points_indices_from_bones(context, stroke):
+def find_chain_indices(co, positions, tolerance):
+    """
+    Arc-length search for monotone chains: walks the stroke once, from the
+    start, looking for each position in order.
+    Returns None if some position is not on the stroke (within tolerance)
+    """
+    size = len(co) // 3
+    tol_sq = tolerance * tolerance
+    indices = []
+    current = 0
+    for pos in positions:
+        x, y, z = pos
+        while current < size:
+            dx = co[3*current] - x
+            dy = co[3*current + 1] - y
+            dz = co[3*current + 2] - z
+            if dx*dx + dy*dy + dz*dz <= tol_sq:
+                break
+            current += 1
+        else:
+            return None
+        indices.append(current)
+    return indices
+
+
+def calculate_points_indices_from_bones(context, stroke, tolerance=1.0e-4):
     """
     Returns the indices of the points in the stroke that constitute the
     boundaries for the deform vertex groups
@@ -198,28 +266,23 @@ def calculate_points_indices_from_bones(context, stroke):
     group_id = stroke.bone_groups
     armature = context.window_manager.gopo_prop_group.ob_armature
     gp_ob = context.window_manager.gopo_prop_group.gp_ob
-    gp_matrix = gp_ob.matrix_world
-    armature_matrix = armature.matrix_world
-    size = len(stroke.points)
-    kd = kdtree.KDTree(size)
 
-    transf_points = get_points_world_position(gp_ob, stroke.points)
-    for i, pt in enumerate(transf_points):
-        kd.insert(pt, i)
-
-    kd.balance()
+    # Bring the tails to gp_ob space instead of transforming every point
+    transf_matrix = gp_ob.matrix_world.inverted() @ armature.matrix_world
 
     bones = [
         b for b in armature.data.bones if b.use_deform and b.rigged_stroke == group_id]
+    bones.sort(key=lambda b: b.bone_order)
+    tails = [transf_matrix @ b.tail_local for b in bones]
 
-    indices = [0]
-    # TODO: add coordinate transformations
-    for b in bones:
-        head, tail = get_bone_world_position(b, armature)
-        co, index, dist = kd.find(tail)
-        indices.append(index)
+    co = get_points_co(stroke.points)
+    # The fitted knots lie on the stroke: no tree needed for a monotone chain
+    tail_indices = find_chain_indices(co, tails, tolerance)
+    if tail_indices is None:
+        kd = get_stroke_kdtree(gp_ob, stroke, co)
+        tail_indices = find_nearest_indices(kd, tails)
 
-    indices = sorted(indices)
+    indices = sorted([0] + tail_indices)
     idx_pairs = list(zip(indices[:-1], indices[1:]))
     return idx_pairs
 
@@ -267,50 +330,93 @@ def get_bones_positions(context):
     return transform_bones_positions(context, bones_positions), ease
 
 
+def get_bones_segments(context):
+    """
+    Bendy bone segments for each fitted bone: num_bendy for all of them, or
+    split by curvature within bbone_segment_budget if there is a budget
+    """
+    props = context.window_manager.gopo_prop_group
+    h_coefs = context.window_manager.fitted_bones
+    if not props.bbone_segment_budget:
+        return [props.num_bendy] * len(h_coefs)
+    return gp_bone_budget.curvature_segments([i.bone_head for i in h_coefs],
+                                             [i.handle_l for i in h_coefs],
+                                             [i.handle_r for i in h_coefs],
+                                             [i.bone_tail for i in h_coefs],
+                                             props.bbone_segment_budget,
+                                             props.num_bendy)
+
+
+def roll_to_global_y(armature, edbone):
+    """
+    Sets the roll of edbone as calculate_roll(type='GLOBAL_POS_Y', axis_only=True)
+    would, without touching any other bone
+    """
+    axis = armature.matrix_world.inverted().to_3x3() @ Vector((0.0, 1.0, 0.0))
+    edbone.roll = 0.0
+    # axis_only: use whichever of +Y, -Y is closer to the current Z axis
+    if axis.dot(edbone.z_axis) < 0.0:
+        axis.negate()
+    edbone.align_roll(axis)
+
+
 def add_deform_bones(context, armature, pos, ease, group_id):
     """
     Creates deform bones - Puts bones in positions
     Creates the hierarchy - Calculates roll
-    Sets stroke_id
+    Sets stroke_id and the bendy segments
     Puts Deform bones in last layer    
+    Returns the names of the new bones
     """
     armature.select_set(True)
     armature.hide_viewport = False
     context.view_layer.objects.active = armature
-    num_bendy = context.window_manager.gopo_prop_group.num_bendy
+    segments = get_bones_segments(context)
 
-    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+    with span('mode_switch'):
+        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
     ed_bones = armature.data.edit_bones
 
+    new_bones = []
+    prev_bone = None
     for i, pos in enumerate(pos):
         head, tail = pos
         ease_in, ease_out = ease[i]
-        name = bname(context, i)
+        name = bname(context, i, group_id=group_id)
 
         edbone = ed_bones.new(name)
         edbone.head = head
         edbone.tail = tail
-        edbone.bbone_segments = num_bendy
+        edbone.bbone_segments = segments[i]
+        edbone.full_segments = segments[i]
         edbone.use_deform = True
-        edbone.roll = 0.0
+        roll_to_global_y(armature, edbone)
         edbone.bbone_easein = ease_in
         edbone.bbone_easeout = ease_out
         edbone.rigged_stroke = group_id
         edbone.poser_deform = True
         edbone.bone_order = i
 
-        if i > 0:
-            edbone.parent = get_bone(ed_bones, group_id, 'DEFORM', i-1)
+        if prev_bone:
+            edbone.parent = prev_bone
             edbone.use_connect = True
             edbone.inherit_scale = 'NONE'
-    bpy.ops.armature.select_all(action='SELECT')
-    bpy.ops.armature.calculate_roll(type='GLOBAL_POS_Y', axis_only=True)
+        prev_bone = edbone
+        new_bones.append(edbone.name)
+
+    with span('mode_switch'):
+        bpy.ops.object.mode_set(mode='OBJECT')
+    set_deform_layers([armature.data.bones[name] for name in new_bones])
+    return new_bones
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    for bone in armature.data.bones:
-        if bone.poser_deform:
-            bone.layers[-1] = True
-            bone.layers[0] = bone.layers[1] = bone.layers[4] = bone.layers[6] = False
+
+def set_deform_layers(bones):
+    """
+    Puts deform bones in the last layer only
+    """
+    for bone in bones:
+        bone.layers[-1] = True
+        bone.layers[0] = bone.layers[1] = bone.layers[4] = bone.layers[6] = False
 
 
 def add_handles(context, armature, i, group_id):
@@ -368,8 +474,8 @@ def add_control_bones(context, armature, pos, threshold, group_id):
     Sets to no-deform - Adds copy location and stretch-to constraints
     Adds custom shapes - Puts control bones in first layer.
     Hides handle bones
+    Returns the names of the new bones
     """
-    addon_properties = context.window_manager.gopo_prop_group
     # TODO: fix the original alignement bug - we where misassigning the handles
     h_coefs = context.window_manager.fitted_bones
     handles = []
@@ -389,7 +495,8 @@ def add_control_bones(context, armature, pos, threshold, group_id):
 
     armature.select_set(True)
     context.view_layer.objects.active = armature
-    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+    with span('mode_switch'):
+        bpy.ops.object.mode_set(mode='EDIT', toggle=False)
     ed_bones = armature.data.edit_bones
 
     # Center of mass for root bone
@@ -401,12 +508,13 @@ def add_control_bones(context, armature, pos, threshold, group_id):
     root_bone.rigged_stroke = group_id
     root_bone.poser_root = True
     root_bone.bone_order = 15
+    new_bones = [root_bone.name]
     
     # add the knots
     prev_control = None
     ctrl_bones_names = [] # Keep to pass to the handles ordered by bone_order
     for i, p in enumerate(pos):
-        name = bname(context, i, role='ctrl_stroke')
+        name = bname(context, i, role='ctrl_stroke', group_id=group_id)
         ctrl, tail = p
         edbone = ed_bones.new(name)
         edbone.head = Vector(ctrl)
@@ -427,7 +535,7 @@ def add_control_bones(context, armature, pos, threshold, group_id):
         
         # The tail of the last bone gets a knot
         if i == len(pos)-1:
-            name = bname(context, i+1, role='ctrl_stroke')
+            name = bname(context, i+1, role='ctrl_stroke', group_id=group_id)
             edbone = ed_bones.new(name)
             edbone.head = Vector(tail)
             edbone.tail = Vector(tail) + Vector((0.0, 0.0, 1.0))
@@ -456,7 +564,7 @@ def add_control_bones(context, armature, pos, threshold, group_id):
         # Bone order is given by rigged segment.  Control bone has same bone order as it's right handle;
         # but one more than it's left handle
         if h_left:
-            name_left = bname(context, idx-1, role='handle', side='left')
+            name_left = bname(context, idx-1, role='handle', side='left', group_id=group_id)
             edbone_left = ed_bones.new(name_left)
             ed_bones[ctrl_bone_name].gp_lhandle = edbone_left
             # For the selection code
@@ -469,9 +577,10 @@ def add_control_bones(context, armature, pos, threshold, group_id):
             edbone_left.rigged_stroke = group_id
             edbone_left.poser_lhandle = True
             edbone_left.bone_order = idx-1
+            new_bones.append(edbone_left.name)
 
         if h_right:
-            name_right = bname(context, idx, role='handle', side='right')
+            name_right = bname(context, idx, role='handle', side='right', group_id=group_id)
             edbone_right = ed_bones.new(name_right)
             ed_bones[ctrl_bone_name].gp_rhandle = edbone_right
             # For the selection code
@@ -484,23 +593,36 @@ def add_control_bones(context, armature, pos, threshold, group_id):
             edbone_right.rigged_stroke = group_id
             edbone_right.poser_rhandle = True
             edbone_right.bone_order = idx
-
-    bpy.ops.object.mode_set(mode='OBJECT')
-    for i, bone_name in enumerate(ctrl_bones_names[:-1]):
-        
-        # adding constraints
-        if i < len(pos):
-            add_copy_location(armature, bone_name, i, group_id)
-        if i > 0:
-            add_stretch_to(armature, bone_name, i, group_id)
-        if i == len(pos) - 1:
-            next_ctrl_bone = get_bone(armature.data.bones, group_id, 'CTRL', i+1)
-            add_stretch_to(armature, next_ctrl_bone.name, i+1, group_id)
-
-        # setting handles
-        add_handles(context, armature, i, group_id)
-
-    pose_bones = armature.pose.bones
+            new_bones.append(edbone_right.name)
+
+    with span('mode_switch'):
+        bpy.ops.object.mode_set(mode='OBJECT')
+    with span('constraints'):
+        for i, bone_name in enumerate(ctrl_bones_names[:-1]):
+            # adding constraints
+            if i < len(pos):
+                add_copy_location(armature, bone_name, i, group_id)
+            if i > 0:
+                add_stretch_to(armature, bone_name, i, group_id)
+            if i == len(pos) - 1:
+                next_ctrl_bone = get_bone(armature.data.bones, group_id, 'CTRL', i+1)
+                add_stretch_to(armature, next_ctrl_bone.name, i+1, group_id)
+
+    with span('drivers'):
+        for i in range(len(ctrl_bones_names) - 1):
+            # setting handles
+            add_handles(context, armature, i, group_id)
+
+    new_bones.extend(ctrl_bones_names)
+    style_control_bones(context, armature, [armature.pose.bones[name] for name in new_bones])
+    return new_bones
+
+
+def style_control_bones(context, armature, pose_bones):
+    """
+    Sets custom shapes, scales and layers of the control, root and handle bones
+    """
+    addon_properties = context.window_manager.gopo_prop_group
     for pbone in pose_bones:
         rest_bone = pbone.bone
         if rest_bone.poser_control or rest_bone.poser_root:
@@ -532,13 +654,24 @@ def add_armature(context, gp_ob, stroke, armature, group_id):
     Adds an armature modifier to the greasepencil object
     Adds a new vertex group containing the stroke
     Sets the modifier to affect only that vertex group
+    (In SHARED modifier_mode reuses the modifier of the armature instead, unless
+    per-stroke modifiers are left: the shared one would deform their strokes
+    twice.  They are merged by the consolidate operator only)
     """
     
     name = armature.name + str(group_id)
-    mod = gp_ob.grease_pencil_modifiers.new(type='GP_ARMATURE',
-                                            name=name)
-
-    mod.object = armature
+    shared = (context.window_manager.gopo_prop_group.modifier_mode == 'SHARED'
+              and not has_stroke_armature_mods(gp_ob, armature))
+    if shared:
+        # One modifier for all the strokes, the deform groups select the points
+        mod = get_shared_armature_mod(gp_ob, armature)
+        if not mod:
+            mod = gp_ob.grease_pencil_modifiers.new(type='GP_ARMATURE', name=armature.name)
+            mod.object = armature
+    else:
+        mod = gp_ob.grease_pencil_modifiers.new(type='GP_ARMATURE',
+                                                name=name)
+        mod.object = armature
 
     context.view_layer.objects.active = gp_ob
     # bpy.ops.object.mode_set(mode='EDIT_GPENCIL')
@@ -546,11 +679,13 @@ def add_armature(context, gp_ob, stroke, armature, group_id):
     vgroup = gp_ob.vertex_groups.new(name=name)
     vgroup.bone_group = group_id
     vgroup.deform_group = False
-    mod.vertex_group = name
+    if not shared:
+        mod.vertex_group = name
     # bpy.ops.gpencil.vertex_group_assign(con)
-    for idx,pt in enumerate(stroke.points):
-        stroke.points.weight_set(vertex_group_index=vgroup.index, point_index=idx, weight=1.0)
-        # pt.select = True
+    weight_set = stroke.points.weight_set
+    vg_index = vgroup.index
+    for idx in range(len(stroke.points)):
+        weight_set(vertex_group_index=vg_index, point_index=idx, weight=1.0)
 
     # con = change_context(context, gp_ob)
 
@@ -582,37 +717,16 @@ def add_weights(context, gp_ob, stroke, bone_group=None):
     name_base = 'deform_' + str(bone_group)
 
     indices = get_points_indices(context, stroke)
+    falloff = context.window_manager.gopo_prop_group.weight_falloff
 
     context.view_layer.objects.active = gp_ob
-    #bpy.ops.object.mode_set(mode='EDIT_GPENCIL')
-
-    pts = stroke.points
 
     def_vertex_groups = [
         group for group in gp_ob.vertex_groups if group.deform_group and group.bone_group == bone_group]
-
-    for group, idx in zip(def_vertex_groups, indices):
-        for point in pts:
-            point.select = False
-        # bpy.ops.gpencil.select_all(action='DESELECT')
-        # gp_ob.vertex_groups.active_index = group.index
-        min_pt_index, max_pt_index = idx
-
-        for point_idx in range(len(pts)):
-            if min_pt_index <= point_idx <= max_pt_index:
-                pts.weight_set(vertex_group_index=group.index, point_index=point_idx, weight=1.0)
-            #     pts[point_idx].select = True
-            # else:
-            #     pts[point_idx].select = False
-        #con = change_context(context, gp_ob)
-        #bpy.ops.gpencil.vertex_group_assign(con)
-
-    # at the end make sure all points in stroke are deselected
-    # for point in pts:
-    #     point.select = False
-
-    # TODO: change this, should not be set here
-    # bpy.ops.object.mode_set(mode='PAINT_GPENCIL')
+    # one weight per group and point, computed for the whole stroke at once
+    indices = indices[:len(def_vertex_groups)]
+    weights = gp_weights.compute_deform_weights(get_points_co(stroke.points), indices, falloff)
+    gp_weights.write_weights(stroke.points, [group.index for group in def_vertex_groups], weights)
 
 
 def prepare_interface(context, armature):
@@ -626,7 +740,12 @@ def prepare_interface(context, armature):
 
     
 
-def fit_and_add_bones(armature, gp_ob, context, closed_threshold, error_threshold, stroke=None, stroke_index=None):
+def fit_and_add_bones(armature, gp_ob, context, closed_threshold, error_threshold, stroke=None, stroke_index=None, max_bones=0):
+    """
+    Rigs a stroke.  With a max_bones budget, searches the error threshold
+    that keeps the chain within budget and returns the max fitting error.
+    Leaves the interface alone: it's usable in background mode
+    """
 
     armature.data.is_gposer_armature = True
     group_id = gp_ob.data.current_bone_group
@@ -638,21 +757,59 @@ def fit_and_add_bones(armature, gp_ob, context, closed_threshold, error_threshol
     context.view_layer.objects.active = gp_ob
     # fit the curve
     error = error_threshold
-    bpy.ops.gpencil.fit_curve(error_threshold=error,
-                              target='ARMATURE',
-                              stroke_index=stroke_index)
+    max_error = None
+    with span('fit'):
+        if max_bones:
+            error = gp_bone_budget.fit_within_budget(context, stroke_index, error, max_bones)
+            max_error = gp_bone_budget.fitted_max_error(context, stroke)
+        else:
+            bpy.ops.gpencil.fit_curve(error_threshold=error,
+                                      target='ARMATURE',
+                                      stroke_index=stroke_index)
 
     pos, ease = get_bones_positions(context)
-    if len(pos) == 0:
-        return
     # store the length of the chain for rigging purposes
     context.window_manager.gopo_prop_group.num_bones = len(pos)
-    add_deform_bones(context, armature, pos, ease, group_id)
-    add_control_bones(context, armature, pos, closed_threshold, group_id)
-    add_armature(context, gp_ob, stroke, armature, group_id)
-    add_vertex_groups(context, gp_ob, armature, group_id)
-    add_weights(context, gp_ob, stroke, group_id)
-    prepare_interface(context, armature)
+    if len(pos) == 0:
+        return
+    with span('deform_bones'):
+        add_deform_bones(context, armature, pos, ease, group_id)
+    with span('control_bones'):
+        add_control_bones(context, armature, pos, closed_threshold, group_id)
+    invalidate_bone_registry(armature)
+    refresh_lod(armature)
+    with span('armature_modifier'):
+        add_armature(context, gp_ob, stroke, armature, group_id)
+    with span('vertex_groups'):
+        add_vertex_groups(context, gp_ob, armature, group_id)
+    with span('weights'):
+        add_weights(context, gp_ob, stroke, group_id)
+    context.window_manager.fitted_bones.clear()
+    return max_error
+
+
+def rig_stroke(context, gp_ob, armature, layer, stroke_index, closed_threshold, error_threshold, max_bones=0):
+    """
+    Rigs the stroke at stroke_index in the active frame of layer with a new
+    bone group.  Returns the bone group id and the max fitting error
+    """
+    gp_ob.data.current_bone_group += 1
+    gp_ob.data.layers.active = layer
+    max_error = fit_and_add_bones(armature, gp_ob, context, closed_threshold, error_threshold,
+                                  stroke=layer.active_frame.strokes[stroke_index],
+                                  stroke_index=stroke_index, max_bones=max_bones)
+    return gp_ob.data.current_bone_group, max_error
+
+
+def report_max_error(operator, context, max_errors):
+    """
+    Reports the worst fitting error of the strokes rigged within a bone budget
+    """
+    max_errors = [e for e in max_errors if e is not None]
+    if not max_errors:
+        return
+    context.window_manager.gopo_prop_group.last_fit_error = max(max_errors)
+    operator.report({'INFO'}, f'Bone budget: max fitting error {max(max_errors):.4f}')
 
 
 class Gomez_OT_Poser(bpy.types.Operator):
@@ -665,6 +822,9 @@ class Gomez_OT_Poser(bpy.types.Operator):
 
     closed_stroke_threshold: FloatProperty(name='closed_stroke_threshold', default=0.03)
     error_threshold: FloatProperty(name='error_threshold', default=0.01)
+    interactive: BoolProperty(name='interactive',
+                              description='Go to pose mode of the armature when done',
+                              default=True)
 
     def invoke(self, context, event):
         if context.object.type == 'GPENCIL':
@@ -674,6 +834,10 @@ class Gomez_OT_Poser(bpy.types.Operator):
         return {'CANCELLED'}
 
     def execute(self, context):
+        with operator_call(self.bl_idname):
+            return self.run(context)
+
+    def run(self, context):
         # Make sure the auxiliary objects have been created
         gp_auxiliary_objects.assure_auxiliary_objects(context)
                 
@@ -689,18 +853,26 @@ class Gomez_OT_Poser(bpy.types.Operator):
                     if stroke.select:
                         strokes_to_fit.append((layer, idx))
             num_strokes = len(strokes_to_fit)
+            max_errors = []
+            deform_bones = gp_bone_budget.count_deform_bones(ob_armature)
             for layer, stroke_index in strokes_to_fit:
-                print(f'restan {num_strokes}')
+                max_bones = gp_bone_budget.stroke_bone_budget(context, ob_armature, num_strokes, deform_bones)
                 num_strokes -=1
-                gp_ob.data.layers.active = layer
-                gp_ob.data.current_bone_group += 1
-                fit_and_add_bones(ob_armature, gp_ob, context,
-                                  self.closed_stroke_threshold, self.error_threshold, stroke=layer.active_frame.strokes[stroke_index], stroke_index=stroke_index)
+                _, max_error = rig_stroke(context, gp_ob, ob_armature, layer, stroke_index,
+                                          self.closed_stroke_threshold, self.error_threshold, max_bones)
+                deform_bones += context.window_manager.gopo_prop_group.num_bones
+                max_errors.append(max_error)
         else:
-            gp_ob.data.current_bone_group += 1
-            fit_and_add_bones(ob_armature, gp_ob, context,
-                          self.closed_stroke_threshold, self.error_threshold)
-
+            max_bones = gp_bone_budget.stroke_bone_budget(context, ob_armature)
+            _, max_error = rig_stroke(context, gp_ob, ob_armature, gp_ob.data.layers.active,
+                                      get_stroke_index(context, gp_ob),
+                                      self.closed_stroke_threshold, self.error_threshold, max_bones)
+            max_errors = [max_error]
+
+        if self.interactive:
+            with span('interface'):
+                prepare_interface(context, ob_armature)
+        report_max_error(self, context, max_errors)
         return {'FINISHED'}
 
     @classmethod
@@ -737,15 +909,32 @@ class Gomez_OT_Rig_All_Strokes(bpy.types.Operator):
 
     closed_stroke_threshold: FloatProperty(name='closed_stroke_threshold', default=0.03)
     error_threshold: FloatProperty(name='error_threshold', default=0.01)
+    interactive: BoolProperty(name='interactive',
+                              description='Go to pose mode of the armature when done',
+                              default=True)
 
     def invoke(self, context, event):
         if context.object.type == 'GPENCIL':           
             context.window_manager.gopo_prop_group.gp_ob = context.object
             self.error_threshold = context.window_manager.gopo_prop_group.error_threshold
-            return self.execute(context)
+            if not context.window:
+                return self.execute(context)
+            # Modal: the strokes are rigged a few per step, Esc removes the rigs added
+            self.prepare(context)
+            if not self._pending:
+                return {'CANCELLED'}
+            begin_modal_job(self, context, self._total)
+            return {'RUNNING_MODAL'}
         return {'CANCELLED'}
 
     def execute(self, context):
+        with operator_call(self.bl_idname):
+            return self.run(context)
+
+    def prepare(self, context):
+        """
+        Collects the strokes in the active frames of the unlocked layers
+        """
         # Make sure the auxiliary objects have been created
         gp_auxiliary_objects.assure_auxiliary_objects(context)
         
@@ -754,20 +943,76 @@ class Gomez_OT_Rig_All_Strokes(bpy.types.Operator):
             
         gp_ob = context.window_manager.gopo_prop_group.gp_ob
         context.view_layer.objects.active = gp_ob
-        ob_armature = context.window_manager.gopo_prop_group.ob_armature
+        self._first_group = gp_ob.data.current_bone_group
 
-        strokes_to_fit = []
+        # (layer name, stroke index) of the strokes left to rig
+        self._pending = []
         for layer in [l for l in gp_ob.data.layers if not l.lock]:
             for idx, stroke in enumerate(layer.active_frame.strokes):
-                strokes_to_fit.append((layer, idx))
-        for layer, idx in strokes_to_fit:
-            gp_ob.data.current_bone_group +=1
-            gp_ob.data.layers.active = layer
-            fit_and_add_bones(ob_armature, gp_ob, context,
-                              self.closed_stroke_threshold, self.error_threshold, layer.active_frame.strokes[idx], idx)
-
+                self._pending.append((layer.info, idx))
+        self._total = len(self._pending)
+        # (layer name, keyframe number, group id) of the rigged strokes
+        self._rigged = []
+        self._max_errors = []
+        self._deform_bones = gp_bone_budget.count_deform_bones(context.window_manager.gopo_prop_group.ob_armature)
+
+    def rig_next(self, context):
+        props = context.window_manager.gopo_prop_group
+        gp_ob = props.gp_ob
+        ob_armature = props.ob_armature
+        max_bones = gp_bone_budget.stroke_bone_budget(context, ob_armature, len(self._pending),
+                                                      self._deform_bones)
+        layer_name, idx = self._pending.pop(0)
+        layer = gp_ob.data.layers[layer_name]
+        group_id, max_error = rig_stroke(context, gp_ob, ob_armature, layer, idx,
+                                         self.closed_stroke_threshold, self.error_threshold, max_bones)
+        self._deform_bones += props.num_bones
+        self._rigged.append((layer_name, layer.active_frame.frame_number, group_id))
+        self._max_errors.append(max_error)
+
+    def run(self, context):
+        self.prepare(context)
+        while self._pending:
+            self.rig_next(context)
+        return self.finish(context)
+
+    def finish(self, context):
+        if self.interactive and self._rigged:
+            with span('interface'):
+                prepare_interface(context, context.window_manager.gopo_prop_group.ob_armature)
+        report_max_error(self, context, self._max_errors)
         return {'FINISHED'}
 
+    @resumes_call
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            with span('rollback'):
+                self.rollback(context)
+            end_modal_job(self, context)
+            self.report({'WARNING'}, f'Rigging cancelled, {len(self._rigged)} rigs removed')
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return job_event_result(event)
+
+        run_job_slice(lambda: self.rig_next(context), lambda: self._pending)
+        update_modal_job(context, 'Rigging stroke', len(self._rigged), self._total)
+        if self._pending:
+            return {'RUNNING_MODAL'}
+        result = self.finish(context)
+        end_modal_job(self, context)
+        return result
+
+    def rollback(self, context):
+        """
+        Removes the rigs added so far, as cleaning a baked stroke does
+        """
+        gp_ob = context.window_manager.gopo_prop_group.gp_ob
+        context.view_layer.objects.active = gp_ob
+        for layer_name, frame_number, group_id in reversed(self._rigged):
+            clean_baked(context, group_id, frame_number, frame_number, layer_name)
+        gp_ob.data.current_bone_group = self._first_group
+        context.window_manager.fitted_bones.clear()
+
     @classmethod
     def poll(cls, context):
         """
@@ -797,12 +1042,37 @@ class Gomez_OT_Rig_All_Strokes(bpy.types.Operator):
     
 
 
+class GOMEZ_OT_set_ease_mode(bpy.types.Operator):
+    """
+    Rebuild the ease drivers of the selected rigs with another ease mode
+    """
+    bl_idname = "armature.set_ease_mode"
+    bl_label = "Gposer set ease mode"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    ease_mode: EnumProperty(name='ease_mode', items=EASE_MODES, default='SCRIPTED')
+
+    def execute(self, context):
+        armature = context.window_manager.gopo_prop_group.ob_armature
+        group_ids = {pbone.bone.rigged_stroke for pbone in context.selected_pose_bones}
+        group_ids.discard(0)
+        for group_id in group_ids:
+            set_ease_mode(context, armature, group_id, self.ease_mode)
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        armature = context.window_manager.gopo_prop_group.ob_armature
+        return armature and context.mode == 'POSE'
+
+
 def register():
     bpy.utils.register_class(Gomez_OT_Poser)
     bpy.utils.register_class(Gomez_OT_Rig_All_Strokes)
+    bpy.utils.register_class(GOMEZ_OT_set_ease_mode)
 
 
 def unregister():
     bpy.utils.unregister_class(Gomez_OT_Poser)
     bpy.utils.unregister_class(Gomez_OT_Rig_All_Strokes)
-    # profile.dump_stats("/home/marcelo/Desktop/lineprof.prof")
+    bpy.utils.unregister_class(GOMEZ_OT_set_ease_mode)
@@ -0,0 +1,395 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import bpy
+from bpy.props import FloatProperty, IntProperty
+from mathutils import Vector
+
+from .fit import fit_curve
+from . import gp_weights
+from . import gp_bone_budget
+from .gp_armature_applier import clean_animation_data
+from .gp_bone_registry import invalidate_bone_registry
+from .gp_bbone_lod import refresh_lod
+from .gp_rigging_ops import (get_bone, bname, add_copy_location, add_stretch_to,
+                             add_handles, style_control_bones, remove_ease_drivers,
+                             roll_to_global_y, set_deform_layers, get_points_co,
+                             calculate_points_indices_from_bones, find_chain_indices)
+
+# Blender scales the bbone handles by ease * length * BBONE_HANDLE_FACTOR
+BBONE_HANDLE_FACTOR = 0.390464
+
+
+def get_rigged_stroke(gp_ob, group_id):
+    """
+    Returns the stroke rigged with group_id
+    """
+    for layer in gp_ob.data.layers:
+        for frame in layer.frames:
+            for stroke in frame.strokes:
+                if stroke.bone_groups == group_id:
+                    return stroke
+
+
+def fitted_ease(knot, handle, length):
+    """
+    Ease value that makes a bbone handle as long as the fitted one
+    """
+    if length == 0.0:
+        return 1.0
+    return (Vector(handle) - Vector(knot)).length / (BBONE_HANDLE_FACTOR * length)
+
+
+def fit_segment(points, first, last, that_1, that_2, error):
+    """
+    Fits the points between first and last keeping the tangents at the ends.
+    Returns the list of (head, handle_start, handle_end, tail) of each segment
+    """
+    result = fit_curve.fit_cubic(points, first, last, that_1, that_2, error)
+    knots = [points[first]] + result[2::3]
+    return [(knots[k], result[3*k], result[3*k + 1], knots[k + 1])
+            for k in range(len(knots) - 1)]
+
+
+def segment_bones(armature, group_id, ctrl_start, ctrl_end):
+    """
+    Returns the names of the bones that get replaced when refitting
+    the segment between the controls ctrl_start and ctrl_end
+    """
+    removed = []
+    for bone in armature.data.bones:
+        if bone.rigged_stroke != group_id:
+            continue
+        order = bone.bone_order
+        if bone.poser_deform and ctrl_start <= order < ctrl_end:
+            removed.append(bone.name)
+        elif bone.poser_control and ctrl_start < order < ctrl_end:
+            removed.append(bone.name)
+        elif bone.poser_rhandle and ctrl_start < order < ctrl_end:
+            removed.append(bone.name)
+        elif bone.poser_lhandle and ctrl_start <= order < ctrl_end - 1:
+            removed.append(bone.name)
+    return removed
+
+
+def stroke_bone_name(bone, order, group_id):
+    """
+    Name gp_rigging_ops gives to a bone with the role of bone at order
+    """
+    if bone.poser_deform:
+        return bname(None, order, group_id=group_id)
+    if bone.poser_control:
+        return bname(None, order, role='ctrl_stroke', group_id=group_id)
+    side = 'left' if bone.poser_lhandle else 'right'
+    return bname(None, order, role='handle', side=side, group_id=group_id)
+
+
+def shift_bone_order(ed_bones, group_id, ctrl_end, delta):
+    """
+    Moves the bone_order of the bones after the refitted segment and renames
+    the ones named after their order.  Returns {old name: new name}
+    """
+    renames = {}
+    if not delta:
+        return renames
+    for edbone in ed_bones:
+        if edbone.rigged_stroke != group_id or edbone.poser_root:
+            continue
+        first_shifted = ctrl_end - 1 if edbone.poser_lhandle else ctrl_end
+        if edbone.bone_order >= first_shifted:
+            if edbone.name == stroke_bone_name(edbone, edbone.bone_order, group_id):
+                renames[edbone.name] = stroke_bone_name(edbone, edbone.bone_order + delta, group_id)
+            edbone.bone_order += delta
+
+    # Through temporary names: the new names of some bones are the old ones of others.
+    # Renaming a bone updates its constraints, drivers and animation
+    for name in renames:
+        ed_bones[name].name = name + '.shift'
+    for name, new_name in renames.items():
+        ed_bones[name + '.shift'].name = new_name
+    return renames
+
+
+def rename_vertex_groups(gp_ob, vgroup_indices, renames):
+    """
+    Renames the vertex groups, given by index, of the renamed deform bones
+    """
+    vgroups = [(gp_ob.vertex_groups[vgroup_indices[name]], new_name)
+               for name, new_name in renames.items() if name in vgroup_indices]
+    for vgroup, new_name in vgroups:
+        vgroup.name = new_name + '.shift'
+    for vgroup, new_name in vgroups:
+        vgroup.name = new_name
+
+
+def new_stroke_bone(ed_bones, name, head, group_id, order, parent):
+    """
+    Adds a non deforming bone pointing up
+    """
+    edbone = ed_bones.new(name)
+    edbone.head = head
+    edbone.tail = head + Vector((0.0, 0.0, 1.0))
+    edbone.use_deform = False
+    edbone.rigged_stroke = group_id
+    edbone.bone_order = order
+    edbone.parent = parent
+    return edbone
+
+
+def rerig_segment(context, gp_ob, armature, group_id, ctrl_start, ctrl_end, error_threshold):
+    """
+    Refits the part of a rigged stroke between two control bones.
+    Only the deform, control and handle bones inside the segment are replaced,
+    the rest of the chain keeps its constraints, drivers and animation: the
+    handles at the ends of the segment keep their rest position, and the bones
+    after it are renamed after their new order.
+    Returns the number of deform bones of the new segment
+    """
+    props = context.window_manager.gopo_prop_group
+    stroke = get_rigged_stroke(gp_ob, group_id)
+    if not stroke:
+        return 0
+
+    bones = armature.data.bones
+    # Boundaries of the segment in the stroke
+    idx_pairs = calculate_points_indices_from_bones(context, stroke)
+    first = idx_pairs[ctrl_start][0]
+    last = idx_pairs[ctrl_end - 1][1]
+    if last - first < 2:
+        return 0
+
+    # Keep the tangents of the handles at the ends of the segment
+    to_gp = gp_ob.matrix_world.inverted() @ armature.matrix_world
+    to_arm = to_gp.inverted()
+    start_ctrl = get_bone(bones, group_id, 'CTRL', ctrl_start)
+    end_ctrl = get_bone(bones, group_id, 'CTRL', ctrl_end)
+    start_handle = get_bone(bones, group_id, 'HANDLE_RIGHT', ctrl_start)
+    end_handle = get_bone(bones, group_id, 'HANDLE_LEFT', ctrl_end - 1)
+    that_1 = (to_gp @ start_handle.head_local - to_gp @ start_ctrl.head_local).normalized()
+    that_2 = (to_gp @ end_handle.head_local - to_gp @ end_ctrl.head_local).normalized()
+
+    points = [pt.co.copy() for pt in stroke.points]
+    segments = fit_segment(points, first, last, that_1, that_2, error_threshold)
+    knots_indices = find_chain_indices(get_points_co(stroke.points),
+                                       [seg[3] for seg in segments],
+                                       1.0e-4)
+    if knots_indices is None:
+        return 0
+    segments = [tuple(to_arm @ Vector(p) for p in seg) for seg in segments]
+
+    num_new = len(segments)
+    delta = num_new - (ctrl_end - ctrl_start)
+
+    removed = segment_bones(armature, group_id, ctrl_start, ctrl_end)
+    # The new deform bones share the bendy segments of the replaced ones, as get_bones_segments does
+    if props.bbone_segment_budget:
+        budget = sum(bones[name].full_segments for name in removed if bones[name].poser_deform)
+        bbone_segments = gp_bone_budget.curvature_segments(*zip(*segments), budget, props.num_bendy)
+    else:
+        bbone_segments = [props.num_bendy] * num_new
+
+    # Remove drivers, animation and vertex groups of the replaced bones
+    for name in removed:
+        if bones[name].poser_deform:
+            remove_ease_drivers(armature, name)
+            vgroup = gp_ob.vertex_groups.get(name)
+            if vgroup:
+                gp_ob.vertex_groups.remove(vgroup)
+    if armature.animation_data:
+        clean_animation_data(context, removed)
+    vgroup_indices = {vgroup.name: vgroup.index for vgroup in gp_ob.vertex_groups}
+
+    act_ob = context.view_layer.objects.active
+    armature.hide_viewport = False
+    armature.select_set(True)
+    context.view_layer.objects.active = armature
+    bpy.ops.object.mode_set(mode='EDIT', toggle=False)
+    ed_bones = armature.data.edit_bones
+
+    for name in removed:
+        ed_bones.remove(ed_bones[name])
+    renames = shift_bone_order(ed_bones, group_id, ctrl_end, delta)
+
+    root_bone = get_bone(ed_bones, group_id, 'ROOT', 15)
+    prev_deform = get_bone(ed_bones, group_id, 'DEFORM', ctrl_start - 1)
+    next_deform = get_bone(ed_bones, group_id, 'DEFORM', ctrl_end + delta)
+    ctrls = [get_bone(ed_bones, group_id, 'CTRL', ctrl_start)]
+
+    new_bones = []
+    pending_left = None
+    for k, seg in enumerate(segments):
+        order = ctrl_start + k
+        head, handle_start, handle_end, tail = seg
+        length = (tail - head).length
+
+        edbone = ed_bones.new(bname(context, order, group_id=group_id))
+        edbone.head = head
+        edbone.tail = tail
+        edbone.bbone_segments = bbone_segments[k]
+        edbone.full_segments = bbone_segments[k]
+        edbone.use_deform = True
+        roll_to_global_y(armature, edbone)
+        edbone.bbone_easein = fitted_ease(head, handle_start, length)
+        edbone.bbone_easeout = fitted_ease(tail, handle_end, length)
+        edbone.rigged_stroke = group_id
+        edbone.poser_deform = True
+        edbone.bone_order = order
+        if prev_deform:
+            edbone.parent = prev_deform
+            edbone.use_connect = True
+            edbone.inherit_scale = 'NONE'
+        prev_deform = edbone
+        new_bones.append(edbone.name)
+
+        # Interior knots get a new control
+        if k > 0:
+            ctrl = new_stroke_bone(ed_bones, bname(context, order, role='ctrl_stroke', group_id=group_id),
+                                   head, group_id, order, root_bone)
+            ctrl.poser_control = True
+            # the left handle added in the previous step belongs to this knot
+            ctrl.gp_lhandle = pending_left
+            pending_left.gp_lhandle = ctrl
+            ctrls.append(ctrl)
+            new_bones.append(ctrl.name)
+
+        # Start handle belongs to the control at the head of the segment.  It keeps
+        # its rest position, that the keys of the chain are relative to: the fit
+        # kept its direction and the ease gives the length
+        if k > 0:
+            right = new_stroke_bone(ed_bones, bname(context, order, role='handle', side='right', group_id=group_id),
+                                    handle_start, group_id, order, root_bone)
+            right.inherit_scale = 'NONE'
+            right.poser_rhandle = True
+            ctrls[-1].gp_rhandle = right
+            right.gp_lhandle = ctrls[-1]
+            new_bones.append(right.name)
+
+        # End handle belongs to the control at the tail of the segment, kept as the start one
+        if k < num_new - 1:
+            left = new_stroke_bone(ed_bones, bname(context, order, role='handle', side='left', group_id=group_id),
+                                   handle_end, group_id, order, root_bone)
+            left.inherit_scale = 'NONE'
+            left.poser_lhandle = True
+            new_bones.append(left.name)
+            pending_left = left
+
+    ctrls.append(get_bone(ed_bones, group_id, 'CTRL', ctrl_end + delta))
+    for ctrl_a, ctrl_b in zip(ctrls[:-1], ctrls[1:]):
+        ctrl_b.bbone_custom_handle_start = ctrl_a
+        ctrl_a.bbone_custom_handle_end = ctrl_b
+
+    if next_deform:
+        next_deform.parent = prev_deform
+        next_deform.use_connect = True
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+    rename_vertex_groups(gp_ob, vgroup_indices, renames)
+    invalidate_bone_registry(armature)
+    refresh_lod(armature)
+
+    # Constraints and drivers of the new deform bones
+    props.num_bones = len([b for b in bones if b.poser_deform and b.rigged_stroke == group_id])
+    for k in range(num_new):
+        order = ctrl_start + k
+        add_copy_location(armature, ctrls[k].name, order, group_id)
+        add_stretch_to(armature, ctrls[k + 1].name, order + 1, group_id)
+        add_handles(context, armature, order, group_id)
+
+    set_deform_layers([bones[name] for name in new_bones if bones[name].poser_deform])
+    style_control_bones(context, armature,
+                        [armature.pose.bones[name] for name in new_bones if not bones[name].poser_deform])
+
+    # Vertex groups of the new deform bones
+    for k in range(num_new):
+        name = get_bone(bones, group_id, 'DEFORM', ctrl_start + k).name
+        vgroup = gp_ob.vertex_groups.new(name=name)
+        vgroup.bone_group = group_id
+        vgroup.deform_group = True
+
+    # The blending at the joints changes: rewrite the weights of the whole stroke as add_weights does
+    deform_bones = sorted((b for b in bones if b.poser_deform and b.rigged_stroke == group_id),
+                          key=lambda b: b.bone_order)
+    idx_pairs = calculate_points_indices_from_bones(context, stroke)
+    weights = gp_weights.compute_deform_weights(get_points_co(stroke.points), idx_pairs, props.weight_falloff)
+    gp_weights.write_weights(stroke.points, [gp_ob.vertex_groups[b.name].index for b in deform_bones],
+                             weights, skip_empty=False)
+
+    context.view_layer.objects.active = act_ob
+    return num_new
+
+
+class GOMEZ_OT_rerig_segment(bpy.types.Operator):
+    """
+    Refit and re-rig the segment of a stroke between two control bones
+    """
+    bl_idname = "greasepencil.rerig_segment"
+    bl_label = "Gposer re-rig segment"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    group_id: IntProperty(name='bgroup', default=0)
+    ctrl_start: IntProperty(name='ctrl_start',
+                            description='bone_order of the control at the start of the segment',
+                            default=0, min=0)
+    ctrl_end: IntProperty(name='ctrl_end',
+                          description='bone_order of the control at the end of the segment',
+                          default=1, min=1)
+    error_threshold: FloatProperty(name='error_threshold', default=0.01)
+
+    def invoke(self, context, event):
+        ctrls = [pbone.bone for pbone in context.selected_pose_bones if pbone.bone.poser_control]
+        if not ctrls:
+            return {'CANCELLED'}
+        self.group_id = ctrls[0].rigged_stroke
+        orders = [bone.bone_order for bone in ctrls if bone.rigged_stroke == self.group_id]
+        self.ctrl_start = min(orders)
+        self.ctrl_end = max(orders)
+        self.error_threshold = context.window_manager.gopo_prop_group.error_threshold
+        return self.execute(context)
+
+    def execute(self, context):
+        if not self.group_id or self.ctrl_end <= self.ctrl_start:
+            return {'CANCELLED'}
+        props = context.window_manager.gopo_prop_group
+        armature = props.ob_armature
+        if not get_bone(armature.data.bones, self.group_id, 'CTRL', self.ctrl_end):
+            return {'CANCELLED'}
+
+        bpy.ops.object.mode_set(mode='OBJECT')
+        num_new = rerig_segment(context, props.gp_ob, armature, self.group_id,
+                                self.ctrl_start, self.ctrl_end, self.error_threshold)
+        context.view_layer.objects.active = armature
+        bpy.ops.object.mode_set(mode='POSE')
+        if not num_new:
+            self.report({'WARNING'}, 'Could not refit the segment')
+            return {'CANCELLED'}
+        return {'FINISHED'}
+
+    @classmethod
+    def poll(cls, context):
+        armature = context.window_manager.gopo_prop_group.ob_armature
+        return armature and context.mode == 'POSE'
+
+
+def register():
+    bpy.utils.register_class(GOMEZ_OT_rerig_segment)
+
+
+def unregister():
+    bpy.utils.unregister_class(GOMEZ_OT_rerig_segment)
@@ -0,0 +1,96 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Spatial index of the points of every rigged stroke, keyed by
+# (gp object name, bone group).  Each entry keeps the signature of the point
+# buffer it was built from, so it is rebuilt only when the stroke changes.
+# Cleaning a rig drops its entry and loading a file drops them all.
+
+import bpy
+from array import array
+from bpy.app.handlers import persistent
+from mathutils import kdtree
+
+_stroke_kdtrees = {}
+
+
+def get_points_co(points):
+    """
+    Returns a flat array with the coordinates of the points in gp_ob space
+    """
+    co = array('f', [0.0]) * (3 * len(points))
+    points.foreach_get('co', co)
+    return co
+
+
+def get_stroke_kdtree(gp_ob, stroke, co=None):
+    """
+    Returns a kdtree of the stroke points (in gp_ob space).
+    The tree is cached and reused until the point buffer of the stroke changes
+    """
+    if co is None:
+        co = get_points_co(stroke.points)
+    key = (gp_ob.name, stroke.bone_groups)
+    signature = (len(co), hash(co.tobytes()))
+
+    cached = _stroke_kdtrees.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    size = len(co) // 3
+    kd = kdtree.KDTree(size)
+    for i in range(size):
+        kd.insert(co[3*i:3*i + 3], i)
+    kd.balance()
+
+    _stroke_kdtrees[key] = (signature, kd)
+    return kd
+
+
+def invalidate_stroke_kdtree(gp_ob, group_id=None):
+    """
+    Drops the cached kdtrees of a bone group, or of the whole gp_ob
+    """
+    for key in list(_stroke_kdtrees):
+        if key[0] == gp_ob.name and (group_id is None or key[1] == group_id):
+            del _stroke_kdtrees[key]
+
+
+def find_nearest_indices(kd, positions):
+    """
+    Batch query: returns the index of the nearest point for every position
+    """
+    find = kd.find
+    return [find(pos)[1] for pos in positions]
+
+
+@persistent
+def kdtree_load_pre(*args):
+    # Object names of the new file may match those of the old one
+    _stroke_kdtrees.clear()
+
+
+def register():
+    bpy.app.handlers.load_pre.append(kdtree_load_pre)
+
+
+def unregister():
+    bpy.app.handlers.load_pre.remove(kdtree_load_pre)
+    _stroke_kdtrees.clear()
@@ -0,0 +1,95 @@
+'''
+Copyright (C) 2020 dzigaVertov@github
+gomezmarcelod@gmail.com
+
+Created by Marcelo Demian Gómez
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import numpy as np
+
+# Weights below this value are not written to the vertex groups
+MIN_WEIGHT = 1.0e-4
+
+
+def arc_length(co):
+    """
+    Cumulative length along the stroke for an (n, 3) array of points
+    """
+    co = np.asarray(co, dtype=np.float64).reshape(-1, 3)
+    seg_lengths = np.linalg.norm(np.diff(co, axis=0), axis=1)
+    return np.concatenate(([0.0], np.cumsum(seg_lengths)))
+
+
+def smoothstep(t):
+    """
+    Hermite blend between 0 and 1
+    """
+    t = np.clip(t, 0.0, 1.0)
+    return t * t * (3.0 - 2.0 * t)
+
+
+def compute_deform_weights(co, idx_pairs, falloff):
+    """
+    Returns an (n_bones, n_points) array with the normalized weight of every
+    point for every deform bone.
+    idx_pairs holds the (first, last) point index covered by each bone.
+    Around each joint the weights blend over an arc length of falloff times
+    the shortest of the two bones (falloff = 0 gives hard ranges)
+    """
+    s = arc_length(co)
+    n_bones = len(idx_pairs)
+    starts = s[[int(first) for first, _ in idx_pairs]]
+    ends = s[[int(last) for _, last in idx_pairs]]
+    lengths = ends - starts
+
+    # Blend at each joint, from 0 (previous bone) to 1 (next bone)
+    blends = []
+    for j in range(n_bones - 1):
+        joint = ends[j]
+        half_width = 0.5 * falloff * min(lengths[j], lengths[j + 1])
+        if half_width > 0.0:
+            blends.append(smoothstep((s - joint + half_width) / (2.0 * half_width)))
+        else:
+            blends.append((s >= joint).astype(np.float64))
+
+    weights = np.ones((n_bones, len(s)))
+    for k in range(n_bones):
+        if k > 0:
+            weights[k] *= blends[k - 1]
+        else:
+            weights[k] *= s >= starts[0]
+        if k < n_bones - 1:
+            weights[k] *= 1.0 - blends[k]
+        else:
+            weights[k] *= s <= ends[-1]
+
+    total = weights.sum(axis=0)
+    np.divide(weights, total, out=weights, where=total > 0.0)
+    return weights
+
+
+def write_weights(points, vgroup_indices, weights, skip_empty=True):
+    """
+    Writes the weights of every vertex group, skipping the points
+    that get (almost) no weight.  Without skip_empty every weight is
+    written, overwriting the weights the points had
+    """
+    weight_set = points.weight_set
+    min_weight = MIN_WEIGHT if skip_empty else -1.0
+    for vg_index, bone_weights in zip(vgroup_indices, weights):
+        for point_index in np.flatnonzero(bone_weights > min_weight).tolist():
+            weight_set(vertex_group_index=vg_index, point_index=point_index,
+                       weight=float(bone_weights[point_index]))
@@ -0,0 +1,202 @@
+import numpy as np
+from types import SimpleNamespace
+import pytest
+from gomez_poser import gp_bbone_eval
+
+# ROTATIONS
+# -----------------------------------------------------
+
+def quaternion_product(a, b):
+    w1, x1, y1, z1 = a
+    w2, x2, y2, z2 = b
+    return np.array([w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2])
+
+
+def axis_quaternion(axis, angle):
+    quat = np.zeros(4)
+    quat[0] = np.cos(angle / 2)
+    quat[1 + 'XYZ'.index(axis)] = np.sin(angle / 2)
+    return quat
+
+
+def test_quaternion_matrices_rotate():
+    # A quarter turn around Z takes X to Y
+    matrix = gp_bbone_eval.quaternion_matrices(axis_quaternion('Z', np.pi / 2)[None])[0]
+    assert matrix @ [1.0, 0.0, 0.0] == pytest.approx([0.0, 1.0, 0.0])
+    assert matrix @ matrix.T == pytest.approx(np.eye(3))
+
+
+@pytest.mark.parametrize('order', ['XYZ', 'XZY', 'YXZ', 'YZX', 'ZXY', 'ZYX'])
+def test_euler_matches_quaternion(order):
+    eulers = np.array([[0.3, -1.2, 2.0], [0.0, 0.0, 0.0], [np.pi, 0.5, -0.7]])
+    from_eulers = gp_bbone_eval.euler_matrices(eulers, order)
+    for angles, matrix in zip(eulers, from_eulers):
+        # The first axis in the order is applied first
+        quat = np.array([1.0, 0.0, 0.0, 0.0])
+        for axis in order:
+            quat = quaternion_product(axis_quaternion(axis, angles['XYZ'.index(axis)]), quat)
+        assert matrix == pytest.approx(gp_bbone_eval.quaternion_matrices(quat[None])[0])
+
+
+def test_y_to_vec_and_swing():
+    rng = np.random.default_rng(0)
+    vecs = gp_bbone_eval.normalized(rng.normal(size=(20, 3)))
+    vecs[0] = (0.0, -1.0, 0.0)
+    matrices = gp_bbone_eval.y_to_vec(vecs)
+    assert matrices[:, :, 1] == pytest.approx(vecs)
+    assert matrices @ np.swapaxes(matrices, -1, -2) == pytest.approx(np.broadcast_to(np.eye(3), (20, 3, 3)))
+
+    targets = gp_bbone_eval.normalized(rng.normal(size=(20, 3)))
+    swings = gp_bbone_eval.swing(vecs[1:], targets[1:])
+    assert np.einsum('nij,nj->ni', swings, vecs[1:]) == pytest.approx(targets[1:])
+
+
+# DEFORM_POINTS
+# -----------------------------------------------------
+
+def straight_bone(head, tail, segments=4, n_frames=3, offset=(0.0, 0.0, 0.0)):
+    """
+    Segments of a bone along Y posed as in rest, moved by offset
+    """
+    head, tail = np.asarray(head, dtype=float), np.asarray(tail, dtype=float)
+    rest_rot = np.eye(3)
+    p1, p2 = gp_bbone_eval.bezier_handles(head, tail, None, None, 1.0, 1.0)
+    points, tangents = gp_bbone_eval.bezier_segments(head, p1, p2, tail, segments)
+    rots = rest_rot @ gp_bbone_eval.y_to_vec(tangents)
+    return {
+        'segments': segments,
+        'rest_head': head,
+        'rest_rot': rest_rot,
+        'rest_length': np.linalg.norm(tail - head),
+        'rest_points': points,
+        'rest_rots': rots,
+        'points': np.broadcast_to(points + offset, (n_frames,) + points.shape),
+        'rots': np.broadcast_to(rots, (n_frames,) + rots.shape),
+    }
+
+
+def test_rest_pose_keeps_points():
+    rng = np.random.default_rng(1)
+    co = rng.uniform((-0.2, -0.1, -0.2), (0.2, 2.1, 0.2), size=(30, 3))
+    segments_by_bone = {'a': straight_bone((0, 0, 0), (0, 1, 0)), 'b': straight_bone((0, 1, 0), (0, 2, 0))}
+    weights = {'a': np.clip(1.5 - co[:, 1], 0.0, 1.0), 'b': np.clip(co[:, 1] - 0.5, 0.0, 1.0)}
+    deformed = gp_bbone_eval.deform_points(co, weights, segments_by_bone)
+    assert deformed.shape == (3, 30, 3)
+    for frame_co in deformed:
+        assert frame_co == pytest.approx(co)
+
+
+def test_moved_bone_moves_points():
+    co = np.array([[0.1, 0.25, 0.0], [0.0, 0.8, -0.1], [5.0, 5.0, 5.0]])
+    segments_by_bone = {'a': straight_bone((0, 0, 0), (0, 1, 0), offset=(1.0, 0.0, 0.0))}
+    weights = {'a': np.array([1.0, 1.0, 0.0])}
+    deformed = gp_bbone_eval.deform_points(co, weights, segments_by_bone)
+    assert deformed[:, :2] == pytest.approx(np.broadcast_to(co[:2] + (1.0, 0.0, 0.0), (3, 2, 3)))
+    # Points outside every deform group keep their position
+    assert deformed[:, 2] == pytest.approx(np.broadcast_to(co[2], (3, 3)))
+
+
+def test_no_weights():
+    co = np.zeros((2, 3))
+    assert gp_bbone_eval.deform_points(co, {'a': np.zeros(2)}, {'a': straight_bone((0, 0, 0), (0, 1, 0))}) is None
+
+
+# RIGGED STROKE CHAIN
+# -----------------------------------------------------
+
+class Bones(dict):
+    # Iterates the bones, as bpy collections do
+    def __iter__(self):
+        return iter(self.values())
+
+
+def rest_matrix(head, tail):
+    matrix = np.eye(4)
+    matrix[:3, :3] = gp_bbone_eval.y_to_vec(gp_bbone_eval.normalized(np.subtract(tail, head, dtype=float)))
+    matrix[:3, 3] = head
+    return matrix
+
+
+def add_bone(armature, name, head, tail, parent=None, inherit_scale='FULL', order=0, **role):
+    head, tail = np.asarray(head, dtype=float), np.asarray(tail, dtype=float)
+    flags = {flag: role.pop(flag, False)
+             for flag in ('poser_control', 'poser_deform', 'poser_root', 'poser_lhandle', 'poser_rhandle')}
+    bone = SimpleNamespace(name=name, head_local=head, tail_local=tail, matrix_local=rest_matrix(head, tail),
+                           length=float(np.linalg.norm(tail - head)), bone_order=order, rigged_stroke=1,
+                           inherit_scale=inherit_scale, use_inherit_rotation=True,
+                           full_segments=4, bbone_segments=4, bbone_easein=1.0, bbone_easeout=1.0, **flags)
+    armature.data.bones[name] = bone
+    armature.pose.bones[name] = SimpleNamespace(name=name, bone=bone, parent=armature.pose.bones.get(parent),
+                                                rotation_mode='QUATERNION', constraints=[])
+
+
+def stroke_armature(name, n_controls=3):
+    """
+    The rig gp_rigging_ops builds for a straight stroke along X: controls
+    pointing up Z and handles under the root, the handles not inheriting its
+    scale, deform bones from every control to the next one
+    """
+    data = SimpleNamespace(name=name, bones=Bones(), get=lambda key, default=None: default)
+    armature = SimpleNamespace(name=name, data=data, pose=SimpleNamespace(bones={}), animation_data=None,
+                               constraints=[], parent=None)
+    add_bone(armature, 'root', (0, 0, 0), (0, 1, 0), poser_root=True)
+    for idx in range(n_controls):
+        head = (float(idx), 0.0, 0.0)
+        add_bone(armature, f'ctrl_{idx}', head, (idx, 0, 1), parent='root', order=idx, poser_control=True)
+        if idx < n_controls - 1:
+            add_bone(armature, f'deform_{idx}', head, (idx + 1, 0, 0), order=idx, poser_deform=True)
+            add_bone(armature, f'rhandle_{idx}', (idx + 0.3, 0, 0), (idx + 0.3, 0, 1), parent='root',
+                     inherit_scale='NONE', order=idx, poser_rhandle=True)
+            add_bone(armature, f'lhandle_{idx}', (idx + 0.7, 0, 0), (idx + 0.7, 0, 1), parent='root',
+                     inherit_scale='NONE', order=idx, poser_lhandle=True)
+    return armature
+
+
+@pytest.fixture
+def channels(monkeypatch):
+    """
+    Animated channels by bone name, the rest pose for the bones not in it
+    """
+    animated = {}
+
+    def sample_bones(armature, names, frames):
+        n = len(frames)
+        samples = {}
+        for name in names:
+            samples[name] = {'location': np.zeros((n, 3)), 'rotation_quaternion': np.tile([1.0, 0, 0, 0], (n, 1)),
+                             'rotation_euler': np.zeros((n, 3)), 'scale': np.ones((n, 3))}
+            samples[name].update(animated.get(name, {}))
+        return samples
+
+    monkeypatch.setattr(gp_bbone_eval, 'sample_bones', sample_bones)
+    return animated
+
+
+def test_stroke_chain_rest_pose(channels):
+    armature = stroke_armature('chain_rest')
+    assert gp_bbone_eval.unsupported_reason(armature, armature, 1) is None
+    segments_by_bone = gp_bbone_eval.deform_bone_segments(armature, 1, [1, 2])
+    assert sorted(segments_by_bone) == ['deform_0', 'deform_1']
+    for seg in segments_by_bone.values():
+        assert seg['points'] == pytest.approx(np.broadcast_to(seg['rest_points'], seg['points'].shape))
+
+
+def test_handles_ignore_root_scale(channels):
+    armature = stroke_armature('chain_scaled')
+    channels['root'] = {'scale': np.full((2, 3), 2.0)}
+    poses = gp_bbone_eval.pose_matrices(armature, ['rhandle_1', 'ctrl_1'], [1, 2])
+    # The location follows the scaled root, the rotation and scale don't
+    assert poses['rhandle_1'][:, :3, 3] == pytest.approx(np.tile([2.6, 0.0, 0.0], (2, 1)))
+    rest = armature.data.bones['rhandle_1'].matrix_local[:3, :3]
+    assert poses['rhandle_1'][:, :3, :3] == pytest.approx(np.broadcast_to(rest, (2, 3, 3)))
+    assert poses['ctrl_1'][:, :3, :3] == pytest.approx(np.broadcast_to(2.0 * rest, (2, 3, 3)))
+
+
+def test_constrained_control_falls_back(channels):
+    armature = stroke_armature('chain_constrained')
+    armature.pose.bones['ctrl_1'].constraints.append(SimpleNamespace(mute=False))
+    assert gp_bbone_eval.unsupported_reason(armature, armature, 1) == 'ctrl_1 has constraints'
+    assert gp_bbone_eval.deform_bone_segments(armature, 1, [1]) is None
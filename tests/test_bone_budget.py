@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from gomez_poser import gp_bone_budget
+
+# CURVATURE_SEGMENTS
+# -----------------------------------------------------
+
+def test_straight_segment_does_not_turn():
+    angles = gp_bone_budget.turning_angles([(0, 0, 0)], [(1, 0, 0)], [(2, 0, 0)], [(3, 0, 0)])
+    assert angles[0] == pytest.approx(0.0)
+
+
+def test_quarter_turn():
+    angles = gp_bone_budget.turning_angles([(0, 0, 0)], [(1, 0, 0)], [(1, 0, 0)], [(1, 1, 0)])
+    assert angles[0] == pytest.approx(np.pi / 2)
+
+
+def test_allocation_stays_within_budget():
+    counts = gp_bone_budget.allocate_segments([0.0, 1.0, 3.0, 0.5], 20)
+    assert sum(counts) <= 20
+    assert min(counts) >= 1
+    assert counts[2] == max(counts)
+    assert counts[0] == 1
+
+
+def test_allocation_caps_segments():
+    counts = gp_bone_budget.allocate_segments([1.0, 0.0], 100, max_segments=32)
+    assert counts == [32, 1]
+
+
+def test_curved_segments_get_more():
+    heads = [(0, 0, 0), (3, 0, 0)]
+    handles_l = [(1, 0, 0), (3, 1, 0)]
+    handles_r = [(2, 0, 0), (4, 1, 0)]
+    tails = [(3, 0, 0), (4, 0, 0)]
+    counts = gp_bone_budget.curvature_segments(heads, handles_l, handles_r, tails, 16)
+    assert counts[0] == 1
+    assert counts[1] == 15
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from gomez_poser import gp_delta_codec
+
+# ENCODE / DECODE
+# -----------------------------------------------------
+
+def random_walk(n_frames=100, n_points=20, step=0.01, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(scale=step, size=(n_frames, n_points, 3)), axis=0)
+
+
+def test_roundtrip_within_precision():
+    values = random_walk()
+    encoded = gp_delta_codec.encode(values, 1e-4)
+    assert np.abs(gp_delta_codec.decode(encoded) - values).max() <= 0.5e-4 + 1e-6
+
+
+def test_random_access_matches_full_decode():
+    values = random_walk()
+    encoded = gp_delta_codec.encode(values, 1e-4, keyframe_interval=8)
+    decoded = gp_delta_codec.decode(encoded)
+    for frame in (0, 1, 7, 8, 9, 50, 99):
+        assert gp_delta_codec.decode_frame(encoded, frame) == pytest.approx(decoded[frame])
+
+
+def test_periodic_keyframes():
+    encoded = gp_delta_codec.encode(random_walk(n_frames=20), 1e-4, keyframe_interval=8)
+    assert encoded['key_frames'].tolist() == [0, 8, 16]
+    assert encoded['deltas'].dtype == np.int16
+
+
+def test_overflow_forces_keyframe():
+    values = np.zeros((5, 1, 1))
+    values[3:] = 10.0
+    encoded = gp_delta_codec.encode(values, 1e-4)
+    assert 3 in encoded['key_frames'].tolist()
+    assert gp_delta_codec.decode_frame(encoded, 3)[0, 0] == pytest.approx(10.0)
+    assert gp_delta_codec.decode(encoded)[4, 0, 0] == pytest.approx(10.0)
+
+
+def test_save_and_load(tmp_path):
+    values = random_walk(n_frames=10)
+    encoded = gp_delta_codec.encode(values, 1e-3)
+    gp_delta_codec.save(str(tmp_path), 'co', encoded)
+    loaded = gp_delta_codec.load(str(tmp_path), 'co')
+    assert gp_delta_codec.decode_frame(loaded, 9) == pytest.approx(gp_delta_codec.decode(encoded)[9])
+
+
+def test_out_of_range_raises():
+    values = np.array([[0.0], [1e6]])
+    with pytest.raises(ValueError):
+        gp_delta_codec.encode(values, 1e-4)
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from gomez_poser import gp_fcurve_sampler
+
+# SAMPLE_KEYFRAMES
+# -----------------------------------------------------
+
+CONSTANT, LINEAR, BEZIER = (gp_fcurve_sampler.INTERPOLATIONS[name] for name in ('CONSTANT', 'LINEAR', 'BEZIER'))
+
+
+def keys(points, interpolation, handle=1.0/3.0):
+    co = np.array(points, dtype=float)
+    # Handles along the line to the neighbouring keys
+    left = co.copy()
+    right = co.copy()
+    right[:-1] += handle * (co[1:] - co[:-1])
+    left[1:] -= handle * (co[1:] - co[:-1])
+    return co, left, right, np.full(len(co), interpolation)
+
+
+def test_linear():
+    values, unsupported = gp_fcurve_sampler.sample_keyframes(*keys([(1, 0), (11, 10)], LINEAR), [1, 3.5, 11])
+    assert values.tolist() == pytest.approx([0.0, 2.5, 10.0])
+    assert not unsupported.any()
+
+
+def test_constant_and_extrapolation():
+    values, _ = gp_fcurve_sampler.sample_keyframes(*keys([(1, 2), (5, 7)], CONSTANT), [-3, 1, 4.9, 5, 20])
+    assert values.tolist() == [2.0, 2.0, 2.0, 7.0, 7.0]
+
+
+def test_bezier_with_aligned_handles_is_linear():
+    frames = np.linspace(0, 20, 41)
+    values, _ = gp_fcurve_sampler.sample_keyframes(*keys([(0, 0), (10, 5), (20, 10)], BEZIER), frames)
+    assert values == pytest.approx(frames / 2.0, abs=1e-5)
+
+
+def test_bezier_ease():
+    co, left, right, interpolation = keys([(0, 0), (10, 1)], BEZIER)
+    # Flat handles: ease in and out
+    right[0] = (10.0/3.0, 0.0)
+    left[1] = (20.0/3.0, 1.0)
+    values, _ = gp_fcurve_sampler.sample_keyframes(co, left, right, interpolation, [0, 2, 5, 8, 10])
+    assert values[2] == pytest.approx(0.5)
+    assert values[1] < 0.2
+    assert values[3] > 0.8
+
+
+def test_unsupported_interpolation():
+    co, left, right, interpolation = keys([(0, 0), (10, 1)], gp_fcurve_sampler.OTHER_INTERPOLATION)
+    _, unsupported = gp_fcurve_sampler.sample_keyframes(co, left, right, interpolation, [-1, 5, 10])
+    assert unsupported.tolist() == [False, True, False]
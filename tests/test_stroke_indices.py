@@ -0,0 +1,27 @@
+from array import array
+from mathutils import Vector
+from gomez_poser import gp_rigging_ops
+
+
+def flat(points):
+    return array('f', [c for p in points for c in p])
+
+# FIND_CHAIN_INDICES
+# -----------------------------------------------------
+
+def test_chain_indices_on_stroke():
+    co = flat([(i, 0, 0) for i in range(10)])
+    tails = [Vector((3, 0, 0)), Vector((7, 0, 0)), Vector((9, 0, 0))]
+    assert gp_rigging_ops.find_chain_indices(co, tails, 1e-4) == [3, 7, 9]
+
+
+def test_chain_indices_closed_stroke():
+    points = [(0, 0, 0), (1, 0, 0), (1, 1, 0), (0, 1, 0), (0, 0, 0)]
+    tails = [Vector((1, 1, 0)), Vector((0, 0, 0))]
+    assert gp_rigging_ops.find_chain_indices(flat(points), tails, 1e-4) == [2, 4]
+
+
+def test_chain_indices_off_stroke():
+    co = flat([(i, 0, 0) for i in range(10)])
+    tails = [Vector((3, 1, 0))]
+    assert gp_rigging_ops.find_chain_indices(co, tails, 1e-4) is None
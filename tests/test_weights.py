@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from gomez_poser import gp_weights
+
+# COMPUTE_DEFORM_WEIGHTS
+# -----------------------------------------------------
+
+def straight_stroke(n):
+    return np.array([(i, 0.0, 0.0) for i in range(n)])
+
+
+def test_hard_weights_without_falloff():
+    weights = gp_weights.compute_deform_weights(straight_stroke(11), [(0, 5), (5, 10)], 0.0)
+    assert weights[0, :5].tolist() == [1.0]*5
+    assert weights[1, 5:].tolist() == [1.0]*6
+    assert weights[0, 5:].sum() == 0.0
+
+
+def test_weights_are_normalized():
+    pairs = [(0, 4), (4, 12), (12, 20)]
+    weights = gp_weights.compute_deform_weights(straight_stroke(21), pairs, 0.5)
+    assert weights.sum(axis=0) == pytest.approx(np.ones(21))
+
+
+def test_weights_blend_at_joint():
+    weights = gp_weights.compute_deform_weights(straight_stroke(21), [(0, 10), (10, 20)], 0.4)
+    assert weights[0, 10] == pytest.approx(0.5)
+    assert weights[1, 10] == pytest.approx(0.5)
+    assert weights[0, 0] == 1.0
+    assert weights[1, 20] == 1.0